@@ -0,0 +1,60 @@
+"""
+Helpers to derive cameras that render exactly the pixels consumed by the diffusion guidance.
+"""
+
+from typing import Tuple
+
+import torch
+
+from nerfstudio.cameras.cameras import Cameras
+
+
+def get_guidance_size(height: int, width: int, short_side: int = 512) -> Tuple[int, int]:
+    """Returns the (height, width) of an image resized such that its smallest side is `short_side`."""
+    l = min(height, width)
+    return int(height * short_side / l), int(width * short_side / l)
+
+
+def resize_camera(camera: Cameras, height: int, width: int) -> Cameras:
+    """Returns a copy of `camera` with intrinsics scaled to render the same view at `height` x `width`.
+
+    Args:
+        camera: single camera to resize
+        height: target image height
+        width: target image width
+    """
+    scale_y = height / camera.height
+    scale_x = width / camera.width
+    return Cameras(
+        camera_to_worlds=camera.camera_to_worlds,
+        fx=camera.fx * scale_x,
+        fy=camera.fy * scale_y,
+        cx=camera.cx * scale_x,
+        cy=camera.cy * scale_y,
+        width=torch.full_like(camera.width, width),
+        height=torch.full_like(camera.height, height),
+        distortion_params=camera.distortion_params,
+        camera_type=camera.camera_type,
+        times=camera.times,
+        metadata=camera.metadata,
+    )
+
+
+def crop_camera(camera: Cameras, top: int, left: int, height: int, width: int) -> Cameras:
+    """Returns a copy of `camera` that only renders the `height` x `width` window starting at (`top`, `left`).
+
+    The principal point is shifted so that every pixel of the crop matches the pixel of the full image.
+    """
+    return Cameras(
+        camera_to_worlds=camera.camera_to_worlds,
+        fx=camera.fx,
+        fy=camera.fy,
+        cx=camera.cx - left,
+        cy=camera.cy - top,
+        width=torch.full_like(camera.width, width),
+        height=torch.full_like(camera.height, height),
+        distortion_params=camera.distortion_params,
+        camera_type=camera.camera_type,
+        times=camera.times,
+        metadata=camera.metadata,
+    )
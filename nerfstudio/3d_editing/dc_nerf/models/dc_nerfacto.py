@@ -20,7 +20,7 @@ from __future__ import annotations
 
 from collections import defaultdict
 from dataclasses import dataclass, field
-from typing import Dict, List, Literal, Optional, Tuple, Type
+from typing import Dict, List, Literal, Optional, Sequence, Tuple, Type
 
 import numpy as np
 import torch
@@ -283,7 +283,18 @@ class DCNerfactoModel(Model):
             )
         return callbacks
 
-    def get_outputs(self, ray_bundle: RayBundle):
+    def get_outputs(self, ray_bundle: RayBundle, output_keys: Optional[Sequence[str]] = None):
+        """Computes the model outputs for a ray bundle.
+
+        Args:
+            ray_bundle: rays to render
+            output_keys: if given, only these outputs are rendered; renderers and proposal depths for other keys
+                are skipped, as are the training-only sample lists.
+        """
+
+        def requested(key: str) -> bool:
+            return output_keys is None or key in output_keys
+
         ray_samples: RaySamples
         ray_samples, weights_list, ray_samples_list = self.proposal_sampler(ray_bundle, density_fns=self.density_fns)
         # print(ray_samples.spacing_starts.shape)
@@ -295,27 +306,27 @@ class DCNerfactoModel(Model):
         weights_list.append(weights)
         ray_samples_list.append(ray_samples)
 
-        rgb = self.renderer_rgb(rgb=field_outputs[FieldHeadNames.RGB], weights=weights)
-        depth = self.renderer_depth(weights=weights, ray_samples=ray_samples)
-        accumulation = self.renderer_accumulation(weights=weights)
-
-        outputs = {
-            "rgb": rgb,
-            "accumulation": accumulation,
-            "depth": depth,
-        }
+        outputs = {}
+        if requested("rgb"):
+            outputs["rgb"] = self.renderer_rgb(rgb=field_outputs[FieldHeadNames.RGB], weights=weights)
+        if requested("accumulation"):
+            outputs["accumulation"] = self.renderer_accumulation(weights=weights)
+        if requested("depth"):
+            outputs["depth"] = self.renderer_depth(weights=weights, ray_samples=ray_samples)
 
         if self.config.predict_normals:
-            normals = self.renderer_normals(normals=field_outputs[FieldHeadNames.NORMALS], weights=weights)
-            pred_normals = self.renderer_normals(field_outputs[FieldHeadNames.PRED_NORMALS], weights=weights)
-            outputs["normals"] = self.normals_shader(normals)
-            outputs["pred_normals"] = self.normals_shader(pred_normals)
+            if requested("normals"):
+                normals = self.renderer_normals(normals=field_outputs[FieldHeadNames.NORMALS], weights=weights)
+                outputs["normals"] = self.normals_shader(normals)
+            if requested("pred_normals"):
+                pred_normals = self.renderer_normals(field_outputs[FieldHeadNames.PRED_NORMALS], weights=weights)
+                outputs["pred_normals"] = self.normals_shader(pred_normals)
         # These use a lot of GPU memory, so we avoid storing them for eval.
-        if self.training:
+        if self.training and output_keys is None:
             outputs["weights_list"] = weights_list
             outputs["ray_samples_list"] = ray_samples_list
 
-        if self.training and self.config.predict_normals:
+        if self.training and self.config.predict_normals and output_keys is None:
             outputs["rendered_orientation_loss"] = orientation_loss(
                 weights.detach(), field_outputs[FieldHeadNames.NORMALS], ray_bundle.directions
             )
@@ -327,7 +338,10 @@ class DCNerfactoModel(Model):
             )
 
         for i in range(self.config.num_proposal_iterations):
-            outputs[f"prop_depth_{i}"] = self.renderer_depth(weights=weights_list[i], ray_samples=ray_samples_list[i])
+            if requested(f"prop_depth_{i}"):
+                outputs[f"prop_depth_{i}"] = self.renderer_depth(
+                    weights=weights_list[i], ray_samples=ray_samples_list[i]
+                )
 
         return outputs
 
@@ -411,7 +425,12 @@ class DCNerfactoModel(Model):
 
         return metrics_dict, images_dict
 
-    def diff_get_outputs_for_camera(self, camera: Cameras, obb_box: Optional[OrientedBox] = None) -> Dict[str, torch.Tensor]:
+    def diff_get_outputs_for_camera(
+        self,
+        camera: Cameras,
+        obb_box: Optional[OrientedBox] = None,
+        output_keys: Optional[Sequence[str]] = None,
+    ) -> Dict[str, torch.Tensor]:
         """
         differentiable version of `get_outputs_for_camera`
         Takes in a camera, generates the raybundle, and computes the output of the model.
@@ -419,16 +438,21 @@ class DCNerfactoModel(Model):
 
         Args:
             camera: generates raybundle
+            obb_box: optional box to crop the rays against
+            output_keys: outputs to render (e.g. ``("rgb",)``); all outputs when None
         """
         return self.diff_get_outputs_for_camera_ray_bundle(
-            camera.generate_rays(camera_indices=0, keep_shape=True, obb_box=obb_box)
+            camera.generate_rays(camera_indices=0, keep_shape=True, obb_box=obb_box), output_keys=output_keys
         )
 
-    def diff_get_outputs_for_camera_ray_bundle(self, camera_ray_bundle: RayBundle) -> Dict[str, torch.Tensor]:
+    def diff_get_outputs_for_camera_ray_bundle(
+        self, camera_ray_bundle: RayBundle, output_keys: Optional[Sequence[str]] = None
+    ) -> Dict[str, torch.Tensor]:
         """Takes in camera parameters and computes the output of the model.
 
         Args:
             camera_ray_bundle: ray bundle to calculate outputs over
+            output_keys: outputs to render (e.g. ``("rgb",)``); all outputs when None
         """
         input_device = camera_ray_bundle.directions.device
         num_rays_per_chunk = self.config.eval_num_rays_per_chunk
@@ -441,7 +465,10 @@ class DCNerfactoModel(Model):
             ray_bundle = camera_ray_bundle.get_row_major_sliced_ray_bundle(start_idx, end_idx)
             # move the chunk inputs to the model device
             ray_bundle = ray_bundle.to(self.device)
-            outputs = self.forward(ray_bundle=ray_bundle)
+            # same as `Model.forward`, but lets `get_outputs` skip the unrequested renderers
+            if self.collider is not None:
+                ray_bundle = self.collider(ray_bundle)
+            outputs = self.get_outputs(ray_bundle, output_keys=output_keys)
             for output_name, output in outputs.items():  # type: ignore
                 if not isinstance(output, torch.Tensor):
                     # TODO: handle lists of tensors as well
@@ -5,7 +5,7 @@ Code borrowed from nerfstudio==1.0.2
 from __future__ import annotations
 
 from dataclasses import dataclass, field
-from typing import Dict, Optional, Tuple, Type
+from typing import Dict, Optional, Sequence, Tuple, Type
 
 import torch
 
@@ -28,17 +28,24 @@ class DCSplatfactoModel(SplatfactoModel):
     """
 
     def diff_get_outputs_for_camera(
-        self, camera: Cameras, obb_box: Optional[OrientedBox] = None
+        self,
+        camera: Cameras,
+        obb_box: Optional[OrientedBox] = None,
+        output_keys: Optional[Sequence[str]] = None,
     ) -> Dict[str, torch.Tensor]:
         """Takes in a camera, generates the raybundle, and computes the output of the model.
         Overridden for a camera-based gaussian model.
 
         Args:
             camera: generates raybundle
+            obb_box: optional box to crop the gaussians against
+            output_keys: outputs to return (e.g. ``("rgb",)``); all outputs when None
         """
         assert camera is not None, "must provide camera to gaussian model"
         self.set_crop(obb_box)
         outs = self.get_outputs(camera.to(self.device))
+        if output_keys is not None:
+            outs = {key: value for key, value in outs.items() if key in output_keys}
         return outs  # type: ignore
 
     def get_image_metrics_and_images(
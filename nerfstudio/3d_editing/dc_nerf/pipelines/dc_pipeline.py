@@ -1,4 +1,3 @@
-from collections import defaultdict
 from dataclasses import dataclass, field
 from typing import Optional, Type, Union
 
@@ -7,12 +6,12 @@ import numpy as np
 import torch
 import torch.nn.functional as F
 import torchvision.transforms.functional as TF
-from nerfstudio.cameras.rays import RayBundle
 from nerfstudio.pipelines.base_pipeline import VanillaPipelineConfig
 from PIL import Image
 from torch.cuda.amp.grad_scaler import GradScaler
 from typing_extensions import Literal
 
+from dc_nerf.cameras.dc_camera_utils import crop_camera, get_guidance_size, resize_camera
 from dc_nerf.pipelines.base_pipeline import ModifiedVanillaPipeline
 from dc_nerf.data.datamanagers.dc_datamanager import DCDataManagerConfig
 from dc.dc import DC, DCConfig, tensor_to_pil, DC
@@ -36,6 +35,15 @@ class DCPipelineConfig(VanillaPipelineConfig):
     change_view_step: int = 1
     log_step: int = 10
 
+    # "full" renders at the camera resolution and resizes to the guidance resolution,
+    # "guidance" renders directly at the guidance resolution by scaling the intrinsics,
+    # "patch" renders a random `patch_size` crop of the guidance-resolution view.
+    render_mode: Literal["full", "guidance", "patch"] = "full"
+    guidance_short_side: int = 512
+    patch_size: int = 256
+    # anti-aliasing for "guidance"/"patch": render at this multiple of the guidance resolution and box-filter down.
+    render_supersample: int = 1
+
 
 class DCPipeline(ModifiedVanillaPipeline):
     config: DCPipelineConfig
@@ -70,30 +78,47 @@ class DCPipeline(ModifiedVanillaPipeline):
         current_spot = self.current_spot
         current_index = self.datamanager.image_batch["image_idx"][current_spot]
         current_camera = self.datamanager.train_dataparser_outputs.cameras[current_index:current_index+1].to(self.device)
-        camera_outputs = self.model.diff_get_outputs_for_camera(current_camera)
+
+        crop = None
+        supersample = self.config.render_supersample
+        if self.config.render_mode != "full":
+            h, w = get_guidance_size(
+                int(current_camera.height), int(current_camera.width), self.config.guidance_short_side
+            )
+            current_camera = resize_camera(current_camera, h * supersample, w * supersample)
+            if self.config.render_mode == "patch":
+                # keep the crop aligned to the 8x8 VAE grid so that it maps onto a latent crop.
+                size = min(self.config.patch_size, h, w) // 8 * 8
+                top = np.random.randint((h - size) // 8 + 1) * 8
+                left = np.random.randint((w - size) // 8 + 1) * 8
+                crop = (top, left, size)
+                current_camera = crop_camera(
+                    current_camera, top * supersample, left * supersample, size * supersample, size * supersample
+                )
+
+        camera_outputs = self.model.diff_get_outputs_for_camera(current_camera, output_keys=("rgb",))
         rendered_image = camera_outputs["rgb"].unsqueeze(dim=0).permute(0, 3, 1, 2)  # [B,3,H,W]
+        if self.config.render_mode != "full" and supersample > 1:
+            rendered_image = F.avg_pool2d(rendered_image, supersample)
 
         # delete to free up memory
         del camera_outputs
         del current_camera
         clean_gpu()
 
-        return rendered_image, current_spot
+        return rendered_image, current_spot, crop
 
     def get_train_loss_dict(self, step: int):
         loss_dict = dict()
 
-        rendered_image, current_spot = self.get_current_rendering(step)
+        rendered_image, current_spot, crop = self.get_current_rendering(step)
         # get original image from dataloader
         original_image = self.datamanager.original_image_batch["image"][current_spot].to(self.device)
         original_image = original_image.unsqueeze(dim=0).permute(0, 3, 1, 2)
 
-        h, w = original_image.shape[2:]
-        l = min(h, w)
-        h = int(h * 512 / l)
-        w = int(w * 512 / l)  # resize an image such that the smallest length is 512.
+        # resize an image such that the smallest length is 512.
+        h, w = get_guidance_size(*original_image.shape[2:], self.config.guidance_short_side)
         original_image_512 = F.interpolate(original_image, size=(h, w), mode="bilinear")
-        rendered_image_512 = F.interpolate(rendered_image, size=(h, w), mode="bilinear")
 
         if current_spot not in self.src_x0s.keys():
             with torch.no_grad():
@@ -102,6 +127,18 @@ class DCPipeline(ModifiedVanillaPipeline):
         else:
             src_x0 = self.src_x0s[current_spot].to(self.dc_device)
 
+        if crop is not None:
+            # run the DC loss on the rendered patch and the matching crop of the source image and latents.
+            top, left, size = crop
+            original_image = original_image_512 = original_image_512[..., top : top + size, left : left + size]
+            src_x0 = src_x0[..., top // 8 : (top + size) // 8, left // 8 : (left + size) // 8]
+            h = w = size
+
+        if rendered_image.shape[2:] != (h, w):
+            rendered_image_512 = F.interpolate(rendered_image, size=(h, w), mode="bilinear")
+        else:
+            rendered_image_512 = rendered_image
+
         x0 = self.dc.encode_image(rendered_image_512.to(self.dc_device))
         src_emb = self.dc.encode_src_image(original_image_512.to(self.dc_device))
 
@@ -161,28 +198,3 @@ class DCPipeline(ModifiedVanillaPipeline):
         vis_grad = vis_grad.resize((w, h), resample=Image.Resampling.NEAREST)
         
         return vis_grad
-
-    # to enable backprop.
-    def get_outputs_for_camera_ray_bundle(self, camera_ray_bundle: RayBundle):
-        input_device = camera_ray_bundle.directions.device
-        num_rays_per_chunk = self.model.config.eval_num_rays_per_chunk
-        image_height, image_width = camera_ray_bundle.origins.shape[:2]
-        num_rays = len(camera_ray_bundle)
-        outputs_lists = defaultdict(list)
-        for i in range(0, num_rays, num_rays_per_chunk):
-            start_idx = i
-            end_idx = i + num_rays_per_chunk
-            ray_bundle = camera_ray_bundle.get_row_major_sliced_ray_bundle(start_idx, end_idx)
-            # move the chunk inputs to the model device
-            ray_bundle = ray_bundle.to(self.device)
-            outputs = self.model.forward(ray_bundle=ray_bundle)
-            for output_name, output in outputs.items():  # type: ignore
-                if not isinstance(output, torch.Tensor):
-                    # TODO: handle lists of tensors as well
-                    continue
-                # move the chunk outputs from the model device back to the device of the inputs.
-                outputs_lists[output_name].append(output.to(input_device))
-        outputs = {}
-        for output_name, outputs_list in outputs_lists.items():
-            outputs[output_name] = torch.cat(outputs_list).view(image_height, image_width, -1)  # type: ignore
-        return outputs
@@ -10,6 +10,7 @@ from dc_nerf.data.datamanagers.dc_splat_datamanager import DCSplatDataManagerCon
 import numpy as np
 import torch
 
+from dc_nerf.cameras.dc_camera_utils import get_guidance_size, resize_camera
 from dc_nerf.pipelines.base_pipeline import ModifiedVanillaPipeline
 from dc_nerf.data.datamanagers.dc_datamanager import DCDataManagerConfig
 from torch.cuda.amp.grad_scaler import GradScaler
@@ -34,6 +35,7 @@ class RefinementPipelineConfig(VanillaPipelineConfig):
     log_step: int = 100
     edit_rate: int = 10
     edit_count: int = 1
+    guidance_short_side: int = 512
 
 
 class RefinementPipeline(ModifiedVanillaPipeline):
@@ -71,7 +73,10 @@ class RefinementPipeline(ModifiedVanillaPipeline):
         current_camera = self.datamanager.train_dataparser_outputs.cameras[current_index : current_index + 1].to(
             self.device
         )
-        camera_outputs = self.model.diff_get_outputs_for_camera(current_camera)
+        # the rendering is only logged, so render it at the guidance resolution instead of the camera resolution.
+        h, w = get_guidance_size(int(current_camera.height), int(current_camera.width), self.config.guidance_short_side)
+        current_camera = resize_camera(current_camera, h, w)
+        camera_outputs = self.model.diff_get_outputs_for_camera(current_camera, output_keys=("rgb",))
         rendered_image = camera_outputs["rgb"].unsqueeze(dim=0).permute(0, 3, 1, 2)  # [B,3,H,W]
         # delete to free up memory
         del camera_outputs
@@ -92,11 +97,7 @@ class RefinementPipeline(ModifiedVanillaPipeline):
 
                 # with torch.no_grad():
                 if True:
-                    h, w = input_img.shape[2:]
-                    l = min(h, w)
-                    h = int(h * 512 / l)
-                    w = int(w * 512 / l)
-
+                    h, w = get_guidance_size(*input_img.shape[2:], self.config.guidance_short_side)
                     resized_img = torch.nn.functional.interpolate(input_img, size=(h, w), mode="bilinear")
                     latents = self.dc.encode_image(resized_img.to(self.dc_device))
 
@@ -110,9 +111,9 @@ class RefinementPipeline(ModifiedVanillaPipeline):
                 edit_x0 = self.dc.run_sdedit(x0, skip=skip)
                 edit_img = self.dc.decode_latent(edit_x0)
 
-                if edit_img.size() != rendered_image.size():
+                if edit_img.size() != original_image.size():
                     edit_img = torch.nn.functional.interpolate(
-                        edit_img, size=rendered_image.size()[2:], mode="bilinear"
+                        edit_img, size=original_image.size()[2:], mode="bilinear"
                     )
 
                 self.datamanager.image_batch["image"][current_spot] = edit_img.squeeze().permute(1, 2, 0)  # [H,W,3]
@@ -13,6 +13,7 @@ from PIL import Image
 from typing import List, Dict
 from dc.dc_unet import CustomUNet2DConditionModel
 from dc.utils.free_lunch import register_free_upblock2d_in, register_free_crossattn_upblock2d_in
+from dc.utils.cfg_planner import CFGPlanner
 import math
 
 @dataclass
@@ -224,31 +225,44 @@ class DC(object):
         eps = dict()
         pred_x0s = dict()
         noisy_latents = dict()
-        
+
+        # one UNet batch for both branches: the source guidance has no text term, and the rows of the two
+        # branches coincide when src_x0 is tgt_x0 (decided by identity, comparing values would sync every step)
+        planner = CFGPlanner()
+        uncond_embeddings = torch.cat([uncond_embedding, uncond_embedding], dim=1)
+        src_encoded = src_emb.latent_dist.mode()
+        uncond_image_latent = torch.zeros_like(src_encoded)
+        rows = dict()
         for latent, cond_text_embedding, name in zip(
             [tgt_x0, src_x0], [tgt_text_embedding, src_text_embedding], ["tgt", "src"]
         ):
-            latents_noisy = scheduler.add_noise(latent, noise, t)
-            text_embeddings = torch.cat([cond_text_embedding, uncond_embedding, uncond_embedding], dim=0)
-            text_embeddings = torch.cat([text_embeddings, text_embeddings], dim=1)
+            if name == "src" and src_x0 is tgt_x0:
+                latents_noisy = noisy_latents["tgt"]
+            else:
+                latents_noisy = scheduler.add_noise(latent, noise, t)
+            noisy_latents[name] = latents_noisy
 
-            src_encoded = src_emb.latent_dist.mode()
-            
-            uncond_image_latent = torch.zeros_like(src_encoded)
-            latent_image = torch.cat([src_encoded, src_encoded, uncond_image_latent], dim=0)
-            latent_model_input = torch.cat([latents_noisy] * 3, dim=0)
-            latent_model_input = torch.cat([latent_model_input, latent_image], dim=1)
-
-            unet_outputs = self.unet.forward(
-                latent_model_input,
-                torch.cat([t] * 3).to(device),
-                encoder_hidden_states=text_embeddings,
+            rows[name] = dict(
+                image=planner.add(latents_noisy, uncond_embeddings, src_encoded),
+                uncond=planner.add(latents_noisy, uncond_embeddings, uncond_image_latent),
             )
-            noise_pred = unet_outputs.sample
-            unet_feats = unet_outputs.features
+            if name == "tgt":
+                text_embeddings = torch.cat([cond_text_embedding, cond_text_embedding], dim=1)
+                rows[name]["text"] = planner.add(latents_noisy, text_embeddings, src_encoded)
+
+        noise_preds = planner.run(
+            lambda x, timesteps, embeddings: self.unet.forward(
+                x, timesteps.to(device), encoder_hidden_states=embeddings
+            ).sample,
+            t,
+        )
 
-            noise_pred_text, noise_pred_image, noise_pred_uncond = noise_pred.chunk(3)
+        for name in ["tgt", "src"]:
+            latents_noisy = noisy_latents[name]
+            noise_pred_image = noise_preds[rows[name]["image"]]
+            noise_pred_uncond = noise_preds[rows[name]["uncond"]]
             if name == "tgt":
+                noise_pred_text = noise_preds[rows[name]["text"]]
                 noise_pred = noise_pred_uncond + self.config.guidance_scale * (noise_pred_text - noise_pred_image) + \
                     self.config.image_guidance_scale * (noise_pred_image - noise_pred_uncond)
             else:
@@ -269,7 +283,6 @@ class DC(object):
 
             eps[name] = noise_pred
             pred_x0s[name] = pred_x0
-            noisy_latents[name] = latents_noisy
            
         self.iteration += 1
         
@@ -18,7 +18,12 @@ from diff_gaussian_rasterization import (
 from gaussiansplatting.utils.sh_utils import eval_sh
 
 
-def camera2rasterizer(viewpoint_camera, bg_color: torch.Tensor, sh_degree: int = 0):
+def camera2rasterizer(
+    viewpoint_camera,
+    bg_color: torch.Tensor,
+    sh_degree: int = 0,
+    scaling_modifier=1.0,
+):
     tanfovx = math.tan(viewpoint_camera.FoVx * 0.5)
     tanfovy = math.tan(viewpoint_camera.FoVy * 0.5)
 
@@ -28,7 +33,7 @@ def camera2rasterizer(viewpoint_camera, bg_color: torch.Tensor, sh_degree: int =
         tanfovx=tanfovx,
         tanfovy=tanfovy,
         bg=bg_color,
-        scale_modifier=1.0,
+        scale_modifier=scaling_modifier,
         viewmatrix=viewpoint_camera.world_view_transform,
         projmatrix=viewpoint_camera.full_proj_transform,
         sh_degree=sh_degree,
@@ -42,101 +47,167 @@ def camera2rasterizer(viewpoint_camera, bg_color: torch.Tensor, sh_degree: int =
     return rasterizer
 
 
-def render(
-    viewpoint_camera,
-    pc,
-    pipe,
-    bg_color: torch.Tensor,
-    scaling_modifier=1.0,
-    override_color=None,
-):
+def frustum_cull(viewpoint_camera, xyz, index=None, margin=0.3, znear=0.2):
     """
-    Render the scene.
+    Indices of the Gaussians (among `index`, or all of them) whose centers lie in the view frustum.
 
-    Background tensor (bg_color) must be on GPU!
+    The frustum is widened by `margin` in normalized device coordinates on every side, so that splats
+    centered just outside the image still reach its border. znear matches the rasterizer's near plane.
     """
-
-    # Create zero tensor. We will use it to make pytorch return gradients of the 2D (screen-space) means
-    screenspace_points = (
-        torch.zeros_like(
-            pc.get_xyz, dtype=pc.get_xyz.dtype, requires_grad=True, device="cuda"
-        )
-        + 0
+    if index is not None:
+        xyz = xyz[index]
+    xyz_h = torch.cat([xyz, torch.ones_like(xyz[:, :1])], dim=1)
+    p_view = xyz_h @ viewpoint_camera.world_view_transform
+    p_hom = xyz_h @ viewpoint_camera.full_proj_transform
+    p_ndc = p_hom[:, :2] / (p_hom[:, 3:] + 1e-7)
+    visible = torch.logical_and(
+        p_view[:, 2] > znear, (p_ndc.abs() <= 1 + margin).all(dim=1)
     )
-    try:
-        screenspace_points.retain_grad()
-    except:
-        pass
+    visible_index = visible.nonzero()[:, 0]
+    return visible_index if index is None else index[visible_index]
 
-    # Set up rasterization configuration
-    tanfovx = math.tan(viewpoint_camera.FoVx * 0.5)
-    tanfovy = math.tan(viewpoint_camera.FoVy * 0.5)
 
-    raster_settings = GaussianRasterizationSettings(
-        image_height=int(viewpoint_camera.image_height),
-        image_width=int(viewpoint_camera.image_width),
-        tanfovx=tanfovx,
-        tanfovy=tanfovy,
-        bg=bg_color,
-        scale_modifier=scaling_modifier,
-        viewmatrix=viewpoint_camera.world_view_transform,
-        projmatrix=viewpoint_camera.full_proj_transform,
-        sh_degree=pc.active_sh_degree,
-        campos=viewpoint_camera.camera_center,
-        prefiltered=False,
-        debug=False,
-    )
-
-    rasterizer = GaussianRasterizer(raster_settings=raster_settings)
-
-    means3D = pc.get_xyz
-    means2D = screenspace_points
-    opacity = pc.get_opacity
+def gaussian_attributes(pc, pipe, scaling_modifier=1.0, override_color=None, index=None):
+    """
+    Activated attributes of the Gaussians `index` (or all of them), computed once for any number of
+    cameras. override_color, if given, is per model Gaussian.
+    """
+    if index is None:
+        means3D = pc.get_xyz
+        opacity = pc.get_opacity
+        scales = pc.get_scaling
+        rotations = pc.get_rotation
+    else:
+        means3D = pc._xyz[index]
+        opacity = pc.opacity_activation(pc._opacity[index])
+        scales = pc.scaling_activation(pc._scaling[index])
+        rotations = pc.rotation_activation(pc._rotation[index])
+        if override_color is not None:
+            override_color = override_color[index]
 
     # If precomputed 3d covariance is provided, use it. If not, then it will be computed from
     # scaling / rotation by the rasterizer.
-    scales = None
-    rotations = None
     cov3D_precomp = None
     if pipe.compute_cov3D_python:
-        cov3D_precomp = pc.get_covariance(scaling_modifier)
-    else:
-        scales = pc.get_scaling
-        rotations = pc.get_rotation
+        if index is None:
+            cov3D_precomp = pc.get_covariance(scaling_modifier)
+        else:
+            cov3D_precomp = pc.covariance_activation(
+                scales, scaling_modifier, pc._rotation[index]
+            )
+        scales = None
+        rotations = None
+
+    features = None
+    if override_color is None:
+        if index is None:
+            features = pc.get_features
+        else:
+            features = torch.cat(
+                (pc._features_dc[index], pc._features_rest[index]), dim=1
+            )
+
+    return {
+        "means3D": means3D,
+        "opacity": opacity,
+        "scales": scales,
+        "rotations": rotations,
+        "cov3D_precomp": cov3D_precomp,
+        "features": features,
+        "override_color": override_color,
+    }
+
+
+def rasterize(
+    viewpoint_camera,
+    pc,
+    pipe,
+    attributes,
+    means2D,
+    bg_color: torch.Tensor,
+    scaling_modifier=1.0,
+):
+    rasterizer = camera2rasterizer(
+        viewpoint_camera, bg_color, pc.active_sh_degree, scaling_modifier
+    )
 
     # If precomputed colors are provided, use them. Otherwise, if it is desired to precompute colors
     # from SHs in Python, do it. If not, then SH -> RGB conversion will be done by rasterizer.
     shs = None
     colors_precomp = None
-    if override_color is None:
+    features = attributes["features"]
+    if attributes["override_color"] is None:
         if pipe.convert_SHs_python:
-            shs_view = pc.get_features.transpose(1, 2).view(
+            shs_view = features.transpose(1, 2).view(
                 -1, 3, (pc.max_sh_degree + 1) ** 2
             )
-            dir_pp = pc.get_xyz - viewpoint_camera.camera_center.repeat(
-                pc.get_features.shape[0], 1
+            dir_pp = attributes["means3D"] - viewpoint_camera.camera_center.repeat(
+                features.shape[0], 1
             )
             dir_pp_normalized = dir_pp / dir_pp.norm(dim=1, keepdim=True)
             sh2rgb = eval_sh(pc.active_sh_degree, shs_view, dir_pp_normalized)
             colors_precomp = torch.clamp_min(sh2rgb + 0.5, 0.0)
         else:
-            shs = pc.get_features
-
-        shs = shs.float()
+            shs = features.float()
     else:
-        colors_precomp = override_color
+        colors_precomp = attributes["override_color"]
 
+    scales = attributes["scales"]
+    rotations = attributes["rotations"]
     # Rasterize visible Gaussians to image, obtain their radii (on screen).
-    # import pdb; pdb.set_trace()
-    rendered_image, radii, depth = rasterizer(
-        means3D=means3D.float(),
+    return rasterizer(
+        means3D=attributes["means3D"].float(),
         means2D=means2D.float(),
         shs=shs,
         colors_precomp=colors_precomp,
-        opacities=opacity.float(),
-        scales=scales.float(),
-        rotations=rotations.float(),
-        cov3D_precomp=cov3D_precomp,
+        opacities=attributes["opacity"].float(),
+        scales=scales.float() if scales is not None else None,
+        rotations=rotations.float() if rotations is not None else None,
+        cov3D_precomp=attributes["cov3D_precomp"],
+    )
+
+
+def render(
+    viewpoint_camera,
+    pc,
+    pipe,
+    bg_color: torch.Tensor,
+    scaling_modifier=1.0,
+    override_color=None,
+    index=None,
+):
+    """
+    Render the scene.
+
+    Background tensor (bg_color) must be on GPU!
+
+    With `index` (a LongTensor of Gaussian indices) only those Gaussians are activated and rasterized;
+    "viewspace_points", "visibility_filter" and "radii" are then per packed Gaussian, and "index" maps
+    them back to the model. override_color, if given, is per model Gaussian.
+    """
+    attributes = gaussian_attributes(pc, pipe, scaling_modifier, override_color, index)
+
+    # Create zero tensor. We will use it to make pytorch return gradients of the 2D (screen-space) means
+    means3D = attributes["means3D"]
+    screenspace_points = (
+        torch.zeros_like(
+            means3D, dtype=means3D.dtype, requires_grad=True, device="cuda"
+        )
+        + 0
+    )
+    try:
+        screenspace_points.retain_grad()
+    except:
+        pass
+
+    rendered_image, radii, depth = rasterize(
+        viewpoint_camera,
+        pc,
+        pipe,
+        attributes,
+        screenspace_points,
+        bg_color,
+        scaling_modifier,
     )
 
     # Those Gaussians that were frustum culled or had a radius of 0 were not visible.
@@ -147,9 +218,67 @@ def render(
         "visibility_filter": radii > 0,
         "radii": radii,
         "depth_3dgs": depth,
+        "index": index,
     }
 
 
+def render_batch(
+    viewpoint_cameras,
+    pc,
+    pipe,
+    bg_color: torch.Tensor,
+    scaling_modifier=1.0,
+    override_color=None,
+    index=None,
+):
+    """
+    Render the scene from several cameras, returning one render() output per camera.
+
+    The activated attributes are computed once and shared by every camera. "viewspace_points" is a
+    single (num_cameras, num_gaussians, 3) tensor shared by all outputs, so the screen-space gradients
+    of the whole batch are accumulated with one sum over its first dimension.
+    """
+    attributes = gaussian_attributes(pc, pipe, scaling_modifier, override_color, index)
+
+    means3D = attributes["means3D"]
+    screenspace_points = (
+        torch.zeros(
+            (len(viewpoint_cameras), *means3D.shape),
+            dtype=means3D.dtype,
+            requires_grad=True,
+            device="cuda",
+        )
+        + 0
+    )
+    try:
+        screenspace_points.retain_grad()
+    except:
+        pass
+
+    outputs = []
+    for camera_id, viewpoint_camera in enumerate(viewpoint_cameras):
+        rendered_image, radii, depth = rasterize(
+            viewpoint_camera,
+            pc,
+            pipe,
+            attributes,
+            screenspace_points[camera_id],
+            bg_color,
+            scaling_modifier,
+        )
+        outputs.append(
+            {
+                "render": rendered_image,
+                "viewspace_points": screenspace_points,
+                "visibility_filter": radii > 0,
+                "radii": radii,
+                "depth_3dgs": depth,
+                "index": index,
+            }
+        )
+    return outputs
+
+
 # from gaussiansplatting.scene.gaussian_model import GaussianModel
 
 
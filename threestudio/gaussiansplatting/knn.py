@@ -1,20 +1,152 @@
+import math
+
 import torch
-from scipy.spatial import KDTree
+from scipy.spatial import cKDTree
+
+# queries sent to the kd-tree or hashed into the voxel grid at once, bounds the float64 copies and result buffers
+QUERY_CHUNK = 1 << 20
+# occupied cells dilated at once, each one expands to up to 125 neighbor keys
+DILATION_CHUNK = 1 << 16
+
+
+class KNNIndex:
+    # Nearest-neighbor index over a fixed (N, 3) point set. Build it once and query it as often as needed.
+
+    def __init__(self, points: torch.Tensor):
+        self.points = points.detach()
+
+    def query(self, query: torch.Tensor, K: int):
+        # (dist, idx) of the K nearest points, shaped (Q,) for K == 1 and (Q, K) otherwise
+        raise NotImplementedError
+
+    def within_radius(self, query: torch.Tensor, radius: float):
+        # (Q,) bool, whether any point lies within `radius` of each query
+        dist, _ = self.query(query, 1)
+        return dist <= radius
+
+
+class KDTreeIndex(KNNIndex):
+    # scipy's cKDTree, queried in chunks on all cores
+
+    def __init__(self, points: torch.Tensor, workers: int = -1):
+        super().__init__(points)
+        self.workers = workers
+        self.tree = cKDTree(self.points.cpu().numpy())
+
+    @torch.no_grad()
+    def query(self, query: torch.Tensor, K: int, distance_upper_bound: float = math.inf):
+        query_np = query.detach().cpu().numpy()
+        nn_dist = []
+        nn_idx = []
+        for start in range(0, max(query_np.shape[0], 1), QUERY_CHUNK):
+            dist, idx = self.tree.query(
+                query_np[start: start + QUERY_CHUNK],
+                k=K,
+                distance_upper_bound=distance_upper_bound,
+                workers=self.workers,
+            )
+            nn_dist.append(torch.from_numpy(dist))
+            nn_idx.append(torch.from_numpy(idx))
+        nn_dist = torch.cat(nn_dist).to(self.points)
+        nn_idx = torch.cat(nn_idx).to(self.points.device).to(torch.long)
+        return nn_dist, nn_idx
+
+    def within_radius(self, query: torch.Tensor, radius: float):
+        # misses come back as inf, so the tree can stop descending past the radius
+        dist, _ = self.query(query, 1, distance_upper_bound=radius * (1 + 1e-6))
+        return dist <= radius
+
+
+class VoxelGridIndex(KNNIndex):
+    # Hashed voxel grid on the device of the points, for fixed-radius queries.
+    # With cells of edge radius / sqrt(3), a query sharing its cell with a point is always within the radius
+    # and a query with no occupied cell among its 5^3 neighbors never is. Both cell sets are hashed once per
+    # radius; only the queries in between, a thin shell around the point set, go to a kd-tree built on first use.
+
+    def __init__(self, points: torch.Tensor):
+        super().__init__(points)
+        self.grids = {}
+        self.tree = None
+
+    def _tree(self):
+        if self.tree is None:
+            self.tree = KDTreeIndex(self.points)
+        return self.tree
+
+    def _grid(self, radius):
+        if radius not in self.grids:
+            cell = radius / math.sqrt(3) * (1 - 1e-6)
+            origin = self.points.min(dim=0).values
+            coords = torch.floor((self.points - origin) / cell).long()
+            # two cells of padding so that the neighbors of every occupied cell have valid keys
+            dims = coords.max(dim=0).values + 5
+            occupied = torch.unique(self._key(coords + 2, dims))
+            # cells with an occupied cell among their 5^3 neighbors, dilating one axis at a time over chunks of
+            # occupied cells, so that a large sparse object never holds all of its 125 neighbor keys at once
+            near = []
+            for start in range(0, occupied.shape[0], DILATION_CHUNK):
+                cells = occupied[start: start + DILATION_CHUNK]
+                for stride in [dims[1] * dims[2], dims[2], 1]:
+                    shifts = torch.arange(-2, 3, device=occupied.device) * stride
+                    cells = torch.unique((cells[:, None] + shifts).reshape(-1))
+                near.append(cells)
+            near = torch.unique(torch.cat(near))
+            self.grids[radius] = (cell, origin, dims, occupied, near)
+        return self.grids[radius]
+
+    @staticmethod
+    def _key(coords, dims):
+        return (coords[..., 0] * dims[1] + coords[..., 1]) * dims[2] + coords[..., 2]
+
+    @staticmethod
+    def _contains(keys, sorted_keys):
+        pos = torch.searchsorted(sorted_keys, keys).clamp_(max=sorted_keys.shape[0] - 1)
+        return sorted_keys[pos] == keys
+
+    def query(self, query: torch.Tensor, K: int):
+        return self._tree().query(query, K)
+
+    @torch.no_grad()
+    def within_radius(self, query: torch.Tensor, radius: float):
+        result = torch.zeros(query.shape[0], dtype=torch.bool, device=query.device)
+        if query.shape[0] == 0 or self.points.shape[0] == 0:
+            return result
+        cell, origin, dims, occupied, near = self._grid(radius)
+        for start in range(0, query.shape[0], QUERY_CHUNK):
+            chunk = query[start: start + QUERY_CHUNK].detach()
+            coords = torch.floor((chunk.to(origin) - origin) / cell).long() + 2
+            inside = torch.nonzero(((coords >= 0) & (coords < dims)).all(dim=1))[:, 0]
+            keys = self._key(coords[inside], dims)
+            hit = self._contains(keys, occupied)
+            result[start + inside[hit]] = True
+
+            candidates = inside[~hit][self._contains(keys[~hit], near)]
+            if candidates.shape[0] > 0:
+                result[start + candidates] = (
+                    self._tree().within_radius(chunk[candidates], radius).to(result.device)
+                )
+        return result
+
+
+KNN_BACKENDS = {
+    "kdtree": KDTreeIndex,
+    "voxel": VoxelGridIndex,
+}
+
+
+def build_knn_index(points: torch.Tensor, backend: str = "kdtree") -> KNNIndex:
+    return KNN_BACKENDS[backend](points)
 
 
 @torch.no_grad()
 def K_nearest_neighbors(
-    mean: torch.Tensor, K: int, query: None, return_dist: bool = False
+    mean: torch.Tensor, K: int, query: None, return_dist: bool = False, index: KNNIndex = None
 ):
-    mean_np = mean.detach().cpu().numpy()
-    query_np = query.detach().cpu().numpy()
-
-    kdtree = KDTree(mean_np)
-
-    nn_dist, nn_idx = kdtree.query(query_np, k=K)
+    # pass a prebuilt `index` over `mean` to skip building the tree again
+    if index is None:
+        index = KDTreeIndex(mean)
 
-    nn_dist = torch.from_numpy(nn_dist).to(mean)
-    nn_idx = torch.from_numpy(nn_idx).to(mean.device).to(torch.long)
+    nn_dist, nn_idx = index.query(query, K)
 
     if not return_dist:
         return mean[nn_idx], nn_idx
@@ -23,9 +155,36 @@ def K_nearest_neighbors(
 
 
 if __name__ == "__main__":
-    mean = torch.randn(100000, 3, device="cuda")
-    query = torch.randn(100000, 3, device="cuda")
+    # python -m gaussiansplatting.knn: fixed-radius queries of a scene against a removed object,
+    # the pattern of GaussianModel.get_near_gaussians_by_mask
+    import time
+
+    from scipy.spatial import KDTree
+
+    device = "cuda" if torch.cuda.is_available() else "cpu"
+    for n in [1_000_000, 3_000_000, 10_000_000]:
+        torch.manual_seed(0)
+        scene = torch.rand(n, 3, device=device) * 10
+        object_xyz = scene[((scene - 5).norm(dim=1) < 1.5)]
+        query = scene[((scene - 5).abs() < 2).all(dim=1)]
+        timings = {}
+
+        t = time.perf_counter()
+        dist, _ = KDTree(object_xyz.cpu().numpy()).query(query.cpu().numpy(), k=1)
+        reference = torch.from_numpy(dist).to(device) <= 0.1
+        timings["scipy KDTree"] = time.perf_counter() - t
 
-    nn_dist, nn_idx = K_nearest_neighbors(mean, 10, query)
+        for backend in KNN_BACKENDS:
+            t = time.perf_counter()
+            index = build_knn_index(object_xyz, backend)
+            result = index.within_radius(query, 0.1)
+            timings[backend] = time.perf_counter() - t
+            assert torch.equal(result, reference), backend
+            t = time.perf_counter()
+            index.within_radius(query, 0.1)
+            timings[backend + " (reused)"] = time.perf_counter() - t
 
-    breakpoint()
+        print(
+            "{} points, {} object, {} queries: ".format(n, object_xyz.shape[0], query.shape[0])
+            + ", ".join("{} {:.2f}s".format(name, value) for name, value in timings.items())
+        )
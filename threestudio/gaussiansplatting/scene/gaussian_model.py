@@ -17,11 +17,13 @@ from gaussiansplatting.utils.general_utils import (
     inverse_sigmoid,
     get_expon_lr_func,
     build_rotation,
+    top_fraction_threshold,
 )
 from torch import nn
 import os
 from gaussiansplatting.utils.system_utils import mkdir_p
-from plyfile import PlyData, PlyElement
+from gaussiansplatting.utils.ply_utils import read_ply, write_ply
+from gaussiansplatting.utils.masked_adam import MaskedAdam
 from gaussiansplatting.utils.sh_utils import RGB2SH
 from simple_knn._C import distCUDA2
 from gaussiansplatting.utils.graphics_utils import BasicPointCloud
@@ -30,12 +32,27 @@ from gaussiansplatting.utils.general_utils import (
     build_scaling_rotation,
 )
 from gaussiansplatting.gaussian_renderer import camera2rasterizer
+from gaussiansplatting.scene.gaussian_storage import GaussianStorage
 
-from gaussiansplatting.knn import K_nearest_neighbors
+from gaussiansplatting.knn import build_knn_index
 
 # from threestudio.utils.typing import Bool, Tensor
 
 MAX_ANCHOR_WEIGHT = 10
+# capacity multiplier of the per-Gaussian buffers when densification outgrows them
+STORAGE_GROWTH = 1.5
+# above this many points the densification threshold comes from a histogram instead of an exact selection
+EXACT_SELECTION_MAX_POINTS = 1 << 24
+DENSIFY_SELECTION_BINS = 4096
+# anchored attributes and the anchor loss each one contributes to
+ANCHOR_LOSS_GROUPS = {
+    "_xyz": "loss_anchor_geo",
+    "_features_dc": "loss_anchor_color",
+    "_features_rest": "loss_anchor_color",
+    "_scaling": "loss_anchor_scale",
+    "_rotation": "loss_anchor_geo",
+    "_opacity": "loss_anchor_opacity",
+}
 
 
 class GaussianModel:
@@ -62,12 +79,14 @@ class GaussianModel:
             anchor_weight_init_g0: float,
             anchor_weight_init: float,
             anchor_weight_multiplier: float,
+            masked_optimizer: bool = False,
+            device="cuda",
     ):
         self.active_sh_degree = 0
         self.anchor_weight_init = anchor_weight_init
         self.anchor_weight_multiplier = anchor_weight_multiplier
         self._anchor_loss_schedule = torch.tensor(
-            [anchor_weight_init_g0], device="cuda"
+            [anchor_weight_init_g0], device=device
         )  # generation 0 begin from weight 0
         self.anchor_weight_init_g0 = anchor_weight_init_g0
         # self._anchor_loss_schedule[x] = y means weight y will be multiplied to the anchor loss of generation x
@@ -86,8 +105,21 @@ class GaussianModel:
         self.percent_dense = 0
         self.spatial_lr_scale = 0
         self.setup_functions()
-        self.anchor = {}
+        # anchors of the masked points only, as one (num_masked, num_attributes) matrix
+        self._anchor = None
+        self._anchor_index = None
+        self._anchor_size = 0
+        self._anchor_weights = None
+        self.mask = None
+        # step only the masked rows in the optimizer instead of masking gradients with hooks. Bit-identical while
+        # the mask is fixed; on a mask change, rows leaving the mask are frozen with their moments, whereas the
+        # hooks only zero their gradients and Adam momentum keeps moving them
+        self.masked_optimizer = masked_optimizer
+        self._grad_mask_index = None
+        self._mask_index = None
+        self._activations = {}
         self.localize = False
+        self._storage = GaussianStorage(STORAGE_GROWTH)
 
     def update_anchor_term(self, anchor_weight_init_g0: float,
                            anchor_weight_init: float,
@@ -97,42 +129,63 @@ class GaussianModel:
         self.anchor_weight_init = anchor_weight_init
         self.anchor_weight_multiplier = anchor_weight_multiplier
         self._anchor_loss_schedule = torch.tensor(
-            [anchor_weight_init_g0], device="cuda"
+            [anchor_weight_init_g0], device=self._anchor_loss_schedule.device
         )  # generation 0 begin from weight 0
         self.anchor_weight_init_g0 = anchor_weight_init_g0
+        self._anchor_weights = None
 
     def anchor_postfix(self):
         self._generation[...] = 0
         self._anchor_loss_schedule = torch.tensor(
-            [self.anchor_weight_init_g0], device="cuda"
+            [self.anchor_weight_init_g0], device=self._anchor_loss_schedule.device
         )  # generation 0 begin from weight 0
+        self._anchor_weights = None
+
+    @staticmethod
+    def _trimmed_copy(tensor):
+        # the live rows only, a view of a storage buffer would save and restore its spare capacity too
+        if isinstance(tensor, nn.Parameter):
+            return nn.Parameter(tensor.detach().clone(), requires_grad=tensor.requires_grad)
+        return tensor.clone() if torch.is_tensor(tensor) else tensor
 
     def capture(self):
+        opt_dict = self.optimizer.state_dict()
+        opt_dict["state"] = {
+            key: {name: self._trimmed_copy(value) for name, value in state.items()}
+            for key, state in opt_dict["state"].items()
+        }
         return (
             self.active_sh_degree,
-            self._xyz,
-            self._features_dc,
-            self._features_rest,
-            self._scaling,
-            self._rotation,
-            self._opacity,
-            self.max_radii2D,
-            self.xyz_gradient_accum,
-            self.denom,
-            self.optimizer.state_dict(),
+            self._trimmed_copy(self._xyz),
+            self._trimmed_copy(self._features_dc),
+            self._trimmed_copy(self._features_rest),
+            self._trimmed_copy(self._scaling),
+            self._trimmed_copy(self._rotation),
+            self._trimmed_copy(self._opacity),
+            self._trimmed_copy(self.max_radii2D),
+            self._trimmed_copy(self.xyz_gradient_accum),
+            self._trimmed_copy(self.denom),
+            opt_dict,
             self.spatial_lr_scale,
         )
 
-    def update_anchor(self):
-        self.anchor = dict(
-            _xyz=self._xyz.detach().clone(),
-            _features_dc=self._features_dc.detach().clone(),
-            _features_rest=self._features_rest.detach().clone(),
-            _scaling=self._scaling.detach().clone(),
-            _rotation=self._rotation.detach().clone(),
-            _opacity=self._opacity.detach().clone(),
+    def _gather_anchor_attributes(self, index):
+        return torch.cat(
+            [
+                getattr(self, key)[index].flatten(1)
+                for key in ANCHOR_LOSS_GROUPS
+            ],
+            dim=1,
         )
 
+    def update_anchor(self):
+        # points outside the mask are frozen by the grad mask, only the masked ones need an anchor
+        with torch.no_grad():
+            self._anchor_index = self.mask.nonzero()[:, 0]
+            self._anchor = self._gather_anchor_attributes(self._anchor_index)
+        self._anchor_size = self.mask.shape[0]
+        self._anchor_weights = None
+
     def update_anchor_loss_schedule(self):
         for generation_idx, weight in enumerate(self._anchor_loss_schedule):
             self._anchor_loss_schedule[generation_idx] = min(
@@ -145,8 +198,9 @@ class GaussianModel:
             # generation_0 begins with 1 anchor loss weight, generations after it begin with self.anchor_weight_init
             # the overall anchor loss can be modified through lambda_anchor_xxx
         self._anchor_loss_schedule = torch.cat(
-            [self._anchor_loss_schedule, torch.tensor([0], device="cuda")]
+            [self._anchor_loss_schedule, self._anchor_loss_schedule.new_zeros(1)]
         )  # firstborn generation won't be applied anchor loss
+        self._anchor_weights = None
 
     # anchor loss
     def anchor_loss(self):
@@ -156,31 +210,25 @@ class GaussianModel:
             "loss_anchor_opacity": 0,
             "loss_anchor_scale": 0,
         }
-
-        target_generation = self._generation[self.mask]
-        anchor_weight_list = torch.gather(
-            self._anchor_loss_schedule, dim=0, index=target_generation
-        )
-
-        for key, value in self.anchor.items():
-            delta = torch.nn.functional.mse_loss(
-                getattr(self, key)[self.mask], value[self.mask], reduction="none"
+        if self._anchor is None:
+            return out
+
+        if self._anchor_weights is None:
+            self._anchor_weights = self._anchor_loss_schedule[
+                self._generation[self._anchor_index]
+            ]
+
+        # every attribute in one weighted squared difference, then one sum per attribute column
+        delta = (self._gather_anchor_attributes(self._anchor_index) - self._anchor) ** 2
+        column_sums = (delta * self._anchor_weights[:, None]).sum(dim=0)
+
+        start = 0
+        for key, loss_name in ANCHOR_LOSS_GROUPS.items():
+            numel = getattr(self, key)[0].numel()
+            out[loss_name] += column_sums[start: start + numel].sum() / (
+                    numel * self._anchor_index.shape[0]
             )
-            if "feature" in key:
-                delta *= anchor_weight_list[:, None, None]
-            else:
-                delta *= anchor_weight_list[:, None]
-            delta = torch.mean(delta)
-            if key in ["_xyz", "_rotation"]:
-                out["loss_anchor_geo"] += delta
-            elif key in ["_features_dc", "_features_rest"]:
-                out["loss_anchor_color"] += delta
-            elif key in ["_opacity"]:
-                out["loss_anchor_opacity"] += delta
-            elif key == "_scaling":
-                out["loss_anchor_scale"] += delta
-            else:
-                raise
+            start += numel
         return out
 
     def restore(self, model_args, training_args):
@@ -218,19 +266,55 @@ class GaussianModel:
     def generation_num(self):
         return len(self._anchor_loss_schedule)
 
+    @property
+    def mask_index(self):
+        # indices of the masked Gaussians, recomputed only when the mask is replaced or modified in place
+        if (
+                self._mask_index is None
+                or self._mask_index[0] is not self.mask
+                or self._mask_index[1] != self.mask._version
+        ):
+            self._mask_index = (self.mask, self.mask._version, self.mask.nonzero()[:, 0])
+        return self._mask_index[2]
+
+    def _cached_activation(self, name, params, compute):
+        # Under no_grad (viewer, mask projection) activations are cached until one of `params` is replaced
+        # (prune, densify, load) or modified in place (optimizer step). With autograd they are recomputed on
+        # every forward: a cached graph would be freed by the first backward, which breaks gradient
+        # accumulation or a skipped optimizer step. Edits through param.data do not bump the version and need
+        # clear_activation_cache().
+        if self.localize or torch.is_grad_enabled():
+            return compute()
+        state = tuple((p, p._version, p.data_ptr()) for p in params)
+        entry = self._activations.get(name)
+        if entry is not None and len(entry[0]) == len(state) and all(
+                a[0] is b[0] and a[1:] == b[1:] for a, b in zip(entry[0], state)
+        ):
+            return entry[1]
+        value = compute()
+        self._activations[name] = (state, value)
+        return value
+
+    def clear_activation_cache(self):
+        self._activations = {}
+
     @property
     def get_scaling(self):
         if self.localize:
             return self.scaling_activation(self._scaling[self.mask])
         else:
-            return self.scaling_activation(self._scaling)
+            return self._cached_activation(
+                "scaling", (self._scaling,), lambda: self.scaling_activation(self._scaling)
+            )
 
     @property
     def get_rotation(self):
         if self.localize:
             return self.rotation_activation(self._rotation[self.mask])
         else:
-            return self.rotation_activation(self._rotation)
+            return self._cached_activation(
+                "rotation", (self._rotation,), lambda: self.rotation_activation(self._rotation)
+            )
 
     @property
     def get_xyz(self):
@@ -242,20 +326,24 @@ class GaussianModel:
     @property
     def get_features(self):
         if self.localize:
-            features_dc = self._features_dc[self.mask]
-            features_rest = self._features_rest[self.mask]
+            return torch.cat(
+                (self._features_dc[self.mask], self._features_rest[self.mask]), dim=1
+            )
         else:
-            features_dc = self._features_dc
-            features_rest = self._features_rest
-
-        return torch.cat((features_dc, features_rest), dim=1)
+            return self._cached_activation(
+                "features",
+                (self._features_dc, self._features_rest),
+                lambda: torch.cat((self._features_dc, self._features_rest), dim=1),
+            )
 
     @property
     def get_opacity(self):
         if self.localize:
             return self.opacity_activation(self._opacity[self.mask])
         else:
-            return self.opacity_activation(self._opacity)
+            return self._cached_activation(
+                "opacity", (self._opacity,), lambda: self.opacity_activation(self._opacity)
+            )
 
     def get_covariance(self, scaling_modifier=1):
         if self.localize:
@@ -263,8 +351,12 @@ class GaussianModel:
                 self.get_scaling[self.mask], scaling_modifier, self._rotation[self.mask]
             )
         else:
-            return self.covariance_activation(
-                self.get_scaling, scaling_modifier, self._rotation
+            return self._cached_activation(
+                ("covariance", scaling_modifier),
+                (self._scaling, self._rotation),
+                lambda: self.covariance_activation(
+                    self.get_scaling, scaling_modifier, self._rotation
+                ),
             )
 
     def oneupSHdegree(self):
@@ -335,8 +427,9 @@ class GaussianModel:
 
     def training_setup(self, training_args):
         self.percent_dense = training_args.percent_dense
-        self.xyz_gradient_accum = torch.zeros((self.get_xyz.shape[0], 1), device="cuda")
-        self.denom = torch.zeros((self.get_xyz.shape[0], 1), device="cuda")
+        self._storage.clear()
+        self.xyz_gradient_accum = torch.zeros((self.get_xyz.shape[0], 1), device=self._xyz.device)
+        self.denom = torch.zeros((self.get_xyz.shape[0], 1), device=self._xyz.device)
 
         l = [
             {
@@ -371,7 +464,8 @@ class GaussianModel:
             },
         ]
         self.params_list = l
-        self.optimizer = torch.optim.Adam(l, lr=0.0, eps=1e-15)
+        self.optimizer = MaskedAdam(l, lr=0.0, eps=1e-15)
+        self._set_optimizer_row_index(self._grad_mask_index)
         self.xyz_scheduler_args = get_expon_lr_func(
             lr_init=training_args.position_lr_init * self.spatial_lr_scale,
             lr_final=training_args.position_lr_final * self.spatial_lr_scale,
@@ -410,39 +504,22 @@ class GaussianModel:
     def save_ply(self, path):
         mkdir_p(os.path.dirname(path))
 
-        xyz = self._xyz.detach().cpu().numpy()
-        normals = np.zeros_like(xyz)
-        f_dc = (
-            self._features_dc.detach()
-            .transpose(1, 2)
-            .flatten(start_dim=1)
-            .contiguous()
-            .cpu()
-            .numpy()
-        )
-        f_rest = (
-            self._features_rest.detach()
-            .transpose(1, 2)
-            .flatten(start_dim=1)
-            .contiguous()
-            .cpu()
-            .numpy()
-        )
-        opacities = self._opacity.detach().cpu().numpy()
-        scale = self._scaling.detach().cpu().numpy()
-        rotation = self._rotation.detach().cpu().numpy()
-
-        dtype_full = [
-            (attribute, "f4") for attribute in self.construct_list_of_attributes()
-        ]
+        xyz = self._xyz.detach()
+        normals = torch.zeros_like(xyz)
+        f_dc = self._features_dc.detach().transpose(1, 2).flatten(start_dim=1)
+        f_rest = self._features_rest.detach().transpose(1, 2).flatten(start_dim=1)
+        opacities = self._opacity.detach()
+        scale = self._scaling.detach()
+        rotation = self._rotation.detach()
 
-        elements = np.empty(xyz.shape[0], dtype=dtype_full)
-        attributes = np.concatenate(
-            (xyz, normals, f_dc, f_rest, opacities, scale, rotation), axis=1
+        attributes = torch.cat(
+            (xyz, normals, f_dc, f_rest, opacities, scale, rotation), dim=1
+        )
+        write_ply(
+            path,
+            self.construct_list_of_attributes(),
+            attributes.float().cpu().numpy(),
         )
-        elements[:] = list(map(tuple, attributes))
-        el = PlyElement.describe(elements, "vertex")
-        PlyData([el]).write(path)
 
     def reset_opacity(self):
         opacities_new = inverse_sigmoid(
@@ -452,97 +529,67 @@ class GaussianModel:
         self._opacity = optimizable_tensors["opacity"]
 
     # load ply
-    def load_ply(self, path):
-        plydata = PlyData.read(path)
+    def load_ply(self, path, device="cuda", pin_memory=False):
+        # the vertex block is memory-mapped and every attribute is gathered in one float32 copy,
+        # optionally staged through pinned memory before moving it to `device`
+        names, attributes = read_ply(path)
+        columns = {name: idx for idx, name in enumerate(names)}
+
+        def sorted_names(prefix):
+            return sorted(
+                [name for name in names if name.startswith(prefix)],
+                key=lambda x: int(x.split("_")[-1]),
+            )
 
-        xyz = np.stack(
-            (
-                np.asarray(plydata.elements[0]["x"]),
-                np.asarray(plydata.elements[0]["y"]),
-                np.asarray(plydata.elements[0]["z"]),
-            ),
-            axis=1,
-        )
-        opacities = np.asarray(plydata.elements[0]["opacity"])[..., np.newaxis]
-
-        features_dc = np.zeros((xyz.shape[0], 3, 1))
-        features_dc[:, 0, 0] = np.asarray(plydata.elements[0]["f_dc_0"])
-        features_dc[:, 1, 0] = np.asarray(plydata.elements[0]["f_dc_1"])
-        features_dc[:, 2, 0] = np.asarray(plydata.elements[0]["f_dc_2"])
-
-        extra_f_names = [
-            p.name
-            for p in plydata.elements[0].properties
-            if p.name.startswith("f_rest_")
-        ]
-        extra_f_names = sorted(extra_f_names, key=lambda x: int(x.split("_")[-1]))
+        extra_f_names = sorted_names("f_rest_")
+        scale_names = sorted_names("scale_")
+        rot_names = sorted_names("rot")
         # assert len(extra_f_names)==3*(self.max_sh_degree + 1) ** 2 - 3
         self.max_sh_degree = int(((len(extra_f_names) + 3) / 3) ** 0.5 - 1)
-        features_extra = np.zeros((xyz.shape[0], len(extra_f_names)))
-        for idx, attr_name in enumerate(extra_f_names):
-            features_extra[:, idx] = np.asarray(plydata.elements[0][attr_name])
+
+        order = (
+            ["x", "y", "z", "f_dc_0", "f_dc_1", "f_dc_2"]
+            + extra_f_names
+            + ["opacity"]
+            + scale_names
+            + rot_names
+        )
+        gathered = torch.from_numpy(attributes[:, [columns[name] for name in order]])
+        if pin_memory:
+            gathered = gathered.pin_memory()
+        gathered = gathered.to(device, non_blocking=pin_memory)
+        xyz, features_dc, features_extra, opacities, scales, rots = gathered.split(
+            [3, 3, len(extra_f_names), 1, len(scale_names), len(rot_names)], dim=1
+        )
         # Reshape (P,F*SH_coeffs) to (P, F, SH_coeffs except DC)
+        features_dc = features_dc.reshape(-1, 3, 1)
         features_extra = features_extra.reshape(
-            (features_extra.shape[0], 3, (self.max_sh_degree + 1) ** 2 - 1)
+            -1, 3, (self.max_sh_degree + 1) ** 2 - 1
         )
 
-        scale_names = [
-            p.name
-            for p in plydata.elements[0].properties
-            if p.name.startswith("scale_")
-        ]
-        scale_names = sorted(scale_names, key=lambda x: int(x.split("_")[-1]))
-        scales = np.zeros((xyz.shape[0], len(scale_names)))
-        for idx, attr_name in enumerate(scale_names):
-            scales[:, idx] = np.asarray(plydata.elements[0][attr_name])
-
-        rot_names = [
-            p.name for p in plydata.elements[0].properties if p.name.startswith("rot")
-        ]
-        rot_names = sorted(rot_names, key=lambda x: int(x.split("_")[-1]))
-        rots = np.zeros((xyz.shape[0], len(rot_names)))
-        for idx, attr_name in enumerate(rot_names):
-            rots[:, idx] = np.asarray(plydata.elements[0][attr_name])
-
-        self._xyz = nn.Parameter(
-            torch.tensor(xyz, dtype=torch.float, device="cuda").requires_grad_(True)
-        )
+        self._xyz = nn.Parameter(xyz.contiguous().requires_grad_(True))
         self._features_dc = nn.Parameter(
-            torch.tensor(features_dc, dtype=torch.float, device="cuda")
-            .transpose(1, 2)
-            .contiguous()
-            .requires_grad_(True)
+            features_dc.transpose(1, 2).contiguous().requires_grad_(True)
         )
         self._features_rest = nn.Parameter(
-            torch.tensor(features_extra, dtype=torch.float, device="cuda")
-            .transpose(1, 2)
-            .contiguous()
-            .requires_grad_(True)
-        )
-        self._opacity = nn.Parameter(
-            torch.tensor(opacities, dtype=torch.float, device="cuda").requires_grad_(
-                True
-            )
-        )
-        self._scaling = nn.Parameter(
-            torch.tensor(scales, dtype=torch.float, device="cuda").requires_grad_(True)
-        )
-        self._rotation = nn.Parameter(
-            torch.tensor(rots, dtype=torch.float, device="cuda").requires_grad_(True)
+            features_extra.transpose(1, 2).contiguous().requires_grad_(True)
         )
+        self._opacity = nn.Parameter(opacities.contiguous().requires_grad_(True))
+        self._scaling = nn.Parameter(scales.contiguous().requires_grad_(True))
+        self._rotation = nn.Parameter(rots.contiguous().requires_grad_(True))
 
         self.active_sh_degree = self.max_sh_degree
         self._generation = torch.zeros(
             self._opacity.shape[0],
             dtype=torch.int64,
-            device="cuda",
+            device=device,
             requires_grad=False,
         )  # generation list, begin from zero
         self.set_mask(
             torch.ones(
                 self._opacity.shape[0],
                 dtype=torch.bool,
-                device="cuda",
+                device=device,
                 requires_grad=False,
             )
         )
@@ -565,31 +612,34 @@ class GaussianModel:
                 optimizable_tensors[group["name"]] = group["params"][0]
         return optimizable_tensors
 
-    def _prune_optimizer(self, mask):
+    def _prune_optimizer(self, keep_index):
         optimizable_tensors = {}
         for group in self.optimizer.param_groups:
+            name = group["name"]
             stored_state = self.optimizer.state.get(group["params"][0], None)
+            param = self._storage.compact(name, group["params"][0], keep_index)
             if stored_state is not None:
-                stored_state["exp_avg"] = stored_state["exp_avg"][mask]
-                stored_state["exp_avg_sq"] = stored_state["exp_avg_sq"][mask]
+                stored_state["exp_avg"] = self._storage.compact(
+                    name + ".exp_avg", stored_state["exp_avg"], keep_index
+                )
+                stored_state["exp_avg_sq"] = self._storage.compact(
+                    name + ".exp_avg_sq", stored_state["exp_avg_sq"], keep_index
+                )
 
                 del self.optimizer.state[group["params"][0]]
-                group["params"][0] = nn.Parameter(
-                    (group["params"][0][mask].requires_grad_(True))
-                )
+                group["params"][0] = nn.Parameter(param.requires_grad_(True))
                 self.optimizer.state[group["params"][0]] = stored_state
 
-                optimizable_tensors[group["name"]] = group["params"][0]
+                optimizable_tensors[name] = group["params"][0]
             else:
-                group["params"][0] = nn.Parameter(
-                    group["params"][0][mask].requires_grad_(True)
-                )
-                optimizable_tensors[group["name"]] = group["params"][0]
+                group["params"][0] = nn.Parameter(param.requires_grad_(True))
+                optimizable_tensors[name] = group["params"][0]
         return optimizable_tensors
 
     def prune_points(self, mask):
-        valid_points_mask = ~mask
-        optimizable_tensors = self._prune_optimizer(valid_points_mask)
+        # compacted in place, the kept rows are gathered once for every tensor
+        keep_index = (~mask).nonzero()[:, 0]
+        optimizable_tensors = self._prune_optimizer(keep_index)
 
         self._xyz = optimizable_tensors["xyz"]
         self._features_dc = optimizable_tensors["f_dc"]
@@ -598,45 +648,48 @@ class GaussianModel:
         self._scaling = optimizable_tensors["scaling"]
         self._rotation = optimizable_tensors["rotation"]
 
-        self.xyz_gradient_accum = self.xyz_gradient_accum[valid_points_mask]
+        self.xyz_gradient_accum = self._storage.compact(
+            "xyz_gradient_accum", self.xyz_gradient_accum, keep_index
+        )
 
-        self.denom = self.denom[valid_points_mask]
-        self.max_radii2D = self.max_radii2D[valid_points_mask]
+        self.denom = self._storage.compact("denom", self.denom, keep_index)
+        self.max_radii2D = self._storage.compact(
+            "max_radii2D", self.max_radii2D, keep_index
+        )
 
-        self.mask = self.mask[valid_points_mask]
-        self._generation = self._generation[valid_points_mask]
+        self.mask = self._storage.compact("mask", self.mask, keep_index)
+        self._generation = self._storage.compact(
+            "_generation", self._generation, keep_index
+        )
 
     def cat_tensors_to_optimizer(self, tensors_dict):
+        # appended into the spare capacity of the storage buffers, see GaussianStorage
         optimizable_tensors = {}
         for group in self.optimizer.param_groups:
             assert len(group["params"]) == 1
-            extension_tensor = tensors_dict[group["name"]]
+            name = group["name"]
+            extension_tensor = tensors_dict[name]
             stored_state = self.optimizer.state.get(group["params"][0], None)
+            param = self._storage.append(name, group["params"][0], extension_tensor)
             if stored_state is not None:
-                stored_state["exp_avg"] = torch.cat(
-                    (stored_state["exp_avg"], torch.zeros_like(extension_tensor)), dim=0
+                n = stored_state["exp_avg"].shape[0]
+                stored_state["exp_avg"] = self._storage.resize(
+                    name + ".exp_avg", stored_state["exp_avg"], param.shape[0]
                 )
-                stored_state["exp_avg_sq"] = torch.cat(
-                    (stored_state["exp_avg_sq"], torch.zeros_like(extension_tensor)),
-                    dim=0,
+                stored_state["exp_avg"][n:] = 0
+                stored_state["exp_avg_sq"] = self._storage.resize(
+                    name + ".exp_avg_sq", stored_state["exp_avg_sq"], param.shape[0]
                 )
+                stored_state["exp_avg_sq"][n:] = 0
 
                 del self.optimizer.state[group["params"][0]]
-                group["params"][0] = nn.Parameter(
-                    torch.cat(
-                        (group["params"][0], extension_tensor), dim=0
-                    ).requires_grad_(True)
-                )
+                group["params"][0] = nn.Parameter(param.requires_grad_(True))
                 self.optimizer.state[group["params"][0]] = stored_state
 
-                optimizable_tensors[group["name"]] = group["params"][0]
+                optimizable_tensors[name] = group["params"][0]
             else:
-                group["params"][0] = nn.Parameter(
-                    torch.cat(
-                        (group["params"][0], extension_tensor), dim=0
-                    ).requires_grad_(True)
-                )
-                optimizable_tensors[group["name"]] = group["params"][0]
+                group["params"][0] = nn.Parameter(param.requires_grad_(True))
+                optimizable_tensors[name] = group["params"][0]
 
         return optimizable_tensors
 
@@ -666,14 +719,19 @@ class GaussianModel:
         self._scaling = optimizable_tensors["scaling"]
         self._rotation = optimizable_tensors["rotation"]
 
-        self.xyz_gradient_accum = torch.zeros((self.get_xyz.shape[0], 1), device="cuda")
-        self.denom = torch.zeros((self.get_xyz.shape[0], 1), device="cuda")
-        self.max_radii2D = torch.zeros((self.get_xyz.shape[0]), device="cuda")
+        n_points = self.get_xyz.shape[0]
+        self.xyz_gradient_accum = self._storage.resize(
+            "xyz_gradient_accum", self.xyz_gradient_accum, n_points
+        ).zero_()
+        self.denom = self._storage.resize("denom", self.denom, n_points).zero_()
+        self.max_radii2D = self._storage.resize(
+            "max_radii2D", self.max_radii2D, n_points
+        ).zero_()
 
     def densify_and_split(self, grads, grad_threshold, scene_extent, N=2):
         n_init_points = self.get_xyz.shape[0]
         # Extract points that satisfy the gradient condition
-        padded_grad = torch.zeros((n_init_points), device="cuda")
+        padded_grad = torch.zeros((n_init_points), device=self._xyz.device)
         padded_grad[: grads.shape[0]] = grads.squeeze()
         selected_pts_mask = torch.where(padded_grad >= grad_threshold, True, False)
         selected_pts_mask = torch.logical_and(
@@ -683,7 +741,7 @@ class GaussianModel:
         )
 
         stds = self.get_scaling[selected_pts_mask].repeat(N, 1)
-        means = torch.zeros((stds.size(0), 3), device="cuda")
+        means = torch.zeros((stds.size(0), 3), device=self._xyz.device)
         samples = torch.normal(mean=means, std=stds)
         rots = build_rotation(self._rotation[selected_pts_mask]).repeat(N, 1, 1)
         new_xyz = torch.bmm(rots, samples.unsqueeze(-1)).squeeze(-1) + self.get_xyz[
@@ -707,20 +765,22 @@ class GaussianModel:
         )
 
         new_mask = torch.cat([self.mask[selected_pts_mask]] * N, dim=0)
-        self.mask = torch.cat([self.mask, new_mask], dim=0)
+        self.mask = self._storage.append("mask", self.mask, new_mask)
 
         new_generation = torch.zeros_like(
             selected_pts_mask.nonzero()[:, 0], dtype=torch.int64
         )
         new_generation[:] = self.generation_num
         new_generation = torch.cat([new_generation] * N, dim=0)
-        self._generation = torch.cat([self._generation, new_generation])
+        self._generation = self._storage.append(
+            "_generation", self._generation, new_generation
+        )
         assert self._generation.shape == self.mask.shape
 
         prune_filter = torch.cat(
             (
                 selected_pts_mask,
-                torch.zeros(N * selected_pts_mask.sum(), device="cuda", dtype=bool),
+                torch.zeros(N * selected_pts_mask.sum(), device=self._xyz.device, dtype=bool),
             )
         )
 
@@ -757,42 +817,129 @@ class GaussianModel:
                 len(torch.nonzero(self.mask[selected_pts_mask] == 0)) == 0
         ), "nontarget area should not be densified"
         # selected_pts_mask [points_num,]
-        self.mask = torch.cat([self.mask, self.mask[selected_pts_mask]], dim=0)
+        self.mask = self._storage.append("mask", self.mask, self.mask[selected_pts_mask])
         new_generation = torch.zeros_like(
             selected_pts_mask.nonzero()[:, 0], dtype=torch.int64
         )
         new_generation[:] = self.generation_num
-        self._generation = torch.cat([self._generation, new_generation])
+        self._generation = self._storage.append(
+            "_generation", self._generation, new_generation
+        )
         # firstborn generation won't be applied anchor loss
 
+    def densify_clone_split_and_prune(
+            self, grads, grad_threshold, min_opacity, scene_extent, max_screen_size, N=2
+    ):
+        # Same result as densify_and_clone, densify_and_split and then pruning, but every mask is computed
+        # against the current points: the kept points are compacted once and the clones and split children
+        # are appended once, instead of rebuilding every tensor four times.
+        # Returns the point counts after cloning and after splitting, as the sequential path would see them.
+        selected_pts_mask = torch.norm(grads, dim=-1) >= grad_threshold
+        large_pts_mask = (
+            torch.max(self.get_scaling, dim=1).values
+            > self.percent_dense * scene_extent
+        )
+        clone_mask = torch.logical_and(selected_pts_mask, ~large_pts_mask)
+        split_mask = torch.logical_and(selected_pts_mask, large_pts_mask)
+        assert (
+                len(torch.nonzero(self.mask[clone_mask] == 0)) == 0
+        ), "nontarget area should not be densified"
+
+        stds = self.get_scaling[split_mask].repeat(N, 1)
+        means = torch.zeros((stds.size(0), 3), device=self._xyz.device)
+        samples = torch.normal(mean=means, std=stds)
+        rots = build_rotation(self._rotation[split_mask]).repeat(N, 1, 1)
+        split_xyz = torch.bmm(rots, samples.unsqueeze(-1)).squeeze(-1) + self.get_xyz[
+            split_mask
+        ].repeat(N, 1)
+        split_scaling = self.scaling_inverse_activation(
+            self.get_scaling[split_mask].repeat(N, 1) / (0.8 * N)
+        )
+
+        new_xyz = torch.cat((self._xyz[clone_mask], split_xyz))
+        new_features_dc = torch.cat(
+            (
+                self._features_dc[clone_mask],
+                self._features_dc[split_mask].repeat(N, 1, 1),
+            )
+        )
+        new_features_rest = torch.cat(
+            (
+                self._features_rest[clone_mask],
+                self._features_rest[split_mask].repeat(N, 1, 1),
+            )
+        )
+        new_opacity = torch.cat(
+            (self._opacity[clone_mask], self._opacity[split_mask].repeat(N, 1))
+        )
+        new_scaling = torch.cat((self._scaling[clone_mask], split_scaling))
+        new_rotation = torch.cat(
+            (self._rotation[clone_mask], self._rotation[split_mask].repeat(N, 1))
+        )
+        new_mask = torch.cat((self.mask[clone_mask], self.mask[split_mask].repeat(N)))
+
+        def prune_filter(opacity, scaling, mask):
+            prune_mask = self.opacity_activation(opacity)[:, 0] < min_opacity
+            if max_screen_size:
+                # densification resets max_radii2D before the prune, so the screen space test never fires
+                big_points_ws = (
+                    self.scaling_activation(scaling).max(dim=1).values
+                    > 0.1 * scene_extent
+                )
+                prune_mask = torch.logical_or(prune_mask, big_points_ws)
+            return torch.logical_and(prune_mask, mask)
+
+        prune_mask = torch.logical_or(
+            split_mask, prune_filter(self._opacity, self._scaling, self.mask)
+        )
+        keep_new = ~prune_filter(new_opacity, new_scaling, new_mask)
+
+        n_points = self.get_xyz.shape[0]
+        n_split = stds.shape[0] // N
+        n_clone = new_xyz.shape[0] - N * n_split
+
+        self.prune_points(prune_mask)
+        self.densification_postfix(
+            new_xyz[keep_new],
+            new_features_dc[keep_new],
+            new_features_rest[keep_new],
+            new_opacity[keep_new],
+            new_scaling[keep_new],
+            new_rotation[keep_new],
+        )
+        new_mask = new_mask[keep_new]
+        self.mask = self._storage.append("mask", self.mask, new_mask)
+        new_generation = torch.full_like(
+            new_mask, self.generation_num, dtype=self._generation.dtype
+        )
+        self._generation = self._storage.append(
+            "_generation", self._generation, new_generation
+        )
+        assert self._generation.shape == self.mask.shape
+
+        return n_points + n_clone, n_points + n_clone + (N - 1) * n_split
+
     def densify_and_prune(
             self, max_grad, max_densify_percent, min_opacity, extent, max_screen_size
     ):
         grads = self.xyz_gradient_accum / self.denom
-        grads[grads.isnan()] = 0.0
-        grads[~self.mask] = 0.0  # the hook didn't set grads to zero here. Bug fixed
+        grads.masked_fill_(grads.isnan(), 0.0)
+        grads.masked_fill_(~self.mask[:, None], 0.0)  # the hook didn't set grads to zero here. Bug fixed
         if max_densify_percent < 1:
-            valid_percent = len(grads.nonzero()) * max_densify_percent / grads.shape[0]
-            thresold_value = torch.quantile(grads, 1 - valid_percent)
-            grads[grads < thresold_value] = 0.0
+            thresold_value = top_fraction_threshold(
+                grads,
+                max_densify_percent,
+                histogram_bins=DENSIFY_SELECTION_BINS
+                if grads.shape[0] > EXACT_SELECTION_MAX_POINTS
+                else 0,
+            )
+            grads.masked_fill_(grads < thresold_value, 0.0)
         # grads
 
         before = self.get_xyz.shape[0]
-        self.densify_and_clone(grads, max_grad, extent)
-        clone = self.get_xyz.shape[0]
-
-        self.densify_and_split(grads, max_grad, extent)
-        split = self.get_xyz.shape[0]
-
-        prune_mask = (self.get_opacity < min_opacity).squeeze()
-        if max_screen_size:
-            big_points_vs = self.max_radii2D > max_screen_size
-            big_points_ws = self.get_scaling.max(dim=1).values > 0.1 * extent
-            prune_mask = torch.logical_or(
-                torch.logical_or(prune_mask, big_points_vs), big_points_ws
-            )
-        prune_mask = torch.logical_and(prune_mask, self.mask)  # fix bug
-        self.prune_points(prune_mask)
+        clone, split = self.densify_clone_split_and_prune(
+            grads, max_grad, min_opacity, extent, max_screen_size
+        )
         prune = self.get_xyz.shape[0]
         assert self._generation.shape == self.mask.shape
 
@@ -831,12 +978,63 @@ class GaussianModel:
             image_weights,
         )
 
+    @torch.no_grad()
+    def apply_weights_batch(self, cameras, weights, weights_cnt, image_weights):
+        # apply_weights for each camera and its (1, H, W) slice of image_weights, the activations are read once
+        background = torch.tensor([0.0, 0.0, 0.0], dtype=torch.float32, device="cuda")
+        xyz, opacity = self.get_xyz, self.get_opacity
+        scaling, rotation = self.get_scaling, self.get_rotation
+        for camera, camera_weights in zip(cameras, image_weights):
+            camera2rasterizer(camera, background).apply_weights(
+                xyz,
+                None,
+                opacity,
+                None,
+                weights,
+                scaling,
+                rotation,
+                None,
+                weights_cnt,
+                camera_weights,
+            )
+
     def set_mask(self, mask):
+        if mask is self.mask:
+            return
         self.mask = mask
+        if self.masked_optimizer and hasattr(self, "hooks"):
+            # the gradient hooks read self.mask, keep the optimizer rows in sync the same way
+            self.apply_grad_mask(mask)
+        if self._anchor is None or self._anchor_size != mask.shape[0]:
+            return
+        # Points that stay masked keep their anchor. Newly masked points are anchored at their current values,
+        # not at the update_anchor snapshot the full-size anchors used to hold: they were outside the mask
+        # since, so only Adam momentum and the unhooked _rotation can have moved them, and keeping a snapshot of
+        # every point for this case would cost the memory the masked anchors save.
+        with torch.no_grad():
+            index = mask.nonzero()[:, 0]
+            anchor = self._gather_anchor_attributes(index)
+            position = torch.full_like(mask, -1, dtype=torch.int64)
+            position[self._anchor_index] = torch.arange(
+                self._anchor_index.shape[0], device=position.device
+            )
+            position = position[index]
+            kept = position >= 0
+            anchor[kept] = self._anchor[position[kept]]
+        self._anchor_index = index
+        self._anchor = anchor
+        self._anchor_weights = None
 
     def apply_grad_mask(self, mask):
         assert self.mask.shape[0] == self._xyz.shape[0]
         self.set_mask(mask)
+        self.hooks = []
+
+        if self.masked_optimizer:
+            index = self.mask.nonzero()[:, 0]
+            self._grad_mask_index = index if index.shape[0] < self.mask.shape[0] else None
+            self._set_optimizer_row_index(self._grad_mask_index)
+            return
 
         def hook(grad):
             final_grad = grad * (
@@ -848,8 +1046,6 @@ class GaussianModel:
 
         fields = ["_xyz", "_features_dc", "_features_rest", "_opacity", "_scaling"]
 
-        self.hooks = []
-
         for field in fields:
             this_field = getattr(self, field)
             assert this_field.is_leaf and this_field.requires_grad
@@ -861,10 +1057,23 @@ class GaussianModel:
             hook.remove()
 
         del self.hooks
+        self._grad_mask_index = None
+        self._set_optimizer_row_index(None)
+
+    def _set_optimizer_row_index(self, index):
+        # the same parameters as the gradient hooks, rotation is never masked
+        if self.optimizer is None:
+            return
+        for group in self.optimizer.param_groups:
+            if group["name"] in ["xyz", "f_dc", "f_rest", "opacity", "scaling"]:
+                group["row_index"] = index
 
     def get_near_gaussians_by_mask(
-            self, mask, dist_thresh: float = 0.1
+            self, mask, dist_thresh: float = 0.1, knn_backend: str = None
     ):
+        # the voxel grid stays on the GPU, a host kd-tree is cheaper to build when the points are on the CPU
+        if knn_backend is None:
+            knn_backend = "voxel" if self._xyz.is_cuda else "kdtree"
         mask = mask.squeeze()
         object_xyz = self._xyz[mask]
         remaining_xyz = self._xyz[~mask]
@@ -883,11 +1092,9 @@ class GaussianModel:
                   (remaining_xyz[:, 2] >= bbox_3D[4]) & (remaining_xyz[:, 2] <= bbox_3D[5])
         in_box_remaining_xyz = remaining_xyz[in_bbox]
 
-        _, _, nn_dist = K_nearest_neighbors(
-            object_xyz, 1, query=in_box_remaining_xyz, return_dist=True
+        valid_mask = build_knn_index(object_xyz, knn_backend).within_radius(
+            in_box_remaining_xyz, dist_thresh
         )
-        nn_dist = nn_dist.squeeze()
-        valid_mask = (nn_dist <= dist_thresh)
 
         mask_to_update = torch.zeros_like(remaining_xyz[:, 0], dtype=torch.bool)
         true_indices = torch.nonzero(in_bbox)
@@ -921,3 +1128,120 @@ class GaussianModel:
         self._generation = torch.cat([self._generation, torch.zeros_like(new_opacities[:, 0], dtype=torch.int64)],
                                      dim=0)
         self.update_anchor()
+
+
+if __name__ == "__main__":
+    # python -m gaussiansplatting.scene.gaussian_model: densify_clone_split_and_prune against the
+    # densify_and_clone -> densify_and_split -> prune sequence it replaces, on the CPU with a fixed seed
+    from types import SimpleNamespace
+
+    training_args = SimpleNamespace(
+        percent_dense=0.01,
+        position_lr_init=1e-3,
+        position_lr_final=1e-5,
+        position_lr_delay_mult=0.01,
+        position_lr_max_steps=100,
+        feature_lr=1e-2,
+        opacity_lr=1e-2,
+        scaling_lr=1e-2,
+        rotation_lr=1e-3,
+    )
+
+    def build(n):
+        torch.manual_seed(0)
+        model = GaussianModel(0, 1.0, 0.5, 2.0, device="cpu")
+        model._xyz = nn.Parameter(torch.randn(n, 3))
+        model._features_dc = nn.Parameter(torch.randn(n, 1, 3))
+        model._features_rest = nn.Parameter(torch.randn(n, 15, 3))
+        model._opacity = nn.Parameter(torch.randn(n, 1) - 2)
+        model._scaling = nn.Parameter(torch.randn(n, 3) * 0.5 - 4)
+        model._rotation = nn.Parameter(torch.randn(n, 4))
+        model.max_radii2D = torch.zeros(n)
+        model._generation = torch.zeros(n, dtype=torch.int64)
+        model.spatial_lr_scale = 1.0
+        model.training_setup(training_args)
+        model.set_mask(torch.rand(n) < 0.8)
+        model.apply_grad_mask(model.mask)
+        model.update_anchor()
+        return model
+
+    def train_steps(model, seed, steps=2):
+        generator = torch.Generator().manual_seed(seed)
+        for _ in range(steps):
+            model.optimizer.zero_grad(set_to_none=True)
+            anchor_loss = sum(value for value in model.anchor_loss().values())
+            loss = (
+                (model.get_xyz ** 2).sum()
+                + model.get_opacity.sum()
+                + model.get_scaling.sum()
+                + model.get_features.sum()
+                + model.get_rotation.sum()
+                + anchor_loss
+            )
+            loss.backward()
+            model.optimizer.step()
+            n = model.get_xyz.shape[0]
+            model.xyz_gradient_accum += torch.rand(n, 1, generator=generator) * 0.02
+            model.denom += 1
+            model.max_radii2D[:] = torch.rand(n, generator=generator) * 30
+
+    def sequential_densify_and_prune(model, max_grad, min_opacity, extent, max_screen_size):
+        # densify_and_prune before the fused pass
+        grads = model.xyz_gradient_accum / model.denom
+        grads[grads.isnan()] = 0.0
+        grads[~model.mask] = 0.0
+        model.densify_and_clone(grads, max_grad, extent)
+        model.densify_and_split(grads, max_grad, extent)
+        prune_mask = (model.get_opacity < min_opacity).squeeze()
+        if max_screen_size:
+            big_points_vs = model.max_radii2D > max_screen_size
+            big_points_ws = model.get_scaling.max(dim=1).values > 0.1 * extent
+            prune_mask = torch.logical_or(torch.logical_or(prune_mask, big_points_vs), big_points_ws)
+        prune_mask = torch.logical_and(prune_mask, model.mask)
+        model.prune_points(prune_mask)
+        model.remove_grad_mask()
+        model.apply_grad_mask(model.mask)
+        model.update_anchor()
+        model.update_anchor_loss_schedule()
+
+    fused, sequential = build(20_000), build(20_000)
+    for densify_round in range(5):
+        train_steps(fused, densify_round)
+        train_steps(sequential, densify_round)
+        torch.manual_seed(densify_round)
+        fused.densify_and_prune(0.01, 1.0, 0.05, 1.0, 20)
+        torch.manual_seed(densify_round)
+        sequential_densify_and_prune(sequential, 0.01, 0.05, 1.0, 20)
+
+        for name in [
+            "_xyz", "_features_dc", "_features_rest", "_opacity", "_scaling", "_rotation",
+            "xyz_gradient_accum", "denom", "max_radii2D", "_generation", "mask",
+            "_anchor", "_anchor_index", "_anchor_loss_schedule",
+        ]:
+            assert torch.equal(getattr(fused, name), getattr(sequential, name)), (densify_round, name)
+        for group, sequential_group in zip(fused.optimizer.param_groups, sequential.optimizer.param_groups):
+            state = fused.optimizer.state[group["params"][0]]
+            sequential_state = sequential.optimizer.state[sequential_group["params"][0]]
+            for key in ["step", "exp_avg", "exp_avg_sq"]:
+                assert torch.equal(state[key], sequential_state[key]), (densify_round, group["name"], key)
+        assert fused.anchor_loss() == sequential.anchor_loss(), densify_round
+    print("densify_clone_split_and_prune matches the sequential path over 5 rounds")
+
+    # anchor memory follows the number of masked points, not the number of points
+    num_attributes = 3 + 3 + 45 + 3 + 4 + 1
+    for n in [20_000, 100_000]:
+        model = build(n)
+        for num_masked in [1_000, 4_000]:
+            mask = torch.zeros(n, dtype=torch.bool)
+            mask[torch.randperm(n)[:num_masked]] = True
+            model.set_mask(mask)
+            model.update_anchor()
+            anchor_bytes = model._anchor.numel() * model._anchor.element_size()
+            assert anchor_bytes == num_masked * num_attributes * 4, (n, num_masked, anchor_bytes)
+            # a larger mask keeps the anchors of the points already masked and only adds the new rows
+            grown = mask | (torch.rand(n) < 0.01)
+            kept_anchor = model._anchor.clone()
+            model.set_mask(grown)
+            assert model._anchor.shape[0] == int(grown.sum())
+            assert torch.equal(model._anchor[mask[grown]], kept_anchor)
+    print("anchors hold num_masked x {} values, independent of the number of points".format(num_attributes))
@@ -21,7 +21,7 @@ from gaussiansplatting.utils.general_utils import (
 from torch import nn
 import os
 from gaussiansplatting.utils.system_utils import mkdir_p
-from plyfile import PlyData, PlyElement
+from gaussiansplatting.utils.ply_utils import read_ply, write_ply
 from gaussiansplatting.utils.sh_utils import RGB2SH
 from simple_knn._C import distCUDA2
 from gaussiansplatting.utils.graphics_utils import BasicPointCloud
@@ -390,39 +390,22 @@ class GaussianModel:
     def save_ply(self, path):
         mkdir_p(os.path.dirname(path))
 
-        xyz = self._xyz.detach().cpu().numpy()
-        normals = np.zeros_like(xyz)
-        f_dc = (
-            self._features_dc.detach()
-            .transpose(1, 2)
-            .flatten(start_dim=1)
-            .contiguous()
-            .cpu()
-            .numpy()
-        )
-        f_rest = (
-            self._features_rest.detach()
-            .transpose(1, 2)
-            .flatten(start_dim=1)
-            .contiguous()
-            .cpu()
-            .numpy()
-        )
-        opacities = self._opacity.detach().cpu().numpy()
-        scale = self._scaling.detach().cpu().numpy()
-        rotation = self._rotation.detach().cpu().numpy()
-
-        dtype_full = [
-            (attribute, "f4") for attribute in self.construct_list_of_attributes()
-        ]
+        xyz = self._xyz.detach()
+        normals = torch.zeros_like(xyz)
+        f_dc = self._features_dc.detach().transpose(1, 2).flatten(start_dim=1)
+        f_rest = self._features_rest.detach().transpose(1, 2).flatten(start_dim=1)
+        opacities = self._opacity.detach()
+        scale = self._scaling.detach()
+        rotation = self._rotation.detach()
 
-        elements = np.empty(xyz.shape[0], dtype=dtype_full)
-        attributes = np.concatenate(
-            (xyz, normals, f_dc, f_rest, opacities, scale, rotation), axis=1
+        attributes = torch.cat(
+            (xyz, normals, f_dc, f_rest, opacities, scale, rotation), dim=1
+        )
+        write_ply(
+            path,
+            self.construct_list_of_attributes(),
+            attributes.float().cpu().numpy(),
         )
-        elements[:] = list(map(tuple, attributes))
-        el = PlyElement.describe(elements, "vertex")
-        PlyData([el]).write(path)
 
     def reset_opacity(self):
         opacities_new = inverse_sigmoid(
@@ -432,97 +415,67 @@ class GaussianModel:
         self._opacity = optimizable_tensors["opacity"]
 
     # load ply
-    def load_ply(self, path):
-        plydata = PlyData.read(path)
+    def load_ply(self, path, device="cuda", pin_memory=False):
+        # the vertex block is memory-mapped and every attribute is gathered in one float32 copy,
+        # optionally staged through pinned memory before moving it to `device`
+        names, attributes = read_ply(path)
+        columns = {name: idx for idx, name in enumerate(names)}
+
+        def sorted_names(prefix):
+            return sorted(
+                [name for name in names if name.startswith(prefix)],
+                key=lambda x: int(x.split("_")[-1]),
+            )
 
-        xyz = np.stack(
-            (
-                np.asarray(plydata.elements[0]["x"]),
-                np.asarray(plydata.elements[0]["y"]),
-                np.asarray(plydata.elements[0]["z"]),
-            ),
-            axis=1,
-        )
-        opacities = np.asarray(plydata.elements[0]["opacity"])[..., np.newaxis]
-
-        features_dc = np.zeros((xyz.shape[0], 3, 1))
-        features_dc[:, 0, 0] = np.asarray(plydata.elements[0]["f_dc_0"])
-        features_dc[:, 1, 0] = np.asarray(plydata.elements[0]["f_dc_1"])
-        features_dc[:, 2, 0] = np.asarray(plydata.elements[0]["f_dc_2"])
-
-        extra_f_names = [
-            p.name
-            for p in plydata.elements[0].properties
-            if p.name.startswith("f_rest_")
-        ]
-        extra_f_names = sorted(extra_f_names, key=lambda x: int(x.split("_")[-1]))
+        extra_f_names = sorted_names("f_rest_")
+        scale_names = sorted_names("scale_")
+        rot_names = sorted_names("rot")
         # assert len(extra_f_names)==3*(self.max_sh_degree + 1) ** 2 - 3
         self.max_sh_degree = int(((len(extra_f_names) + 3) / 3) ** 0.5 - 1)
-        features_extra = np.zeros((xyz.shape[0], len(extra_f_names)))
-        for idx, attr_name in enumerate(extra_f_names):
-            features_extra[:, idx] = np.asarray(plydata.elements[0][attr_name])
+
+        order = (
+            ["x", "y", "z", "f_dc_0", "f_dc_1", "f_dc_2"]
+            + extra_f_names
+            + ["opacity"]
+            + scale_names
+            + rot_names
+        )
+        gathered = torch.from_numpy(attributes[:, [columns[name] for name in order]])
+        if pin_memory:
+            gathered = gathered.pin_memory()
+        gathered = gathered.to(device, non_blocking=pin_memory)
+        xyz, features_dc, features_extra, opacities, scales, rots = gathered.split(
+            [3, 3, len(extra_f_names), 1, len(scale_names), len(rot_names)], dim=1
+        )
         # Reshape (P,F*SH_coeffs) to (P, F, SH_coeffs except DC)
+        features_dc = features_dc.reshape(-1, 3, 1)
         features_extra = features_extra.reshape(
-            (features_extra.shape[0], 3, (self.max_sh_degree + 1) ** 2 - 1)
+            -1, 3, (self.max_sh_degree + 1) ** 2 - 1
         )
 
-        scale_names = [
-            p.name
-            for p in plydata.elements[0].properties
-            if p.name.startswith("scale_")
-        ]
-        scale_names = sorted(scale_names, key=lambda x: int(x.split("_")[-1]))
-        scales = np.zeros((xyz.shape[0], len(scale_names)))
-        for idx, attr_name in enumerate(scale_names):
-            scales[:, idx] = np.asarray(plydata.elements[0][attr_name])
-
-        rot_names = [
-            p.name for p in plydata.elements[0].properties if p.name.startswith("rot")
-        ]
-        rot_names = sorted(rot_names, key=lambda x: int(x.split("_")[-1]))
-        rots = np.zeros((xyz.shape[0], len(rot_names)))
-        for idx, attr_name in enumerate(rot_names):
-            rots[:, idx] = np.asarray(plydata.elements[0][attr_name])
-
-        self._xyz = nn.Parameter(
-            torch.tensor(xyz, dtype=torch.float, device="cuda").requires_grad_(True)
-        )
+        self._xyz = nn.Parameter(xyz.contiguous().requires_grad_(True))
         self._features_dc = nn.Parameter(
-            torch.tensor(features_dc, dtype=torch.float, device="cuda")
-            .transpose(1, 2)
-            .contiguous()
-            .requires_grad_(True)
+            features_dc.transpose(1, 2).contiguous().requires_grad_(True)
         )
         self._features_rest = nn.Parameter(
-            torch.tensor(features_extra, dtype=torch.float, device="cuda")
-            .transpose(1, 2)
-            .contiguous()
-            .requires_grad_(True)
-        )
-        self._opacity = nn.Parameter(
-            torch.tensor(opacities, dtype=torch.float, device="cuda").requires_grad_(
-                True
-            )
-        )
-        self._scaling = nn.Parameter(
-            torch.tensor(scales, dtype=torch.float, device="cuda").requires_grad_(True)
-        )
-        self._rotation = nn.Parameter(
-            torch.tensor(rots, dtype=torch.float, device="cuda").requires_grad_(True)
+            features_extra.transpose(1, 2).contiguous().requires_grad_(True)
         )
+        self._opacity = nn.Parameter(opacities.contiguous().requires_grad_(True))
+        self._scaling = nn.Parameter(scales.contiguous().requires_grad_(True))
+        self._rotation = nn.Parameter(rots.contiguous().requires_grad_(True))
 
         self.active_sh_degree = self.max_sh_degree
         self._generation = torch.zeros(
             self._opacity.shape[0],
             dtype=torch.int64,
-            device="cuda",
+            device=device,
             requires_grad=False,
         )  # generation list, begin from zero
         self.set_mask(
             torch.ones(
                 self._opacity.shape[0],
                 dtype=torch.bool,
-                device="cuda",
+                device=device,
                 requires_grad=False,
             )
         )
@@ -0,0 +1,134 @@
+#
+# Copyright (C) 2023, Inria
+# GRAPHDECO research group, https://team.inria.fr/graphdeco
+# All rights reserved.
+#
+# This software is free for non-commercial, research and evaluation use
+# under the terms of the LICENSE.md file.
+#
+# For inquiries contact  george.drettakis@inria.fr
+#
+
+import math
+
+import torch
+
+# rows gathered at once while compacting, bounds the temporary memory of a prune
+COMPACT_CHUNK = 1 << 20
+
+
+class GaussianStorage:
+    # Over-allocated row buffers for the per-Gaussian tensors of a GaussianModel.
+    # Every tensor handed out is a view of the first rows of a buffer with spare capacity, so densification
+    # appends rows in place (growing the buffer geometrically when it is full) and pruning compacts the kept
+    # rows in place, instead of reallocating every parameter, Adam moment and statistic on each densify.
+    # Tensors that are not views of a buffer yet (fresh from load_ply, Adam's lazily created moments, or a
+    # mask owned by the caller) are copied into a new buffer the first time they are touched.
+
+    def __init__(self, growth=1.5):
+        assert growth > 1
+        self.growth = growth
+        self.buffers = {}
+
+    def _is_view(self, buffer, tensor):
+        return (
+            buffer is not None
+            and buffer.data_ptr() == tensor.data_ptr()
+            and buffer.dtype == tensor.dtype
+            and buffer.shape[1:] == tensor.shape[1:]
+            and tensor.is_contiguous()
+            and tensor.shape[0] <= buffer.shape[0]
+        )
+
+    def _reserve(self, key, tensor, size):
+        buffer = self.buffers.get(key)
+        if self._is_view(buffer, tensor) and size <= buffer.shape[0]:
+            return buffer
+        capacity = max(size, math.ceil(max(tensor.shape[0], 1) * self.growth))
+        if self._is_view(buffer, tensor):
+            capacity = max(capacity, math.ceil(buffer.shape[0] * self.growth))
+        grown = tensor.new_empty((capacity, *tensor.shape[1:]))
+        grown[: tensor.shape[0]] = tensor
+        self.buffers[key] = grown
+        return grown
+
+    @torch.no_grad()
+    def resize(self, key, tensor, size):
+        # first `size` rows of the buffer behind `tensor`, rows past tensor.shape[0] are uninitialized
+        return self._reserve(key, tensor, size)[:size]
+
+    @torch.no_grad()
+    def append(self, key, tensor, rows):
+        # `tensor` extended by `rows`, written into the spare capacity of its buffer
+        n = tensor.shape[0]
+        extended = self.resize(key, tensor, n + rows.shape[0])
+        extended[n:] = rows
+        return extended
+
+    @torch.no_grad()
+    def compact(self, key, tensor, keep_index):
+        # rows `keep_index` (sorted ascending) of `tensor`, moved in place to the front of its buffer
+        buffer = self._reserve(key, tensor, tensor.shape[0])
+        size = keep_index.shape[0]
+        # keep_index[i] >= i, so each chunk only reads rows that no earlier chunk has overwritten
+        for start in range(0, size, COMPACT_CHUNK):
+            end = min(start + COMPACT_CHUNK, size)
+            buffer[start:end] = buffer[keep_index[start:end]]
+        return buffer[:size]
+
+    def clear(self):
+        self.buffers = {}
+
+
+if __name__ == "__main__":
+    # python -m gaussiansplatting.scene.gaussian_storage [num_points ...]: the row traffic of densify_and_prune,
+    # with every parameter, both Adam moments and the statistics reallocated by torch.cat / index_select as
+    # GaussianModel did before, against GaussianStorage. Each round clones 5% of the rows, splits 5% into two
+    # and prunes 8%
+    import sys
+    import time
+
+    device = "cuda" if torch.cuda.is_available() else "cpu"
+    # xyz, f_dc, f_rest (SH degree 3), scaling, rotation and opacity with their two Adam moments, then
+    # xyz_gradient_accum, denom and max_radii2D
+    widths = [3, 3, 45, 3, 4, 1] * 3 + [1, 1, 1]
+    rounds = 5
+
+    def densify_rounds(n, append, compact):
+        generator = torch.Generator(device=device).manual_seed(0)
+        tensors = [torch.rand(n, width, device=device, generator=generator) for width in widths]
+        for _ in range(rounds):
+            n = tensors[0].shape[0]
+            new_index = torch.randint(n, (n // 20 + 2 * (n // 20),), device=device, generator=generator)
+            tensors = [append(key, tensor, tensor[new_index]) for key, tensor in enumerate(tensors)]
+            keep = torch.rand(tensors[0].shape[0], device=device, generator=generator) >= 0.08
+            keep_index = keep.nonzero()[:, 0]
+            tensors = [compact(key, tensor, keep_index) for key, tensor in enumerate(tensors)]
+        if device == "cuda":
+            torch.cuda.synchronize()
+        return tensors
+
+    sizes = [int(arg) for arg in sys.argv[1:]] or [1_000_000, 5_000_000]
+    for n in sizes:
+        t = time.perf_counter()
+        reference = densify_rounds(
+            n,
+            lambda key, tensor, rows: torch.cat([tensor, rows], dim=0),
+            lambda key, tensor, keep_index: tensor[keep_index],
+        )
+        reference_time = time.perf_counter() - t
+        reference = [tensor.cpu() for tensor in reference]
+
+        storage = GaussianStorage()
+        t = time.perf_counter()
+        result = densify_rounds(n, storage.append, storage.compact)
+        storage_time = time.perf_counter() - t
+
+        assert all(torch.equal(a.cpu(), b) for a, b in zip(result, reference)), n
+        print(
+            "{} points, {} rounds: torch.cat {:.2f}s, GaussianStorage {:.2f}s, identical".format(
+                n, rounds, reference_time, storage_time
+            ),
+            flush=True,
+        )
+        del reference, result, storage
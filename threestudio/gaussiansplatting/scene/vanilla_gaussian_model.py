@@ -20,7 +20,8 @@ from gaussiansplatting.utils.general_utils import (
 from torch import nn
 import os
 from gaussiansplatting.utils.system_utils import mkdir_p
-from plyfile import PlyData, PlyElement
+from gaussiansplatting.utils.ply_utils import write_ply
+from plyfile import PlyData
 from gaussiansplatting.utils.sh_utils import RGB2SH
 from simple_knn._C import distCUDA2
 from gaussiansplatting.utils.graphics_utils import BasicPointCloud
@@ -248,39 +249,22 @@ class GaussianModel:
     def save_ply(self, path):
         mkdir_p(os.path.dirname(path))
 
-        xyz = self._xyz.detach().cpu().numpy()
-        normals = np.zeros_like(xyz)
-        f_dc = (
-            self._features_dc.detach()
-            .transpose(1, 2)
-            .flatten(start_dim=1)
-            .contiguous()
-            .cpu()
-            .numpy()
-        )
-        f_rest = (
-            self._features_rest.detach()
-            .transpose(1, 2)
-            .flatten(start_dim=1)
-            .contiguous()
-            .cpu()
-            .numpy()
-        )
-        opacities = self._opacity.detach().cpu().numpy()
-        scale = self._scaling.detach().cpu().numpy()
-        rotation = self._rotation.detach().cpu().numpy()
-
-        dtype_full = [
-            (attribute, "f4") for attribute in self.construct_list_of_attributes()
-        ]
+        xyz = self._xyz.detach()
+        normals = torch.zeros_like(xyz)
+        f_dc = self._features_dc.detach().transpose(1, 2).flatten(start_dim=1)
+        f_rest = self._features_rest.detach().transpose(1, 2).flatten(start_dim=1)
+        opacities = self._opacity.detach()
+        scale = self._scaling.detach()
+        rotation = self._rotation.detach()
 
-        elements = np.empty(xyz.shape[0], dtype=dtype_full)
-        attributes = np.concatenate(
-            (xyz, normals, f_dc, f_rest, opacities, scale, rotation), axis=1
+        attributes = torch.cat(
+            (xyz, normals, f_dc, f_rest, opacities, scale, rotation), dim=1
+        )
+        write_ply(
+            path,
+            self.construct_list_of_attributes(),
+            attributes.float().cpu().numpy(),
         )
-        elements[:] = list(map(tuple, attributes))
-        el = PlyElement.describe(elements, "vertex")
-        PlyData([el]).write(path)
 
     def reset_opacity(self):
         opacities_new = inverse_sigmoid(
@@ -9,7 +9,7 @@
 # For inquiries contact  george.drettakis@inria.fr
 #
 
-from gaussiansplatting.scene.cameras import Camera, Simple_Camera
+from gaussiansplatting.scene.cameras import Camera, Simple_Camera, MiniCam
 import numpy as np
 from gaussiansplatting.utils.general_utils import PILtoTorch
 from gaussiansplatting.utils.graphics_utils import fov2focal
@@ -71,6 +71,14 @@ def cameraList_load(cam_infos, h, w):
         )
     return camera_list
 
+def rescale_camera(camera, height, width):
+    """Returns a camera with the view and FoV of `camera` that renders a `height` x `width` image.
+
+    Works for Camera, Simple_Camera, C2W_Camera and MiniCam, whose projection only depends on the FoV.
+    """
+    return MiniCam(width, height, camera.FoVy, camera.FoVx, camera.znear, camera.zfar,
+                   camera.world_view_transform, camera.full_proj_transform)
+
 def camera_to_JSON(id, camera : Camera):
     Rt = np.zeros((4, 4))
     Rt[:3, :3] = camera.R.transpose()
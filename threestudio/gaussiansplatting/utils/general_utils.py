@@ -80,7 +80,7 @@ def build_rotation(r):
 
     q = r / norm[:, None]
 
-    R = torch.zeros((q.size(0), 3, 3), device='cuda')
+    R = torch.zeros((q.size(0), 3, 3), device=q.device)
 
     r = q[:, 0]
     x = q[:, 1]
@@ -109,6 +109,40 @@ def build_scaling_rotation(s, r):
     L = R @ L
     return L
 
+def top_fraction_threshold(values, fraction, histogram_bins=0, histogram_octaves=32):
+    """
+    Threshold t such that values >= t are the largest `fraction` of the non-zero entries of the
+    non-negative tensor `values`. Unlike torch.quantile it has no 16M element limit.
+
+    The exact mode selects the k-th largest non-zero entry with torch.kthvalue on the non-zero subset,
+    which costs one host synchronization to size it. With histogram_bins > 0 the non-zero entries are
+    binned on a log2 scale over the `histogram_octaves` octaves below the maximum and t is the lower
+    edge of the bin holding the k-th largest entry, so slightly more than `fraction` may be kept; only
+    this mode never synchronizes with the host.
+    """
+    values = values.reshape(-1)
+    if histogram_bins <= 0:
+        nonzero = values[values > 0]
+        if nonzero.numel() == 0:
+            return values.new_zeros(())
+        k = max(int(nonzero.numel() * fraction), 1)
+        return torch.kthvalue(nonzero, nonzero.numel() - k + 1).values
+
+    vmax = values.max().clamp_min(torch.finfo(values.dtype).tiny)
+    positive = values > 0
+    target = (positive.sum() * fraction).clamp_min(1)
+    bins_per_octave = histogram_bins / histogram_octaves
+    octaves = torch.log2(values.clamp_min(torch.finfo(values.dtype).tiny) / vmax)
+    index = ((octaves + histogram_octaves) * bins_per_octave).long().clamp_(0, histogram_bins - 1)
+    counts = torch.zeros(histogram_bins, dtype=torch.float64, device=values.device)
+    counts.index_add_(0, index, positive.double())
+    # counts_above[b]: number of non-zero entries in bin b or higher, non increasing
+    counts_above = counts.flip(0).cumsum(0).flip(0)
+    selected_bin = (counts_above >= target).sum() - 1
+    threshold = vmax * torch.exp2(selected_bin / bins_per_octave - histogram_octaves)
+    # the lowest bin also holds every entry below its range
+    return torch.where(selected_bin > 0, threshold, torch.zeros_like(threshold))
+
 def safe_state(silent):
     old_f = sys.stdout
     class F:
@@ -131,3 +165,44 @@ def safe_state(silent):
     np.random.seed(0)
     torch.manual_seed(0)
     torch.cuda.set_device(torch.device("cuda:0"))
+
+
+if __name__ == "__main__":
+    # python -m gaussiansplatting.utils.general_utils: top_fraction_threshold on 20M gradients, 40% of them
+    # non-zero, against the torch.kthvalue selection over the non-zero entries; on CUDA the histogram mode
+    # runs with host synchronizations raising an error
+    import time
+
+    device = "cuda" if torch.cuda.is_available() else "cpu"
+    fraction = 0.3
+    generator = torch.Generator(device=device).manual_seed(0)
+    n = 20_000_000
+    values = torch.rand(n, device=device, generator=generator) * 1e-3
+    values[torch.rand(n, device=device, generator=generator) >= 0.4] = 0.0
+
+    nonzero = values[values > 0]
+    target = max(int(nonzero.numel() * fraction), 1)
+    reference = torch.kthvalue(nonzero.cpu(), nonzero.numel() - target + 1).values.item()
+
+    for name, bins in [("exact", 0), ("histogram", 4096)]:
+        top_fraction_threshold(values, fraction, histogram_bins=bins)
+        if device == "cuda":
+            torch.cuda.synchronize()
+            torch.cuda.set_sync_debug_mode("error" if bins > 0 else "default")
+        t = time.perf_counter()
+        threshold = top_fraction_threshold(values, fraction, histogram_bins=bins)
+        if device == "cuda":
+            torch.cuda.set_sync_debug_mode("default")
+            torch.cuda.synchronize()
+        elapsed = time.perf_counter() - t
+        kept = (values >= threshold).sum().item()
+        if bins == 0:
+            # ties at the threshold are all kept
+            above = (values > threshold).sum().item()
+            assert threshold.item() == reference and above < target <= kept, (above, kept, target)
+        else:
+            assert target <= kept <= target * 1.01, (kept, target)
+        print("{}: {:.3f}s, keeps {} of target {}".format(name, elapsed, kept, target))
+
+    assert top_fraction_threshold(torch.zeros(10, device=device), fraction).item() == 0
+    assert top_fraction_threshold(torch.zeros(0, device=device), fraction).item() == 0
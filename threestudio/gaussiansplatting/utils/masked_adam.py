@@ -0,0 +1,157 @@
+#
+# Copyright (C) 2023, Inria
+# GRAPHDECO research group, https://team.inria.fr/graphdeco
+# All rights reserved.
+#
+# This software is free for non-commercial, research and evaluation use
+# under the terms of the LICENSE.md file.
+#
+# For inquiries contact  george.drettakis@inria.fr
+#
+
+import torch
+
+
+class MaskedAdam(torch.optim.Adam):
+    # Adam that only steps selected rows of some parameters. A param group with a "row_index" (sorted
+    # LongTensor) updates the parameter rows and moment rows in that index and leaves every other row, and
+    # its moments, untouched, which replaces multiplying the full gradients by a mask in backward hooks.
+    # Groups without a row_index are stepped by torch.optim.Adam as usual.
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        # id(param) -> (its state["step"] tensor, the tensor's _version, the step as a python number), so the bias
+        # corrections never read the step tensor back; Adam stepping the param or a loaded state changes the
+        # tensor or its version and the value is read once again
+        self._step_counts = {}
+
+    @torch.no_grad()
+    def step(self, closure=None):
+        loss = None
+        if closure is not None:
+            with torch.enable_grad():
+                loss = closure()
+
+        masked_groups = [group for group in self.param_groups if group.get("row_index") is not None]
+        # hide the masked parameters from Adam, it skips parameters without gradient
+        hidden_grads = []
+        for group in masked_groups:
+            for p in group["params"]:
+                hidden_grads.append((group, p, p.grad))
+                p.grad = None
+        super().step()
+
+        for group, p, grad in hidden_grads:
+            p.grad = grad
+            if grad is not None:
+                self._masked_step(group, p, grad)
+        # forget the parameters replaced since, e.g. by densification
+        live = {id(p) for _, p, _ in hidden_grads}
+        self._step_counts = {key: value for key, value in self._step_counts.items() if key in live}
+        return loss
+
+    def _masked_step(self, group, p, grad):
+        assert not group["amsgrad"] and not group["maximize"] and group["weight_decay"] == 0
+        beta1, beta2 = group["betas"]
+        index = group["row_index"]
+
+        state = self.state[p]
+        if len(state) == 0:
+            state["step"] = torch.tensor(0.0, dtype=torch.float32)
+            state["exp_avg"] = torch.zeros_like(p, memory_format=torch.preserve_format)
+            state["exp_avg_sq"] = torch.zeros_like(p, memory_format=torch.preserve_format)
+            self._step_counts[id(p)] = (state["step"], state["step"]._version, 0.0)
+        count = self._step_counts.get(id(p))
+        if count is not None and count[0] is state["step"] and count[1] == state["step"]._version:
+            step = count[2] + 1
+        else:
+            step = state["step"].item() + 1
+        state["step"] += 1
+        self._step_counts[id(p)] = (state["step"], state["step"]._version, step)
+
+        # same arithmetic as the single tensor torch.optim.Adam, on the gathered rows
+        grad = grad.index_select(0, index)
+        exp_avg = state["exp_avg"].index_select(0, index).lerp_(grad, 1 - beta1)
+        exp_avg_sq = state["exp_avg_sq"].index_select(0, index).mul_(beta2).addcmul_(grad, grad, value=1 - beta2)
+
+        bias_correction1 = 1 - beta1**step
+        bias_correction2 = 1 - beta2**step
+        step_size = group["lr"] / bias_correction1
+        denom = (exp_avg_sq.sqrt() / bias_correction2**0.5).add_(group["eps"])
+        rows = p.index_select(0, index).addcdiv_(exp_avg, denom, value=-step_size)
+
+        p.index_copy_(0, index, rows)
+        state["exp_avg"].index_copy_(0, index, exp_avg)
+        state["exp_avg_sq"].index_copy_(0, index, exp_avg_sq)
+
+
+if __name__ == "__main__":
+    # python -m gaussiansplatting.utils.masked_adam [num_points]: MaskedAdam against torch.optim.Adam on gradients
+    # multiplied by the mask, as the backward hooks of GaussianModel.apply_grad_mask do. With a fixed mask the two
+    # are bit-identical, also around a phase without mask stepped by Adam, and the step counts are never read
+    # back from their tensors. Once the mask changes they diverge on purpose: rows leaving the mask keep their
+    # Adam momentum and still move under zero gradients with the hooks, while MaskedAdam freezes them
+    import sys
+    import time
+
+    device = "cuda" if torch.cuda.is_available() else "cpu"
+    # xyz, f_dc, f_rest (SH degree 3), opacity and scaling, the parameters the hooks mask
+    widths = [3, 3, 45, 1, 3]
+
+    def run(n, masks, masked, steps=3, seed=0):
+        generator = torch.Generator(device=device).manual_seed(seed)
+        params = [torch.nn.Parameter(torch.randn(n, width, device=device, generator=generator)) for width in widths]
+        groups = [{"params": [p], "lr": 1e-2} for p in params]
+        optimizer = MaskedAdam(groups, eps=1e-15) if masked else torch.optim.Adam(groups, eps=1e-15, foreach=False)
+        elapsed = 0.0
+        for mask in masks:
+            # a None mask steps every row, through Adam for MaskedAdam
+            for group in optimizer.param_groups:
+                group["row_index"] = mask.nonzero()[:, 0] if masked and mask is not None else None
+            for _ in range(steps):
+                grads = [torch.randn(p.shape, device=device, generator=generator) for p in params]
+                if device == "cuda":
+                    torch.cuda.synchronize()
+                t = time.perf_counter()
+                for p, grad in zip(params, grads):
+                    p.grad = grad if masked or mask is None else grad * mask[:, None]
+                optimizer.step()
+                if device == "cuda":
+                    torch.cuda.synchronize()
+                elapsed += time.perf_counter() - t
+        return [p.detach() for p in params], optimizer, elapsed
+
+    first = torch.tensor([1, 1, 1, 0, 0, 0], dtype=torch.bool, device=device)
+    second = torch.tensor([0, 0, 1, 1, 1, 1], dtype=torch.bool, device=device)
+
+    # the last phase masks every row, so none leaves the mask after the Adam phase
+    for masks in [[first], [first, None, first | second]]:
+        hooked, hooked_optimizer, _ = run(6, masks, masked=False)
+        masked, masked_optimizer, _ = run(6, masks, masked=True)
+        assert all(torch.equal(a, b) for a, b in zip(hooked, masked))
+        for a, b in zip(hooked_optimizer.state.values(), masked_optimizer.state.values()):
+            assert torch.equal(a["exp_avg"], b["exp_avg"]) and torch.equal(a["exp_avg_sq"], b["exp_avg_sq"])
+            assert torch.equal(a["step"], b["step"])
+    print("fixed mask, and around an unmasked Adam phase: parameters and moments bit-identical")
+
+    item = torch.Tensor.item
+    reads = []
+    torch.Tensor.item = lambda tensor: reads.append(tensor) or item(tensor)
+    run(6, [first], masked=True)
+    torch.Tensor.item = item
+    assert len(reads) == 0, len(reads)
+    print("no step count read back while masked")
+
+    hooked, _, _ = run(6, [first, second], masked=False)
+    masked, _, _ = run(6, [first, second], masked=True)
+    left = first & ~second
+    drift = max((a[left] - b[left]).abs().max().item() for a, b in zip(hooked, masked))
+    assert drift > 0
+    assert all(torch.equal(a[~left], b[~left]) for a, b in zip(hooked, masked))
+    print("mask change: rows leaving the mask differ by up to {:.3f}, every other row bit-identical".format(drift))
+
+    n = int(sys.argv[1]) if len(sys.argv) > 1 else 1_000_000
+    mask = torch.rand(n, device=device) < 0.05
+    _, _, hooked_time = run(n, [mask], masked=False)
+    _, _, masked_time = run(n, [mask], masked=True)
+    print("{} points, 5% mask, 3 steps: hooks + Adam {:.3f}s, MaskedAdam {:.3f}s".format(n, hooked_time, masked_time))
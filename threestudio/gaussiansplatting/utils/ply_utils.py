@@ -0,0 +1,143 @@
+#
+# Copyright (C) 2023, Inria
+# GRAPHDECO research group, https://team.inria.fr/graphdeco
+# All rights reserved.
+#
+# This software is free for non-commercial, research and evaluation use
+# under the terms of the LICENSE.md file.
+#
+# For inquiries contact  george.drettakis@inria.fr
+#
+
+import numpy as np
+
+
+def write_ply(path, attribute_names, attributes):
+    # Writes an (N, len(attribute_names)) matrix as the float vertex element of a binary little endian ply.
+    # Byte-identical to PlyData([PlyElement.describe(elements, "vertex")]).write(path) on a structured array
+    # of "f4" fields, but dumps the matrix as one buffer instead of building a python tuple per vertex.
+    attributes = np.ascontiguousarray(attributes, dtype="<f4")
+    assert attributes.ndim == 2 and attributes.shape[1] == len(attribute_names)
+
+    header = ["ply", "format binary_little_endian 1.0", "element vertex {}".format(attributes.shape[0])]
+    header += ["property float {}".format(name) for name in attribute_names]
+    header.append("end_header")
+
+    with open(path, "wb") as f:
+        f.write(("\n".join(header) + "\n").encode("ascii"))
+        attributes.tofile(f)
+
+
+_PLY_DTYPES = {
+    "char": "i1", "int8": "i1", "uchar": "u1", "uint8": "u1",
+    "short": "i2", "int16": "i2", "ushort": "u2", "uint16": "u2",
+    "int": "i4", "int32": "i4", "uint": "u4", "uint32": "u4",
+    "float": "f4", "float32": "f4", "double": "f8", "float64": "f8",
+}
+
+
+def read_ply(path):
+    # Returns the vertex property names and an (N, len(names)) float32 matrix of their values.
+    # Binary little endian files are memory-mapped; when every property is a float the matrix is a
+    # zero-copy view of the file. Anything else (ascii, big endian, list properties) goes through plyfile.
+    with open(path, "rb") as f:
+        if f.readline().strip() != b"ply":
+            raise ValueError("{} is not a ply file".format(path))
+        fmt = None
+        elements = []
+        while True:
+            line = f.readline()
+            if not line:
+                raise ValueError("{} has a truncated ply header".format(path))
+            tokens = line.decode("ascii").split()
+            if not tokens:
+                continue
+            if tokens[0] == "format":
+                fmt = tokens[1]
+            elif tokens[0] == "element":
+                elements.append((tokens[1], int(tokens[2]), []))
+            elif tokens[0] == "property":
+                elements[-1][2].append((tokens[-1], tokens[1]))
+            elif tokens[0] == "end_header":
+                break
+        offset = f.tell()
+
+    if (
+        fmt != "binary_little_endian"
+        or len(elements) == 0
+        or elements[0][0] != "vertex"
+        or any(ply_type not in _PLY_DTYPES for _, ply_type in elements[0][2])
+    ):
+        return _read_ply_with_plyfile(path)
+
+    _, count, properties = elements[0]
+    names = [name for name, _ in properties]
+    if count == 0:
+        return names, np.zeros((0, len(names)), dtype=np.float32)
+
+    dtype = np.dtype([(name, "<" + _PLY_DTYPES[ply_type]) for name, ply_type in properties])
+    vertices = np.memmap(path, dtype=dtype, mode="r", offset=offset, shape=(count,))
+    if all(_PLY_DTYPES[ply_type] == "f4" for _, ply_type in properties):
+        attributes = vertices.view("<f4").reshape(count, len(names))
+    else:
+        attributes = np.stack([vertices[name].astype(np.float32) for name in names], axis=1)
+    return names, attributes
+
+
+def _read_ply_with_plyfile(path):
+    from plyfile import PlyData
+
+    vertices = PlyData.read(path).elements[0]
+    names = [p.name for p in vertices.properties]
+    attributes = np.stack([np.asarray(vertices[name], dtype=np.float32) for name in names], axis=1)
+    return names, attributes
+
+
+if __name__ == "__main__":
+    # python -m gaussiansplatting.utils.ply_utils: write_ply against plyfile on the attribute layout of a Gaussian
+    # checkpoint. The per-vertex tuples of the old save_ply need several GB past 1M points, so above that the
+    # plyfile reference is written from a structured view of the matrix and only its write is timed
+    import filecmp
+    import os
+    import tempfile
+    import time
+
+    from plyfile import PlyData, PlyElement
+
+    names = ["x", "y", "z", "nx", "ny", "nz"]
+    names += ["f_dc_{}".format(i) for i in range(3)] + ["f_rest_{}".format(i) for i in range(45)]
+    names += ["opacity"] + ["scale_{}".format(i) for i in range(3)] + ["rot_{}".format(i) for i in range(4)]
+    dtype = np.dtype([(name, "<f4") for name in names])
+
+    with tempfile.TemporaryDirectory() as tmp:
+        for n in [0, 10, 1_000_000, 5_000_000]:
+            attributes = np.random.default_rng(0).standard_normal((n, len(names)), dtype=np.float32)
+            reference_path = os.path.join(tmp, "reference.ply")
+            path = os.path.join(tmp, "write_ply.ply")
+
+            t = time.perf_counter()
+            if n <= 1_000_000:
+                reference_name = "save_ply tuples + plyfile"
+                elements = np.empty(n, dtype=dtype)
+                elements[:] = list(map(tuple, attributes))
+            else:
+                reference_name = "plyfile"
+                elements = attributes.view(dtype).reshape(n)
+            PlyData([PlyElement.describe(elements, "vertex")]).write(reference_path)
+            reference_time = time.perf_counter() - t
+            del elements
+
+            t = time.perf_counter()
+            write_ply(path, names, attributes)
+            write_time = time.perf_counter() - t
+
+            assert filecmp.cmp(reference_path, path, shallow=False), n
+            read_names, read_attributes = read_ply(path)
+            assert read_names == names and np.array_equal(read_attributes, attributes), n
+            del read_attributes
+            print(
+                "{} points: {} {:.2f}s, write_ply {:.2f}s, byte-identical".format(
+                    n, reference_name, reference_time, write_time
+                ),
+                flush=True,
+            )
@@ -14,6 +14,7 @@ import threestudio
 from threestudio.models.prompt_processors.base import PromptProcessorOutput
 from threestudio.utils.base import BaseObject
 from threestudio.utils.misc import C, parse_version
+from threestudio.utils.truncated_schedule import TruncatedSchedulerCache
 from threestudio.utils.typing import *
 
 
@@ -102,6 +103,9 @@ class ControlNetGuidance(BaseObject):
             cache_dir=self.cfg.cache_dir,
         )
         self.scheduler.set_timesteps(self.cfg.diffusion_steps)
+        self.truncated_schedulers = TruncatedSchedulerCache(
+            self.scheduler, self.cfg.diffusion_steps
+        )
 
         if self.cfg.enable_memory_efficient_attention:
             if parse_version(torch.__version__) >= parse_version("2"):
@@ -235,8 +239,8 @@ class ControlNetGuidance(BaseObject):
         image_cond: Float[Tensor, "B 3 H W"],
         t: Int[Tensor, "B"],
     ) -> Float[Tensor, "B 4 DH DW"]:
-        self.scheduler.config.num_train_timesteps = t.item()
-        self.scheduler.set_timesteps(self.cfg.diffusion_steps)
+        # denoise over [0, t] with a cached truncated copy of the schedule, self.scheduler stays untouched
+        scheduler = self.truncated_schedulers[t.item()]
         with torch.no_grad():
             # add noise
             noise = torch.randn_like(latents)
@@ -244,7 +248,7 @@ class ControlNetGuidance(BaseObject):
 
             # sections of code used from https://github.com/huggingface/diffusers/blob/main/src/diffusers/pipelines/stable_diffusion/pipeline_stable_diffusion_instruct_pix2pix.py
             threestudio.debug("Start editing...")
-            for i, t in enumerate(self.scheduler.timesteps):
+            for i, t in enumerate(scheduler.timesteps):
                 # predict the noise residual with unet, NO grad!
                 with torch.no_grad():
                     # pred noise
@@ -274,7 +278,7 @@ class ControlNetGuidance(BaseObject):
                     noise_pred_text - noise_pred_uncond
                 )
                 # get previous sample, continue loop
-                latents = self.scheduler.step(noise_pred, t, latents).prev_sample
+                latents = scheduler.step(noise_pred, t, latents).prev_sample
             threestudio.debug("Editing finished.")
         return latents
 
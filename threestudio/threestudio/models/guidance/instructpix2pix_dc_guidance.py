@@ -12,7 +12,9 @@ from tqdm import tqdm
 import threestudio
 from threestudio.models.prompt_processors.base import PromptProcessorOutput
 from threestudio.utils.base import BaseObject
+from threestudio.utils.cfg_planner import CFGPlanner
 from threestudio.utils.misc import C, parse_version
+from threestudio.utils.truncated_schedule import TruncatedSchedulerCache
 from threestudio.utils.typing import *
 from threestudio.utils.free_lunch import register_free_upblock2d_in, register_free_crossattn_upblock2d_in
 
@@ -37,6 +39,7 @@ class InstructPix2PixDCGuidance(BaseObject):
         half_precision_weights: bool = True
 
         fixed_size: int = -1
+        antialias: bool = False
 
         min_step_percent: float = 0.02
         max_step_percent: float = 0.98
@@ -85,6 +88,9 @@ class InstructPix2PixDCGuidance(BaseObject):
             cache_dir=self.cfg.cache_dir,
         )
         self.scheduler.set_timesteps(self.cfg.diffusion_steps)
+        self.truncated_schedulers = TruncatedSchedulerCache(
+            self.scheduler, self.cfg.diffusion_steps
+        )
 
         if self.cfg.enable_memory_efficient_attention:
             if parse_version(torch.__version__) >= parse_version("2"):
@@ -125,6 +131,11 @@ class InstructPix2PixDCGuidance(BaseObject):
 
         self.grad_clip_val: Optional[float] = None
 
+        # (view index, RH, RW) -> VAE posterior mean and std of the fixed source frame of that view
+        self.source_latents: Dict[Tuple[int, int, int], Tuple[Tensor, Tensor]] = {}
+        # (target, source) negative embeddings last compared by shared_uncond, and whether they are equal
+        self._shared_uncond: Optional[Tuple[Tensor, Tensor, bool]] = None
+
         self.iteration = 0
         self.max_iteration = self.cfg.max_iteration
 
@@ -180,6 +191,38 @@ class InstructPix2PixDCGuidance(BaseObject):
         latents = torch.cat([latents, latents, uncond_image_latents], dim=0)
         return latents.to(input_dtype)
 
+    @torch.cuda.amp.autocast(enabled=False)
+    @torch.no_grad()
+    def encode_source_images(
+        self, imgs: Float[Tensor, "B 3 H W"], index: List[int], RH: int, RW: int
+    ) -> Tuple[Float[Tensor, "B 4 DH DW"], Float[Tensor, "B 4 DH DW"]]:
+        # posterior mean and std of source frames, encoded once per view and guidance resolution
+        missing = [i for i, view in enumerate(index) if (int(view), RH, RW) not in self.source_latents]
+        if len(missing) > 0:
+            missing_imgs = self.resize_to_guidance(imgs[missing], RH, RW) * 2.0 - 1.0
+            posterior = self.vae.encode(missing_imgs.to(self.weights_dtype)).latent_dist
+            for i, mean, std in zip(missing, posterior.mean, posterior.std):
+                self.source_latents[(int(index[i]), RH, RW)] = (mean, std)
+        mean, std = zip(*[self.source_latents[(int(view), RH, RW)] for view in index])
+        return torch.stack(mean, dim=0), torch.stack(std, dim=0)
+
+    def cache_source_images(self, imgs: Float[Tensor, "B H W C"], index: List[int]) -> None:
+        # fill the source latent cache ahead of training, at the guidance size of the frames
+        RH, RW = self.get_guidance_size(*imgs.shape[1:3])
+        self.encode_source_images(imgs.permute(0, 3, 1, 2), index, RH, RW)
+
+    def save_source_latents(self, path: str) -> None:
+        torch.save(
+            {key: (mean.cpu(), std.cpu()) for key, (mean, std) in self.source_latents.items()},
+            path,
+        )
+
+    def load_source_latents(self, path: str) -> None:
+        self.source_latents = {
+            key: (mean.to(self.device, self.weights_dtype), std.to(self.device, self.weights_dtype))
+            for key, (mean, std) in torch.load(path).items()
+        }
+
     @torch.cuda.amp.autocast(enabled=False)
     def decode_latents(
         self, latents: Float[Tensor, "B 4 DH DW"]
@@ -190,6 +233,21 @@ class InstructPix2PixDCGuidance(BaseObject):
         image = (image * 0.5 + 0.5).clamp(0, 1)
         return image.to(input_dtype)
 
+    def get_guidance_size(self, H: int, W: int) -> Tuple[int, int]:
+        if self.cfg.fixed_size > 0:
+            return self.cfg.fixed_size, self.cfg.fixed_size
+        return H // 8 * 8, W // 8 * 8
+
+    def resize_to_guidance(
+        self, imgs: Float[Tensor, "B 3 H W"], RH: int, RW: int
+    ) -> Float[Tensor, "B 3 RH RW"]:
+        # renders already at the guidance resolution are passed through untouched
+        if imgs.shape[-2:] == (RH, RW):
+            return imgs
+        return F.interpolate(
+            imgs, (RH, RW), mode="bilinear", align_corners=False, antialias=self.cfg.antialias
+        )
+
     def edit_latents(
         self,
         text_embeddings: Float[Tensor, "BB 77 768"],
@@ -197,15 +255,15 @@ class InstructPix2PixDCGuidance(BaseObject):
         image_cond_latents: Float[Tensor, "B 4 DH DW"],
         t: Int[Tensor, "B"],
     ) -> Float[Tensor, "B 4 DH DW"]:
-        self.scheduler.config.num_train_timesteps = t.item()
-        self.scheduler.set_timesteps(self.cfg.diffusion_steps)
+        # denoise over [0, t] with a cached truncated copy of the schedule, self.scheduler stays untouched
+        scheduler = self.truncated_schedulers[t.item()]
         with torch.no_grad():
             # add noise
             noise = torch.randn_like(latents)
             latents = self.scheduler.add_noise(latents, noise, t)  # type: ignore
             threestudio.debug("Start editing...")
             # sections of code used from https://github.com/huggingface/diffusers/blob/main/src/diffusers/pipelines/stable_diffusion/pipeline_stable_diffusion_instruct_pix2pix.py
-            for i, t in enumerate(self.scheduler.timesteps):
+            for i, t in enumerate(scheduler.timesteps):
                 # predict the noise residual with unet, NO grad!
                 with torch.no_grad():
                     # pred noise
@@ -227,10 +285,90 @@ class InstructPix2PixDCGuidance(BaseObject):
                 )
 
                 # get previous sample, continue loop
-                latents = self.scheduler.step(noise_pred, t, latents).prev_sample
+                latents = scheduler.step(noise_pred, t, latents).prev_sample
             threestudio.debug("Editing finished.")
         return latents
 
+    def shared_uncond(
+        self,
+        target_prompt_utils: PromptProcessorOutput,
+        source_prompt_utils: PromptProcessorOutput,
+    ) -> bool:
+        # whether both prompts embed the same negative prompt, compared once per pair of prompt processor
+        # outputs instead of on every step
+        target = target_prompt_utils.uncond_text_embeddings
+        source = source_prompt_utils.uncond_text_embeddings
+        if (
+            self._shared_uncond is None
+            or self._shared_uncond[0] is not target
+            or self._shared_uncond[1] is not source
+        ):
+            shared = target is source or torch.equal(target, source)
+            self._shared_uncond = (target, source, shared)
+        return self._shared_uncond[2]
+
+    @torch.no_grad()
+    def predict_dds_noise(
+        self,
+        tgt_latents: Float[Tensor, "B 4 DH DW"],
+        src_latents: Float[Tensor, "B 4 DH DW"],
+        tgt_text_embeddings: Float[Tensor, "BB 77 768"],
+        src_text_embeddings: Float[Tensor, "BB 77 768"],
+        image_cond_latents: Float[Tensor, "BB 4 DH DW"],
+        noise: Float[Tensor, "B 4 DH DW"],
+        t: Int[Tensor, "B"],
+        shared_uncond: bool = False,
+    ) -> Dict[str, Float[Tensor, "B 4 DH DW"]]:
+        # Guided noise of both DDS branches from a single UNet call. The target branch uses the noisy target
+        # latents with the [text, image, uncond] rows of the target prompt, the source branch the noisy source
+        # latents with the source prompt. The source guidance has no text term, so its text row is skipped, and
+        # its rows are shared with the target ones when src_latents is tgt_latents and, with shared_uncond,
+        # both prompts have the same negative embedding. Sharing is decided by the caller instead of comparing
+        # tensors, which would synchronize with the device on every step.
+        batch_size = tgt_latents.shape[0]
+        tgt_latents_noisy = self.scheduler.add_noise(tgt_latents, noise, t)
+        if src_latents is tgt_latents:
+            src_latents_noisy = tgt_latents_noisy
+        else:
+            src_latents_noisy = self.scheduler.add_noise(src_latents, noise, t)
+        image_cond, _, uncond_image = image_cond_latents.chunk(3)
+        if tgt_text_embeddings.shape[0] == 3:
+            tgt_text_embeddings = tgt_text_embeddings.repeat_interleave(batch_size, dim=0)
+        if src_text_embeddings.shape[0] == 3:
+            src_text_embeddings = src_text_embeddings.repeat_interleave(batch_size, dim=0)
+        # [positive, negative, negative]
+        tgt_cond_embeddings, tgt_uncond_embeddings, _ = tgt_text_embeddings.chunk(3)
+        _, src_uncond_embeddings, _ = src_text_embeddings.chunk(3)
+        if shared_uncond:
+            src_uncond_embeddings = tgt_uncond_embeddings
+
+        planner = CFGPlanner()
+        text = planner.add(tgt_latents_noisy, tgt_cond_embeddings, image_cond)
+        image = planner.add(tgt_latents_noisy, tgt_uncond_embeddings, image_cond)
+        uncond = planner.add(tgt_latents_noisy, tgt_uncond_embeddings, uncond_image)
+        src_image = planner.add(src_latents_noisy, src_uncond_embeddings, image_cond)
+        src_uncond = planner.add(src_latents_noisy, src_uncond_embeddings, uncond_image)
+        noise_pred = planner.run(
+            lambda x, timesteps, embeddings: self.forward_unet(
+                x, timesteps, encoder_hidden_states=embeddings
+            ),
+            t,
+        )
+        noise_pred_text, noise_pred_image, noise_pred_uncond = (
+            noise_pred[text],
+            noise_pred[image],
+            noise_pred[uncond],
+        )
+        src_noise_pred_image, src_noise_pred_uncond = noise_pred[src_image], noise_pred[src_uncond]
+
+        return {
+            "target": noise_pred_uncond
+            + self.cfg.guidance_scale * (noise_pred_text - noise_pred_image)
+            + self.cfg.condition_scale * (noise_pred_image - noise_pred_uncond),
+            "source": src_noise_pred_uncond
+            + self.cfg.condition_scale * (src_noise_pred_image - src_noise_pred_uncond),
+        }
+
     def compute_grad_dds(
         self,
         tgt_latents: Float[Tensor, "B 4 DH DW"],
@@ -240,43 +378,19 @@ class InstructPix2PixDCGuidance(BaseObject):
         image_cond_latents: Float[Tensor, "B 4 DH DW"],
         t: Int[Tensor, "B"],
         t_normalized: Int[Tensor, "B"] = None,
+        shared_uncond: bool = False,
     ):
-        eps = dict()
         noise = torch.randn_like(tgt_latents)  # TODO: use torch generator
-
-        for latent, cond_text_embedding, name in zip(
-            [tgt_latents, src_latents], [tgt_text_embeddings, src_text_embeddings], ["target", "source"]
-        ):
-            with torch.no_grad():
-            
-                # add noise
-                latents_noisy = self.scheduler.add_noise(tgt_latents, noise, t)
-
-                # pred noise
-                latent_model_input = torch.cat([latents_noisy] * 3)
-                latent_model_input = torch.cat(
-                    [latent_model_input, image_cond_latents], dim=1
-                )
-
-                noise_pred = self.forward_unet(
-                    latent_model_input, t, encoder_hidden_states=tgt_text_embeddings
-                )
-
-            noise_pred_text, noise_pred_image, noise_pred_uncond = noise_pred.chunk(3)
-            
-            if name == "target":
-                noise_pred = (
-                    noise_pred_uncond
-                    + self.cfg.guidance_scale * (noise_pred_text - noise_pred_image)
-                    + self.cfg.condition_scale * (noise_pred_image - noise_pred_uncond)
-                )
-            else:
-                noise_pred = (
-                    noise_pred_uncond 
-                    + self.cfg.condition_scale * (noise_pred_image - noise_pred_uncond)
-                )
-
-            eps[name] = noise_pred
+        eps = self.predict_dds_noise(
+            tgt_latents,
+            src_latents,
+            tgt_text_embeddings,
+            src_text_embeddings,
+            image_cond_latents,
+            noise,
+            t,
+            shared_uncond=shared_uncond,
+        )
 
         if t_normalized is not None and self.cfg.use_dreamcatalyst:
             w = self.cfg.delta + self.cfg.gamma * (t_normalized ** (1/math.e))
@@ -294,6 +408,8 @@ class InstructPix2PixDCGuidance(BaseObject):
         cond_rgb: Float[Tensor, "B H W C"],
         target_prompt_utils: PromptProcessorOutput,
         source_prompt_utils: PromptProcessorOutput,
+        # view indices of cond_rgb, the source latents of these fixed frames are then encoded only once
+        cond_index: Optional[List[int]] = None,
         # TODO: DDS
         **kwargs,
     ):
@@ -302,25 +418,22 @@ class InstructPix2PixDCGuidance(BaseObject):
         rgb_BCHW = rgb.permute(0, 3, 1, 2)
         target_latents: Float[Tensor, "B 4 DH DW"]
         source_latents: Float[Tensor, "B 4 DH DW"]
-        if self.cfg.fixed_size > 0:
-            RH, RW = self.cfg.fixed_size, self.cfg.fixed_size
-        else:
-            RH, RW = H // 8 * 8, W // 8 * 8
-        rgb_BCHW_HW8 = F.interpolate(
-            rgb_BCHW, (RH, RW), mode="bilinear", align_corners=False
-        )
+        RH, RW = self.get_guidance_size(H, W)
+        rgb_BCHW_HW8 = self.resize_to_guidance(rgb_BCHW, RH, RW)
         target_latents = self.encode_images(rgb_BCHW_HW8)
 
         cond_rgb_BCHW = cond_rgb.permute(0, 3, 1, 2)
-        cond_rgb_BCHW_HW8 = F.interpolate(
-            cond_rgb_BCHW,
-            (RH, RW),
-            mode="bilinear",
-            align_corners=False,
-        )
-
-        source_latents = self.encode_images(cond_rgb_BCHW_HW8)
-        cond_latents = self.encode_cond_images(cond_rgb_BCHW_HW8)
+        if cond_index is None:
+            cond_rgb_BCHW_HW8 = self.resize_to_guidance(cond_rgb_BCHW, RH, RW)
+            source_latents = self.encode_images(cond_rgb_BCHW_HW8)
+            cond_latents = self.encode_cond_images(cond_rgb_BCHW_HW8)
+        else:
+            # what encode_images and encode_cond_images return: a posterior sample and the mode
+            mean, std = self.encode_source_images(cond_rgb_BCHW, cond_index, RH, RW)
+            source_latents = (
+                (mean + std * torch.randn_like(mean)) * self.vae.config.scaling_factor
+            ).to(rgb.dtype)
+            cond_latents = torch.cat([mean, mean, torch.zeros_like(mean)], dim=0).to(rgb.dtype)
 
         temp = torch.zeros(1).to(rgb.device)
         target_text_embeddings = target_prompt_utils.get_text_embeddings(temp, temp, temp, False)
@@ -366,7 +479,8 @@ class InstructPix2PixDCGuidance(BaseObject):
                 source_text_embeddings, 
                 cond_latents, 
                 t,
-                t_noralized if self.cfg.use_dreamcatalyst else None
+                t_noralized if self.cfg.use_dreamcatalyst else None,
+                shared_uncond=self.shared_uncond(target_prompt_utils, source_prompt_utils),
             )
             grad = torch.nan_to_num(grad)
             if self.grad_clip_val is not None:
@@ -401,9 +515,74 @@ class InstructPix2PixDCGuidance(BaseObject):
 
 
 if __name__ == "__main__":
-    from threestudio.utils.config import ExperimentConfig, load_config
+    from argparse import Namespace
+
+    from threestudio.utils.config import ExperimentConfig, load_config, parse_structured
     from threestudio.utils.typing import Optional
 
+    # predict_dds_noise against two explicit [text, image, uncond] passes, one with the noisy target latents and
+    # the target prompt, one with the noisy source latents and the source prompt, on CPU with a tiny UNet
+    class TinyUNet(torch.nn.Module):
+        def __init__(self):
+            super().__init__()
+            self.conv = torch.nn.Conv2d(8, 4, 3, padding=1)
+            self.proj = torch.nn.Linear(16, 4)
+            self.rows = 0
+
+        def forward(self, latents, t, encoder_hidden_states):
+            self.rows += latents.shape[0]
+            sample = self.conv(latents) * (1 + t.view(-1, 1, 1, 1) / 1000)
+            sample = sample + self.proj(encoder_hidden_states.mean(1))[..., None, None]
+            return Namespace(sample=sample)
+
+    torch.manual_seed(0)
+    tiny = InstructPix2PixDCGuidance.__new__(InstructPix2PixDCGuidance)
+    tiny.cfg = parse_structured(InstructPix2PixDCGuidance.Config, {})
+    tiny.unet = TinyUNet()
+    tiny.weights_dtype = torch.float32
+    tiny.scheduler = DDIMScheduler()
+
+    def explicit_dds_noise(tgt_latents, src_latents, tgt_text_embeddings, src_text_embeddings, image_cond_latents, noise, t):
+        eps = {}
+        for name, latents, text_embeddings in [
+            ("target", tgt_latents, tgt_text_embeddings),
+            ("source", src_latents, src_text_embeddings),
+        ]:
+            latents_noisy = tiny.scheduler.add_noise(latents, noise, t)
+            noise_pred = tiny.forward_unet(
+                torch.cat([torch.cat([latents_noisy] * 3), image_cond_latents], dim=1),
+                torch.cat([t] * 3),
+                encoder_hidden_states=text_embeddings.repeat_interleave(latents.shape[0], dim=0),
+            )
+            noise_pred_text, noise_pred_image, noise_pred_uncond = noise_pred.chunk(3)
+            eps[name] = noise_pred_uncond + tiny.cfg.condition_scale * (noise_pred_image - noise_pred_uncond)
+            if name == "target":
+                eps[name] = eps[name] + tiny.cfg.guidance_scale * (noise_pred_text - noise_pred_image)
+        return eps
+
+    # shared: the source branch gets the target latents and negative prompt, its rows are all target rows
+    for batch_size, shared in [(1, False), (2, False), (1, True), (2, True)]:
+        tgt_latents = torch.randn(batch_size, 4, 8, 8)
+        src_latents = tgt_latents if shared else torch.randn(batch_size, 4, 8, 8)
+        image_cond = torch.randn(batch_size, 4, 8, 8)
+        image_cond_latents = torch.cat([image_cond, image_cond, torch.zeros_like(image_cond)])
+        # [positive, negative, negative]
+        tgt_text_embeddings = torch.randn(3, 5, 16)
+        tgt_text_embeddings[2] = tgt_text_embeddings[1]
+        src_text_embeddings = torch.randn(3, 5, 16)
+        src_text_embeddings[1:] = tgt_text_embeddings[1:] if shared else src_text_embeddings[1]
+        noise = torch.randn(batch_size, 4, 8, 8)
+        t = torch.randint(20, 980, (batch_size,))
+        args = (tgt_latents, src_latents, tgt_text_embeddings, src_text_embeddings, image_cond_latents, noise, t)
+        tiny.unet.rows = 0
+        eps = tiny.predict_dds_noise(*args, shared_uncond=shared)
+        assert tiny.unet.rows == (3 if shared else 5) * batch_size
+        with torch.no_grad():
+            reference = explicit_dds_noise(*args)
+        for name in ["target", "source"]:
+            assert torch.allclose(eps[name], reference[name], atol=1e-5), (batch_size, shared, name)
+    print("predict_dds_noise matches two explicit 3-way CFG passes")
+
     cfg = load_config("configs/debugging/instructpix2pix.yaml")
     guidance = threestudio.find(cfg.system.guidance_type)(cfg.system.guidance)
     prompt_processor = threestudio.find(cfg.system.prompt_processor_type)(
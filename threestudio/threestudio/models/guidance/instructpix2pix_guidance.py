@@ -12,6 +12,7 @@ import threestudio
 from threestudio.models.prompt_processors.base import PromptProcessorOutput
 from threestudio.utils.base import BaseObject
 from threestudio.utils.misc import C, parse_version
+from threestudio.utils.truncated_schedule import TruncatedSchedulerCache
 from threestudio.utils.typing import *
 
 
@@ -70,6 +71,9 @@ class InstructPix2PixGuidance(BaseObject):
             cache_dir=self.cfg.cache_dir,
         )
         self.scheduler.set_timesteps(self.cfg.diffusion_steps)
+        self.truncated_schedulers = TruncatedSchedulerCache(
+            self.scheduler, self.cfg.diffusion_steps
+        )
 
         if self.cfg.enable_memory_efficient_attention:
             if parse_version(torch.__version__) >= parse_version("2"):
@@ -170,15 +174,16 @@ class InstructPix2PixGuidance(BaseObject):
         image_cond_latents: Float[Tensor, "B 4 DH DW"],
         t: Int[Tensor, "B"],
     ) -> Float[Tensor, "B 4 DH DW"]:
-        self.scheduler.config.num_train_timesteps = t.item()
-        self.scheduler.set_timesteps(self.cfg.diffusion_steps)
+        # denoise over [0, t] with a cached truncated copy of the schedule, self.scheduler stays untouched,
+        # the views of a batch are edited together and share t[0]
+        scheduler = self.truncated_schedulers[t[0].item()]
         with torch.no_grad():
             # add noise
             noise = torch.randn_like(latents)
             latents = self.scheduler.add_noise(latents, noise, t)  # type: ignore
             threestudio.debug("Start editing...")
             # sections of code used from https://github.com/huggingface/diffusers/blob/main/src/diffusers/pipelines/stable_diffusion/pipeline_stable_diffusion_instruct_pix2pix.py
-            for i, t in enumerate(self.scheduler.timesteps):
+            for i, t in enumerate(scheduler.timesteps):
                 # predict the noise residual with unet, NO grad!
                 with torch.no_grad():
                     # pred noise
@@ -202,7 +207,7 @@ class InstructPix2PixGuidance(BaseObject):
                 )
 
                 # get previous sample, continue loop
-                latents = self.scheduler.step(noise_pred, t, latents).prev_sample
+                latents = scheduler.step(noise_pred, t, latents).prev_sample
             threestudio.debug("Editing finished.")
         return latents
 
@@ -273,6 +278,8 @@ class InstructPix2PixGuidance(BaseObject):
         text_embeddings = torch.cat(
             [text_embeddings, text_embeddings[-1:]], dim=0
         )  # [positive, negative, negative]
+        # one row per view in each branch, matching torch.cat([latents] * 3)
+        text_embeddings = text_embeddings.repeat_interleave(batch_size, dim=0)
 
         # timestep ~ U(0.02, 0.98) to avoid very high/low noise level
         t = torch.randint(
@@ -297,6 +304,7 @@ class InstructPix2PixGuidance(BaseObject):
                 "max_step": self.max_step,
             }
         else:
+            t = t[:1].expand(batch_size)
             edit_latents = self.edit_latents(text_embeddings, latents, cond_latents, t)
             edit_images = self.decode_latents(edit_latents)
             edit_images = F.interpolate(edit_images, (H, W), mode="bilinear")
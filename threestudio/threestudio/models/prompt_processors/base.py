@@ -1,7 +1,9 @@
+import fcntl
 import json
 import os
 from dataclasses import dataclass, field
 
+import numpy as np
 import torch
 import torch.multiprocessing as mp
 import torch.nn as nn
@@ -23,6 +25,82 @@ def hash_prompt(model: str, prompt: str) -> str:
     return hashlib.md5(identifier.encode()).hexdigest()
 
 
+def encode_into_queue(encode_func, pretrained_model_name_or_path, prompts, queue) -> None:
+    # process target returning the embeddings of uncached prompts to the parent
+    queue.put(encode_func(pretrained_model_name_or_path, prompts).numpy())
+
+
+class PromptEmbeddingStore:
+    """
+    Text embeddings of all models and prompts in one file: the raw tensors are appended to `embeddings.bin`
+    and `embeddings.json` maps hash_prompt(model, prompt) to their offset, size, dtype and shape.
+    Reads are memory-mapped and only copy the requested embeddings.
+    """
+
+    def __init__(self, cache_dir: str):
+        self.cache_dir = cache_dir
+        self.data_path = os.path.join(cache_dir, "embeddings.bin")
+        self.index_path = os.path.join(cache_dir, "embeddings.json")
+        self.lock_path = os.path.join(cache_dir, "embeddings.lock")
+        self._index = None
+        self._data = None
+
+    @property
+    def index(self) -> Dict[str, Dict[str, Any]]:
+        if self._index is None:
+            self.reload()
+        return self._index
+
+    def reload(self) -> None:
+        # pick up the embeddings added by other processes since the last read
+        self._index = {}
+        if os.path.exists(self.index_path):
+            with open(self.index_path, "r") as f:
+                self._index = json.load(f)
+        self._data = None
+
+    def __contains__(self, key: str) -> bool:
+        return key in self.index
+
+    def get(self, key: str, device: Optional[torch.device] = None) -> Tensor:
+        entry = self.index[key]
+        end = entry["offset"] + entry["nbytes"]
+        if self._data is None or self._data.shape[0] < end:
+            self._data = np.memmap(self.data_path, dtype=np.uint8, mode="r")
+        embedding = torch.frombuffer(
+            bytearray(self._data[entry["offset"] : end]),
+            dtype=getattr(torch, entry["dtype"]),
+        ).reshape(entry["shape"])
+        return embedding.to(device)
+
+    def add(self, keys: List[str], embeddings: Float[Tensor, "B ..."]) -> None:
+        os.makedirs(self.cache_dir, exist_ok=True)
+        embeddings = embeddings.detach().cpu().contiguous()
+        dtype = str(embeddings.dtype).replace("torch.", "")
+        # other jobs may add to the same store: the reload, the append and the index replace happen under one
+        # exclusive lock, so the offsets come from the current end of the data and no entry of theirs is dropped
+        with open(self.lock_path, "w") as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            self.reload()
+            # the index is replaced after the data is appended, so an interrupted write is a miss
+            with open(self.data_path, "ab") as f:
+                offset = f.seek(0, os.SEEK_END)
+                for key, embedding in zip(keys, embeddings):
+                    data = embedding.reshape(-1).view(torch.uint8).numpy().tobytes()
+                    f.write(data)
+                    self._index[key] = {
+                        "offset": offset,
+                        "nbytes": len(data),
+                        "dtype": dtype,
+                        "shape": list(embedding.shape),
+                    }
+                    offset += len(data)
+            with open(self.index_path + ".tmp", "w") as f:
+                json.dump(self._index, f)
+            os.replace(self.index_path + ".tmp", self.index_path)
+        self._data = None
+
+
 @dataclass
 class DirectionConfig:
     name: str
@@ -38,8 +116,8 @@ class DirectionConfig:
 class PromptProcessorOutput:
     text_embeddings: Float[Tensor, "N Nf"]
     uncond_text_embeddings: Float[Tensor, "N Nf"]
-    text_embeddings_vd: Float[Tensor, "Nv N Nf"]
-    uncond_text_embeddings_vd: Float[Tensor, "Nv N Nf"]
+    text_embeddings_vd: Optional[Float[Tensor, "Nv N Nf"]]
+    uncond_text_embeddings_vd: Optional[Float[Tensor, "Nv N Nf"]]
     directions: List[DirectionConfig]
     direction2idx: Dict[str, int]
     use_perp_neg: bool
@@ -47,6 +125,20 @@ class PromptProcessorOutput:
     perp_neg_f_fsb: Tuple[float, float, float]
     perp_neg_f_fs: Tuple[float, float, float]
     perp_neg_f_sf: Tuple[float, float, float]
+    # loads the view-dependent embeddings on first use when the processor left them out (lazy_view_dependent)
+    load_text_embeddings_vd: Optional[
+        Callable[[], Tuple[Float[Tensor, "Nv N Nf"], Float[Tensor, "Nv N Nf"]]]
+    ] = None
+
+    def get_text_embeddings_vd(
+        self,
+    ) -> Tuple[Float[Tensor, "Nv N Nf"], Float[Tensor, "Nv N Nf"]]:
+        if self.text_embeddings_vd is None:
+            (
+                self.text_embeddings_vd,
+                self.uncond_text_embeddings_vd,
+            ) = self.load_text_embeddings_vd()
+        return self.text_embeddings_vd, self.uncond_text_embeddings_vd
 
     def get_text_embeddings(
         self,
@@ -58,6 +150,7 @@ class PromptProcessorOutput:
         batch_size = elevation.shape[0]
 
         if view_dependent_prompting:
+            text_embeddings_vd, uncond_text_embeddings_vd = self.get_text_embeddings_vd()
             # Get direction
             direction_idx = torch.zeros_like(elevation, dtype=torch.long)
             for d in self.directions:
@@ -66,8 +159,8 @@ class PromptProcessorOutput:
                 ] = self.direction2idx[d.name]
 
             # Get text embeddings
-            text_embeddings = self.text_embeddings_vd[direction_idx]  # type: ignore
-            uncond_text_embeddings = self.uncond_text_embeddings_vd[direction_idx]  # type: ignore
+            text_embeddings = text_embeddings_vd[direction_idx]  # type: ignore
+            uncond_text_embeddings = uncond_text_embeddings_vd[direction_idx]  # type: ignore
         else:
             text_embeddings = self.text_embeddings.expand(batch_size, -1, -1)  # type: ignore
             uncond_text_embeddings = self.uncond_text_embeddings.expand(  # type: ignore
@@ -89,6 +182,7 @@ class PromptProcessorOutput:
         ), "Perp-Neg only works with view-dependent prompting"
 
         batch_size = elevation.shape[0]
+        text_embeddings_vd, uncond_text_embeddings_vd = self.get_text_embeddings_vd()
 
         direction_idx = torch.zeros_like(elevation, dtype=torch.long)
         for d in self.directions:
@@ -105,24 +199,24 @@ class PromptProcessorOutput:
         neg_guidance_weights = []
         uncond_text_embeddings = []
 
-        side_emb = self.text_embeddings_vd[0]
-        front_emb = self.text_embeddings_vd[1]
-        back_emb = self.text_embeddings_vd[2]
-        overhead_emb = self.text_embeddings_vd[3]
+        side_emb = text_embeddings_vd[0]
+        front_emb = text_embeddings_vd[1]
+        back_emb = text_embeddings_vd[2]
+        overhead_emb = text_embeddings_vd[3]
 
         for idx, ele, azi, dis in zip(
             direction_idx, elevation, azimuth, camera_distances
         ):
             azi = shift_azimuth_deg(azi)  # to (-180, 180)
             uncond_text_embeddings.append(
-                self.uncond_text_embeddings_vd[idx]
+                uncond_text_embeddings_vd[idx]
             )  # should be ""
             if idx.item() == 3:  # overhead view
                 pos_text_embeddings.append(overhead_emb)  # side view
                 # dummy
                 neg_text_embeddings += [
-                    self.uncond_text_embeddings_vd[idx],
-                    self.uncond_text_embeddings_vd[idx],
+                    uncond_text_embeddings_vd[idx],
+                    uncond_text_embeddings_vd[idx],
                 ]
                 neg_guidance_weights += [0.0, 0.0]
             else:  # interpolating views
@@ -210,8 +304,18 @@ class PromptProcessor(BaseObject):
         # index of words that can potentially be removed
         prompt_debiasing_mask_ids: Optional[List[int]] = None
 
+        # build the view-dependent (and debiased) prompts and embeddings on first use only, for guidances
+        # that never use view-dependent prompting such as the editing ones
+        lazy_view_dependent: bool = False
+
     cfg: Config
 
+    # prompts registered by all processors and not encoded yet, per spawn_func, model and cache directory. The
+    # first processor that needs its embeddings encodes them all, with a single text encoder load
+    _pending_prompts: Dict[Tuple[Callable, str, str], Dict[str, None]] = {}
+    # load/prompt_library.json, parsed once per process on the first "lib:" prompt
+    _prompt_library: Optional[Dict[str, List[str]]] = None
+
     @rank_zero_only
     def configure_text_encoder(self) -> None:
         raise NotImplementedError
@@ -294,8 +398,6 @@ class PromptProcessor(BaseObject):
 
         self.direction2idx = {d.name: i for i, d in enumerate(self.directions)}
 
-        with open(os.path.join("load/prompt_library.json"), "r") as f:
-            self.prompt_library = json.load(f)
         # use provided prompt or find prompt in library
         self.prompt = self.preprocess_prompt(self.cfg.prompt)
         # use provided negative prompt
@@ -305,6 +407,28 @@ class PromptProcessor(BaseObject):
             f"Using prompt [{self.prompt}] and negative prompt [{self.negative_prompt}]"
         )
 
+        self.prompts_vd: Optional[List[str]] = None
+        self.negative_prompts_vd: Optional[List[str]] = None
+        self.text_embeddings_vd = None
+        self.uncond_text_embeddings_vd = None
+        if not self.cfg.lazy_view_dependent:
+            self.prepare_prompts_vd()
+
+        self.store = PromptEmbeddingStore(self._cache_dir)
+        # with use_cache off, prompt -> embedding encoded by this processor, never written to the store
+        self._uncached_embeddings: Dict[str, Tensor] = {}
+        self._embeddings_loaded = False
+        # the embeddings are encoded and loaded on the first call, together with those of the other processors
+        self.prepare_text_embeddings()
+
+    @property
+    def prompt_library(self) -> Dict[str, List[str]]:
+        if PromptProcessor._prompt_library is None:
+            with open(os.path.join("load/prompt_library.json"), "r") as f:
+                PromptProcessor._prompt_library = json.load(f)
+        return PromptProcessor._prompt_library
+
+    def prepare_prompts_vd(self) -> None:
         # view-dependent prompting
         if self.cfg.use_prompt_debiasing:
             assert (
@@ -334,39 +458,55 @@ class PromptProcessor(BaseObject):
             d.negative_prompt(self.negative_prompt) for d in self.directions
         ]
 
-        self.prepare_text_embeddings()
-        self.load_text_embeddings()
+    @staticmethod
+    def encode_prompts(pretrained_model_name_or_path, prompts) -> Float[Tensor, "B N Nf"]:
+        raise NotImplementedError
 
     @staticmethod
     def spawn_func(pretrained_model_name_or_path, prompts, cache_dir):
         raise NotImplementedError
 
+    @property
+    def _pending_key(self) -> Tuple[Callable, str, str]:
+        return (self.spawn_func, self.cfg.pretrained_model_name_or_path, self._cache_dir)
+
     @rank_zero_only
-    def prepare_text_embeddings(self):
+    def prepare_text_embeddings(self, prompts: Optional[List[str]] = None):
+        if not self.cfg.use_cache:
+            # encoded on every rank by encode_uncached_prompts when loaded, the store is left untouched
+            return
         os.makedirs(self._cache_dir, exist_ok=True)
 
-        all_prompts = (
-            [self.prompt]
-            + [self.negative_prompt]
-            + self.prompts_vd
-            + self.negative_prompts_vd
-        )
-        prompts_to_process = []
+        if prompts is not None:
+            all_prompts = prompts
+        elif self.prompts_vd is not None:
+            all_prompts = (
+                [self.prompt]
+                + [self.negative_prompt]
+                + self.prompts_vd
+                + self.negative_prompts_vd
+            )
+        else:
+            all_prompts = [self.prompt] + [self.negative_prompt]
+        pending = self._pending_prompts.setdefault(self._pending_key, {})
         for prompt in all_prompts:
-            if self.cfg.use_cache:
-                # some text embeddings are already in cache
-                # do not process them
-                cache_path = os.path.join(
-                    self._cache_dir,
-                    f"{hash_prompt(self.cfg.pretrained_model_name_or_path, prompt)}.pt",
+            key = hash_prompt(self.cfg.pretrained_model_name_or_path, prompt)
+            # embeddings of older caches, one .pt file per prompt, are moved to the store
+            legacy_path = os.path.join(self._cache_dir, f"{key}.pt")
+            if key not in self.store and os.path.exists(legacy_path):
+                self.store.add([key], torch.load(legacy_path, map_location="cpu")[None])
+            # some text embeddings are already in cache
+            # do not process them
+            if key in self.store:
+                threestudio.debug(
+                    f"Text embeddings for model {self.cfg.pretrained_model_name_or_path} and prompt [{prompt}] are already in cache, skip processing."
                 )
-                if os.path.exists(cache_path):
-                    threestudio.debug(
-                        f"Text embeddings for model {self.cfg.pretrained_model_name_or_path} and prompt [{prompt}] are already in cache, skip processing."
-                    )
-                    continue
-            prompts_to_process.append(prompt)
+                continue
+            pending[prompt] = None
 
+    @rank_zero_only
+    def encode_pending_prompts(self):
+        prompts_to_process = list(self._pending_prompts.pop(self._pending_key, {}))
         if len(prompts_to_process) > 0:
             if self.cfg.spawn:
                 ctx = mp.get_context("spawn")
@@ -388,31 +528,73 @@ class PromptProcessor(BaseObject):
                 )
             cleanup()
 
+    def encode_uncached_prompts(self, prompts: List[str]) -> None:
+        prompts = [
+            prompt for prompt in dict.fromkeys(prompts) if prompt not in self._uncached_embeddings
+        ]
+        if len(prompts) == 0:
+            return
+        if self.cfg.spawn:
+            ctx = mp.get_context("spawn")
+            queue = ctx.Queue()
+            subprocess = ctx.Process(
+                target=encode_into_queue,
+                args=(self.encode_prompts, self.cfg.pretrained_model_name_or_path, prompts, queue),
+            )
+            subprocess.start()
+            embeddings = torch.from_numpy(queue.get())
+            subprocess.join()
+        else:
+            embeddings = self.encode_prompts(self.cfg.pretrained_model_name_or_path, prompts)
+        cleanup()
+        for prompt, embedding in zip(prompts, embeddings):
+            self._uncached_embeddings[prompt] = embedding
+
     def load_text_embeddings(self):
+        if not self.cfg.use_cache:
+            self.encode_uncached_prompts([self.prompt, self.negative_prompt])
+        self.encode_pending_prompts()
         # synchronize, to ensure the text embeddings have been computed and saved to cache
         barrier()
+        self.store.reload()
         self.text_embeddings = self.load_from_cache(self.prompt)[None, ...]
         self.uncond_text_embeddings = self.load_from_cache(self.negative_prompt)[
             None, ...
         ]
+        if self.prompts_vd is not None:
+            self.load_text_embeddings_vd()
+        self._embeddings_loaded = True
+        threestudio.debug(f"Loaded text embeddings.")
+
+    def load_text_embeddings_vd(
+        self,
+    ) -> Tuple[Float[Tensor, "Nv N Nf"], Float[Tensor, "Nv N Nf"]]:
+        if self.prompts_vd is None:
+            # first use with lazy_view_dependent
+            self.prepare_prompts_vd()
+            self.prepare_text_embeddings(self.prompts_vd + self.negative_prompts_vd)
+            self.encode_pending_prompts()
+            barrier()
+            self.store.reload()
+        if not self.cfg.use_cache:
+            self.encode_uncached_prompts(self.prompts_vd + self.negative_prompts_vd)
         self.text_embeddings_vd = torch.stack(
             [self.load_from_cache(prompt) for prompt in self.prompts_vd], dim=0
         )
         self.uncond_text_embeddings_vd = torch.stack(
             [self.load_from_cache(prompt) for prompt in self.negative_prompts_vd], dim=0
         )
-        threestudio.debug(f"Loaded text embeddings.")
+        return self.text_embeddings_vd, self.uncond_text_embeddings_vd
 
     def load_from_cache(self, prompt):
-        cache_path = os.path.join(
-            self._cache_dir,
-            f"{hash_prompt(self.cfg.pretrained_model_name_or_path, prompt)}.pt",
-        )
-        if not os.path.exists(cache_path):
+        if not self.cfg.use_cache:
+            return self._uncached_embeddings[prompt].to(self.device)
+        key = hash_prompt(self.cfg.pretrained_model_name_or_path, prompt)
+        if key not in self.store:
             raise FileNotFoundError(
-                f"Text embedding file {cache_path} for model {self.cfg.pretrained_model_name_or_path} and prompt [{prompt}] not found."
+                f"Text embedding {key} for model {self.cfg.pretrained_model_name_or_path} and prompt [{prompt}] not found in {self.store.index_path}."
             )
-        return torch.load(cache_path, map_location=self.device)
+        return self.store.get(key, self.device)
 
     def preprocess_prompt(self, prompt: str) -> str:
         if prompt.startswith("lib:"):
@@ -501,6 +683,8 @@ class PromptProcessor(BaseObject):
         return debiased_prompts
 
     def __call__(self) -> PromptProcessorOutput:
+        if not self._embeddings_loaded:
+            self.load_text_embeddings()
         return PromptProcessorOutput(
             text_embeddings=self.text_embeddings,
             uncond_text_embeddings=self.uncond_text_embeddings,
@@ -513,4 +697,5 @@ class PromptProcessor(BaseObject):
             perp_neg_f_fsb=self.cfg.perp_neg_f_fsb,
             perp_neg_f_fs=self.cfg.perp_neg_f_fs,
             perp_neg_f_sf=self.cfg.perp_neg_f_sf,
+            load_text_embeddings_vd=self.load_text_embeddings_vd,
         )
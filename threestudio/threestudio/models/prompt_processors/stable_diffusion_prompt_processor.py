@@ -7,7 +7,11 @@ import torch.nn as nn
 from transformers import AutoTokenizer, CLIPTextModel
 
 import threestudio
-from threestudio.models.prompt_processors.base import PromptProcessor, hash_prompt
+from threestudio.models.prompt_processors.base import (
+    PromptEmbeddingStore,
+    PromptProcessor,
+    hash_prompt,
+)
 from threestudio.utils.misc import cleanup
 from threestudio.utils.typing import *
 
@@ -70,7 +74,7 @@ class StableDiffusionPromptProcessor(PromptProcessor):
     ###
 
     @staticmethod
-    def spawn_func(pretrained_model_name_or_path, prompts, cache_dir):
+    def encode_prompts(pretrained_model_name_or_path, prompts):
         os.environ["TOKENIZERS_PARALLELISM"] = "false"
         tokenizer = AutoTokenizer.from_pretrained(
             pretrained_model_name_or_path, subfolder="tokenizer"
@@ -90,13 +94,15 @@ class StableDiffusionPromptProcessor(PromptProcessor):
             )
             text_embeddings = text_encoder(tokens.input_ids.to(text_encoder.device))[0]
 
-        for prompt, embedding in zip(prompts, text_embeddings):
-            torch.save(
-                embedding,
-                os.path.join(
-                    cache_dir,
-                    f"{hash_prompt(pretrained_model_name_or_path, prompt)}.pt",
-                ),
-            )
-
         del text_encoder
+        return text_embeddings.cpu()
+
+    @staticmethod
+    def spawn_func(pretrained_model_name_or_path, prompts, cache_dir):
+        text_embeddings = StableDiffusionPromptProcessor.encode_prompts(
+            pretrained_model_name_or_path, prompts
+        )
+        PromptEmbeddingStore(cache_dir).add(
+            [hash_prompt(pretrained_model_name_or_path, prompt) for prompt in prompts],
+            text_embeddings,
+        )
@@ -1,3 +1,4 @@
+from concurrent.futures import ThreadPoolExecutor
 from dataclasses import dataclass, field
 
 from PIL import Image
@@ -12,7 +13,7 @@ import os
 from threestudio.systems.base import BaseLift3DSystem
 
 from threestudio.utils.typing import *
-from gaussiansplatting.gaussian_renderer import render
+from gaussiansplatting.gaussian_renderer import render, render_batch, frustum_cull
 from gaussiansplatting.scene import GaussianModel
 
 from gaussiansplatting.arguments import (
@@ -25,6 +26,7 @@ from argparse import ArgumentParser
 from threestudio.utils.misc import get_device
 from threestudio.utils.perceptual import PerceptualLoss
 from threestudio.utils.sam import LangSAMTextSegmentor
+from threestudio.utils.frame_cache import FrameCache, FrameStore, frames_to_uint8
 
 
 class GaussianEditor(BaseLift3DSystem):
@@ -54,10 +56,28 @@ class GaussianEditor(BaseLift3DSystem):
         min_opacity: float = 0.005
 
         seg_prompt: str = ""
+        # views segmented together by LangSAM during mask extraction
+        seg_batch_size: int = 8
+        # update only the masked Gaussians in the optimizer instead of masking their gradients with hooks. Same
+        # result while the mask is fixed; when it changes, Gaussians leaving it are frozen at once, whereas with
+        # hooks their Adam momentum keeps moving them for a while
+        masked_optimizer: bool = False
+        # rasterize only the Gaussians whose centers are in the view frustum
+        frustum_cull: bool = False
+        # local edits: composite the masked Gaussians over a cached render of the frozen unmasked ones
+        local_background: bool = False
 
         # cache
         cache_overwrite: bool = True
         cache_dir: str = ""
+        # also write the cached frames and masks as PNGs, for inspection only
+        cache_png: bool = False
+        # storage of origin_frames and edit_frames ("uint8", "float16" or "float32"), optionally on pinned host
+        # memory, with the given number of recently read frames kept on the device in float32
+        origin_frames_dtype: str = "uint8"
+        edit_frames_dtype: str = "float16"
+        frames_on_host: bool = False
+        frames_device_cache: int = 8
 
         # anchor
         anchor_weight_init: float = 0.1
@@ -73,15 +93,30 @@ class GaussianEditor(BaseLift3DSystem):
             anchor_weight_init_g0=self.cfg.anchor_weight_init_g0,
             anchor_weight_init=self.cfg.anchor_weight_init,
             anchor_weight_multiplier=self.cfg.anchor_weight_multiplier,
+            masked_optimizer=self.cfg.masked_optimizer,
         )
         bg_color = [1, 1, 1] if False else [0, 0, 0]
         self.background_tensor = torch.tensor(
             bg_color, dtype=torch.float32, device="cuda"
         )
-        self.edit_frames = {}
-        self.origin_frames = {}
+        self.edit_frames = FrameStore(
+            self.cfg.edit_frames_dtype,
+            get_device(),
+            self.cfg.frames_on_host,
+            self.cfg.frames_device_cache,
+        )
+        self.origin_frames = FrameStore(
+            self.cfg.origin_frames_dtype,
+            get_device(),
+            self.cfg.frames_on_host,
+            self.cfg.frames_device_cache,
+        )
+        self.background_cache = {}
+        self._mask_color = None
         self.perceptual_loss = PerceptualLoss().eval().to(get_device())
-        self.text_segmentor = LangSAMTextSegmentor().to(get_device())
+        self.text_segmentor = LangSAMTextSegmentor(
+            batch_size=self.cfg.seg_batch_size
+        ).to(get_device())
 
     @torch.no_grad()
     def update_mask(self, save_name="mask") -> None:
@@ -91,45 +126,53 @@ class GaussianEditor(BaseLift3DSystem):
         )
         gs_mask_path = os.path.join(mask_cache_dir, "gs_mask.pt")
         if not os.path.exists(gs_mask_path) or self.cfg.cache_overwrite:
-            if os.path.exists(mask_cache_dir):
-                shutil.rmtree(mask_cache_dir)
-            os.makedirs(mask_cache_dir)
+            view_list = list(self.view_list)
+            mask_cache = FrameCache(mask_cache_dir)
+            # per-view masks of an earlier segmentation, reused when the views, resolution and hashes match
+            cached_masks = None
+            if not self.cfg.cache_overwrite:
+                cached_masks = mask_cache.load(
+                    view_list,
+                    self.trainer.datamodule.train_dataset.height,
+                    self.trainer.datamodule.train_dataset.width,
+                    1,
+                )
+            if cached_masks is None:
+                if os.path.exists(mask_cache_dir):
+                    shutil.rmtree(mask_cache_dir)
+                os.makedirs(mask_cache_dir)
+                threestudio.info(f"Segmentation with prompt: {self.cfg.seg_prompt}")
+            else:
+                threestudio.info(f"Loaded cached segmentation masks from {mask_cache_dir}")
             weights = torch.zeros_like(self.gaussian._opacity)
             weights_cnt = torch.zeros_like(self.gaussian._opacity, dtype=torch.int32)
-            threestudio.info(f"Segmentation with prompt: {self.cfg.seg_prompt}")
-            for id in tqdm(self.view_list):
-                cur_path = os.path.join(mask_cache_dir, "{:0>4d}.png".format(id))
-                cur_path_viz = os.path.join(
-                    mask_cache_dir, "viz_{:0>4d}.png".format(id)
-                )
-
-                cur_cam = self.trainer.datamodule.train_dataset.scene.cameras[id]
-
-                mask = self.text_segmentor(self.origin_frames[id], self.cfg.seg_prompt)[
-                    0
-                ].to(get_device())
-
-                mask_to_save = (
-                        mask[0]
-                        .cpu()
-                        .detach()[..., None]
-                        .repeat(1, 1, 3)
-                        .numpy()
-                        .clip(0.0, 1.0)
-                        * 255.0
-                ).astype(np.uint8)
-                cv2.imwrite(cur_path, mask_to_save)
-
-                masked_image = self.origin_frames[id].detach().clone()[0]
-                masked_image[mask[0].bool()] *= 0.3
-                masked_image_to_save = (
-                        masked_image.cpu().detach().numpy().clip(0.0, 1.0) * 255.0
-                ).astype(np.uint8)
-                masked_image_to_save = cv2.cvtColor(
-                    masked_image_to_save, cv2.COLOR_RGB2BGR
+            cameras = self.trainer.datamodule.train_dataset.scene.cameras
+            batch_size = self.cfg.seg_batch_size
+            masks_to_save = []
+            for start in tqdm(range(0, len(view_list), batch_size)):
+                ids = view_list[start: start + batch_size]
+                if cached_masks is not None:
+                    masks = cached_masks[start: start + batch_size, None, ..., 0].to(get_device()) / 255
+                    self.gaussian.apply_weights_batch(
+                        [cameras[id] for id in ids], weights, weights_cnt, masks
+                    )
+                    continue
+                frames = torch.cat([self.origin_frames[id] for id in ids], dim=0)
+                masks = self.text_segmentor(frames, self.cfg.seg_prompt).to(get_device())
+                masks_to_save.append(frames_to_uint8(masks[:, 0, ..., None]).cpu())
+                if self.cfg.cache_png:
+                    masked_images = torch.where(masks[:, 0, ..., None].bool(), frames * 0.3, frames)
+                    self.save_cache_png(
+                        mask_cache_dir, ids, frames_to_uint8(masked_images), prefix="viz_"
+                    )
+                self.gaussian.apply_weights_batch(
+                    [cameras[id] for id in ids], weights, weights_cnt, masks
                 )
-                cv2.imwrite(cur_path_viz, masked_image_to_save)
-                self.gaussian.apply_weights(cur_cam, weights, weights_cnt, mask)
+            if cached_masks is None:
+                masks_to_save = torch.cat(masks_to_save, dim=0)
+                mask_cache.save(view_list, masks_to_save)
+                if self.cfg.cache_png:
+                    self.save_cache_png(mask_cache_dir, view_list, masks_to_save.repeat(1, 1, 1, 3))
 
             weights /= weights_cnt + 1e-7
 
@@ -138,83 +181,141 @@ class GaussianEditor(BaseLift3DSystem):
             torch.save(selected_mask, gs_mask_path)
         else:
             print("load cache")
-            for id in tqdm(self.view_list):
-                cur_path = os.path.join(mask_cache_dir, "{:0>4d}.png".format(id))
-                cur_mask = cv2.imread(cur_path)
-                cur_mask = torch.tensor(
-                    cur_mask / 255, device="cuda", dtype=torch.float32
-                )[..., 0][None]
             selected_mask = torch.load(gs_mask_path)
 
         self.gaussian.set_mask(selected_mask)
         self.gaussian.apply_grad_mask(selected_mask)
+        self.background_cache = {}
 
     def on_validation_epoch_end(self):
         pass
 
-    def forward(self, batch: Dict[str, Any], renderbackground=None, local=False) -> Dict[str, Any]:
+    def composite_background(self, view_index, cam, image, depth, index, renderbackground):
+        # The unmasked Gaussians are frozen during local edits, so their render is cached per view and the
+        # masked ones are alpha-composited over it. Unmasked Gaussians in front of masked ones are ignored.
+        key = (view_index, int(cam.image_height), int(cam.image_width))
+        if key not in self.background_cache:
+            with torch.no_grad():
+                background_pkg = render(
+                    cam,
+                    self.gaussian,
+                    self.pipe,
+                    renderbackground,
+                    index=(~self.gaussian.mask).nonzero()[:, 0],
+                )
+            self.background_cache[key] = (
+                background_pkg["render"],
+                background_pkg["depth_3dgs"],
+            )
+        background, background_depth = self.background_cache[key]
+
+        alpha = render(
+            cam,
+            self.gaussian,
+            self.pipe,
+            torch.zeros_like(renderbackground),
+            override_color=self.gaussian._opacity.new_ones(1, 3).expand(
+                self.gaussian._opacity.shape[0], 3
+            ),
+            index=index,
+        )["render"][:1]
+        # image already holds (1 - alpha) * renderbackground behind the masked Gaussians
+        image = image + (1 - alpha) * (background - renderbackground[:, None, None])
+        depth = depth + (1 - alpha) * background_depth
+        return image, depth
+
+    @property
+    def mask_color(self):
+        # per Gaussian override color of the semantic render, rebuilt only when the mask changes
+        mask = self.gaussian.mask
+        if (
+                self._mask_color is None
+                or self._mask_color[0] is not mask
+                or self._mask_color[1] != mask._version
+        ):
+            self._mask_color = (mask, mask._version, mask[..., None].float().repeat(1, 3))
+        return self._mask_color[2]
+
+    def forward(
+            self,
+            batch: Dict[str, Any],
+            renderbackground=None,
+            local=False,
+            render_semantic=None,
+    ) -> Dict[str, Any]:
+        # the "semantic" and "masks" outputs cost a second render per camera, by default they are only
+        # produced outside of training
+        if render_semantic is None:
+            render_semantic = not self.training
         if renderbackground is None:
             renderbackground = self.background_tensor
         images = []
         depths = []
         semantics = []
         masks = []
-        self.viewspace_point_list = []
-        self.gaussian.localize = local
-
-        for id, cam in enumerate(batch["camera"]):
-            render_pkg = render(cam, self.gaussian, self.pipe, renderbackground)
-            image, viewspace_point_tensor, _, radii = (
-                render_pkg["render"],
-                render_pkg["viewspace_points"],
-                render_pkg["visibility_filter"],
-                render_pkg["radii"],
-            )
-            self.viewspace_point_list.append(viewspace_point_tensor)
-
-            if id == 0:
-                self.radii = radii
-            else:
-                self.radii = torch.max(radii, self.radii)
-
+        view_indices = batch["index"]
+        if isinstance(view_indices, int):
+            view_indices = [view_indices]
+        cameras = batch["camera"]
+
+        # local edits only rasterize the masked Gaussians, packed by index
+        index = self.gaussian.mask_index if local else None
+        if self.cfg.frustum_cull:
+            index = [frustum_cull(cam, self.gaussian._xyz.detach(), index) for cam in cameras]
+            index = torch.cat(index).unique() if len(index) > 1 else index[0]
+        # the activated attributes are shared by every camera of the batch
+        render_pkgs = render_batch(cameras, self.gaussian, self.pipe, renderbackground, index=index)
+        self.viewspace_points = render_pkgs[0]["viewspace_points"]
+        self.render_index = index
+        self.radii = torch.stack([pkg["radii"] for pkg in render_pkgs]).max(dim=0).values
+        if index is not None:
+            self.radii = torch.zeros(
+                self.gaussian._xyz.shape[0], dtype=self.radii.dtype, device=self.radii.device
+            ).index_copy_(0, index, self.radii)
+
+        for id, (cam, render_pkg) in enumerate(zip(cameras, render_pkgs)):
+            image = render_pkg["render"]
             depth = render_pkg["depth_3dgs"]
+            if local and self.cfg.local_background:
+                image, depth = self.composite_background(
+                    int(view_indices[id]), cam, image, depth, index, renderbackground
+                )
             depth = depth.permute(1, 2, 0)
 
-            semantic_map = render(
-                cam,
-                self.gaussian,
-                self.pipe,
-                renderbackground,
-                override_color=self.gaussian.mask[..., None].float().repeat(1, 3),
-            )["render"]
-            semantic_map = torch.norm(semantic_map, dim=0)
-            semantic_map = semantic_map > 0.8
-            semantic_map_viz = image.detach().clone()
-            semantic_map_viz = semantic_map_viz.permute(
-                1, 2, 0
-            )  # 3 512 512 to 512 512 3
-            semantic_map_viz[semantic_map] = 0.40 * semantic_map_viz[
-                semantic_map
-            ] + 0.60 * torch.tensor([1.0, 0.0, 0.0], device="cuda")
-            semantic_map_viz = semantic_map_viz.permute(
-                2, 0, 1
-            )  # 512 512 3 to 3 512 512
-
-            semantics.append(semantic_map_viz)
-            masks.append(semantic_map)
+            if render_semantic:
+                with torch.no_grad():
+                    semantic_map = render(
+                        cam,
+                        self.gaussian,
+                        self.pipe,
+                        renderbackground,
+                        override_color=self.mask_color,
+                        index=index,
+                    )["render"]
+                semantic_map = torch.norm(semantic_map, dim=0)
+                semantic_map = semantic_map > 0.8
+                semantic_map_viz = image.detach().clone()
+                semantic_map_viz = semantic_map_viz.permute(
+                    1, 2, 0
+                )  # 3 512 512 to 512 512 3
+                semantic_map_viz[semantic_map] = 0.40 * semantic_map_viz[
+                    semantic_map
+                ] + 0.60 * torch.tensor([1.0, 0.0, 0.0], device="cuda")
+                semantic_map_viz = semantic_map_viz.permute(
+                    2, 0, 1
+                )  # 512 512 3 to 3 512 512
+
+                semantics.append(semantic_map_viz)
+                masks.append(semantic_map)
             image = image.permute(1, 2, 0)
             images.append(image)
             depths.append(depth)
 
-        self.gaussian.localize = False  # reverse
-
         images = torch.stack(images, 0)
         depths = torch.stack(depths, 0)
-        semantics = torch.stack(semantics, dim=0)
-        masks = torch.stack(masks, dim=0)
-
-        render_pkg["semantic"] = semantics
-        render_pkg["masks"] = masks
+        if render_semantic:
+            render_pkg["semantic"] = torch.stack(semantics, dim=0)
+            render_pkg["masks"] = torch.stack(masks, dim=0)
         self.visibility_filter = self.radii > 0.0
         render_pkg["comp_rgb"] = images
         render_pkg["depth"] = depths
@@ -224,41 +325,54 @@ class GaussianEditor(BaseLift3DSystem):
         }
 
     def render_all_view(self, cache_name):
-        cache_dir = os.path.join(self.cache_dir, cache_name)
-        os.makedirs(cache_dir, exist_ok=True)
-        with torch.no_grad():
-            for id in tqdm(self.view_list):
-                cur_path = os.path.join(cache_dir, "{:0>4d}.png".format(id))
-                if not os.path.exists(cur_path) or self.cfg.cache_overwrite:
+        cache = FrameCache(os.path.join(self.cache_dir, cache_name))
+        height = self.trainer.datamodule.train_dataset.height
+        width = self.trainer.datamodule.train_dataset.width
+        view_list = list(self.view_list)
+        frames = None
+        if not self.cfg.cache_overwrite:
+            frames = cache.load(view_list, height, width, 3)
+        if frames is None:
+            frames = []
+            with torch.no_grad():
+                for id in tqdm(view_list):
                     cur_cam = self.trainer.datamodule.train_dataset.scene.cameras[id]
                     cur_batch = {
                         "index": id,
                         "camera": [cur_cam],
-                        "height": self.trainer.datamodule.train_dataset.height,
-                        "width": self.trainer.datamodule.train_dataset.width,
+                        "height": height,
+                        "width": width,
                     }
-                    out = self(cur_batch)["comp_rgb"]
-                    out_to_save = (
-                            out[0].cpu().detach().numpy().clip(0.0, 1.0) * 255.0
-                    ).astype(np.uint8)
-                    out_to_save = cv2.cvtColor(out_to_save, cv2.COLOR_RGB2BGR)
-                    cv2.imwrite(cur_path, out_to_save)
-                cached_image = cv2.cvtColor(cv2.imread(cur_path), cv2.COLOR_BGR2RGB)
-                self.origin_frames[id] = torch.tensor(
-                    cached_image / 255, device="cuda", dtype=torch.float32
-                )[None]
+                    frames.append(frames_to_uint8(self(cur_batch)["comp_rgb"][0]))
+            frames = torch.stack(frames, dim=0).cpu()
+            cache.save(view_list, frames)
+            if self.cfg.cache_png:
+                self.save_cache_png(cache.cache_dir, view_list, frames)
+        for i, id in enumerate(view_list):
+            self.origin_frames[id] = frames[i][None]
+
+    def save_cache_png(self, cache_dir, view_list, frames, prefix=""):
+        # debug copies of the uint8 (V, H, W, C) frames of a FrameCache
+        frames = frames.cpu().numpy()
+        if frames.shape[-1] == 3:
+            frames = frames[..., ::-1]
+        with ThreadPoolExecutor(max_workers=4) as writer:
+            for id, frame in zip(view_list, frames):
+                writer.submit(
+                    cv2.imwrite,
+                    os.path.join(cache_dir, prefix + "{:0>4d}.png".format(id)),
+                    np.ascontiguousarray(frame),
+                )
 
     def on_before_optimizer_step(self, optimizer):
         with torch.no_grad():
             if self.true_global_step < self.cfg.densify_until_iter:
-                viewspace_point_tensor_grad = torch.zeros_like(
-                    self.viewspace_point_list[0]
-                )
-                for idx in range(len(self.viewspace_point_list)):
-                    viewspace_point_tensor_grad = (
-                            viewspace_point_tensor_grad
-                            + self.viewspace_point_list[idx].grad
-                    )
+                # summed over the cameras of the batch, packed renders scatter back to the rendered Gaussians
+                viewspace_point_tensor_grad = self.viewspace_points.grad.sum(dim=0)
+                if self.render_index is not None:
+                    viewspace_point_tensor_grad = torch.zeros_like(
+                        self.gaussian._xyz
+                    ).index_add_(0, self.render_index, viewspace_point_tensor_grad)
                 # Keep track of max radii in image-space for pruning
                 self.gaussian.max_radii2D[self.visibility_filter] = torch.max(
                     self.gaussian.max_radii2D[self.visibility_filter],
@@ -354,7 +468,7 @@ class GaussianEditor(BaseLift3DSystem):
             bg_color, dtype=torch.float32, device="cuda"
         )
 
-        out = self(batch, testbackground_tensor)
+        out = self(batch, testbackground_tensor, render_semantic=False)
         if only_rgb:
             self.save_image_grid(
                 f"it{self.true_global_step}-test/{batch['index'][0]}.png",
@@ -7,7 +7,8 @@ import torch
 import threestudio
 import os
 
-from threestudio.utils.misc import dilate_mask, fill_closed_areas
+from threestudio.utils.misc import dilate_mask, fill_closed_areas, get_device
+from threestudio.utils.frame_cache import FrameCache, frames_to_uint8
 from threestudio.systems.GassuianEditor import GaussianEditor
 
 
@@ -129,32 +130,37 @@ class GaussianEditor_Del(GaussianEditor):
             )[None]
 
     def render_all_view_with_mask(self, cache_name):
-        cache_dir = os.path.join(self.cache_dir, cache_name)
-        os.makedirs(cache_dir, exist_ok=True)
-        with torch.no_grad():
-            for id in tqdm(self.view_list):
-                cur_path = os.path.join(cache_dir, "{:0>4d}.png".format(id))
-                if not os.path.exists(cur_path) or self.cfg.cache_overwrite:
+        cache = FrameCache(os.path.join(self.cache_dir, cache_name))
+        height = self.trainer.datamodule.train_dataset.height
+        width = self.trainer.datamodule.train_dataset.width
+        view_list = list(self.view_list)
+        masks = None
+        if not self.cfg.cache_overwrite:
+            masks = cache.load(view_list, height, width, 1)
+        if masks is None:
+            masks = []
+            with torch.no_grad():
+                for id in tqdm(view_list):
                     cur_cam = self.trainer.datamodule.train_dataset.scene.cameras[id]
                     cur_batch = {
                         "index": id,
                         "camera": [cur_cam],
-                        "height": self.trainer.datamodule.train_dataset.height,
-                        "width": self.trainer.datamodule.train_dataset.width,
+                        "height": height,
+                        "width": width,
                     }
-                    out = self(cur_batch)["masks"]
+                    out = self(cur_batch, render_semantic=True)["masks"]
                     out = dilate_mask(out.to(torch.float32), self.cfg.mask_dilate)
                     if self.cfg.fix_holes:
                         out = fill_closed_areas(out)
-                    out_to_save = (
-                            out[0].cpu().detach().numpy().clip(0.0, 1.0) * 255.0
-                    ).astype(np.uint8)
-                    out_to_save = cv2.cvtColor(out_to_save, cv2.COLOR_RGB2BGR)
-                    cv2.imwrite(cur_path, out_to_save)
-                cached_image = cv2.cvtColor(cv2.imread(cur_path), cv2.COLOR_BGR2RGB)
-                self.masks_2D[id] = torch.tensor(
-                    cached_image / 255, device="cuda", dtype=torch.uint8
-                )[..., 0][None]
+                    masks.append(frames_to_uint8(out[0][..., :1].to(torch.float32)))
+            masks = torch.stack(masks, dim=0).cpu()
+            cache.save(view_list, masks)
+            if self.cfg.cache_png:
+                self.save_cache_png(cache.cache_dir, view_list, masks.repeat(1, 1, 1, 3))
+        # only fully covered pixels are masked, as the uint8 cast of the PNG values / 255 used to do
+        masks = (masks.to(get_device(), non_blocking=True)[..., 0] // 255).to(torch.uint8)
+        for i, id in enumerate(view_list):
+            self.masks_2D[id] = masks[i][None]
 
     def training_step(self, batch, batch_idx):
         self.gaussian.update_learning_rate(self.true_global_step)
@@ -1,3 +1,4 @@
+import time
 from dataclasses import dataclass, field
 
 from tqdm import tqdm
@@ -9,6 +10,7 @@ import os
 from threestudio.utils.clip_metrics import ClipSimilarity
 
 from threestudio.systems.GassuianEditor import GaussianEditor
+from gaussiansplatting.utils.camera_utils import rescale_camera
 
 @threestudio.register("gsedit-system-edit")
 class GaussianEditor_Edit(GaussianEditor):
@@ -26,6 +28,16 @@ class GaussianEditor_Edit(GaussianEditor):
         clip_prompt_origin: str = ""
         clip_prompt_target: str = ""  # only for metrics
 
+        # render DDS-only steps at the resolution the guidance VAE consumes
+        render_at_guidance_size: bool = False
+        # encode the source frames for the DDS guidance before training and keep the latents next to the
+        # origin renders, reused as long as those are (cache_overwrite=False)
+        cache_guidance_latents: bool = False
+        # views edited together by the nerf2nerf guidance: when views of the batch are due for (re-)editing, the
+        # never edited and then the least recently edited other views fill up the group, one edit_latents call
+        # per group. Only the InstructPix2Pix guidance edits more than one view per call
+        edit_batch_size: int = 1
+
     cfg: Config
 
     def configure(self) -> None:
@@ -34,6 +46,8 @@ class GaussianEditor_Edit(GaussianEditor):
             self.cache_dir = os.path.join("edit_cache", self.cfg.cache_dir)
         else:
             self.cache_dir = os.path.join("edit_cache", self.cfg.gs_source.replace("/", "-"))
+        # global step of the last edit of each view
+        self.edit_steps = {}
 
     def on_fit_start(self) -> None:
         super().on_fit_start()
@@ -60,6 +74,75 @@ class GaussianEditor_Edit(GaussianEditor):
             self.second_guidance = threestudio.find(self.cfg.second_guidance_type)(
                 self.cfg.second_guidance
             )
+            if self.cfg.cache_guidance_latents:
+                self.cache_guidance_latents()
+
+    def cache_guidance_latents(self):
+        latents_path = os.path.join(self.cache_dir, "origin_render", "guidance_source_latents.pt")
+        if os.path.exists(latents_path) and not self.cfg.cache_overwrite:
+            self.second_guidance.load_source_latents(latents_path)
+        else:
+            view_list = list(self.view_list)
+            for start in range(0, len(view_list), 8):
+                ids = view_list[start: start + 8]
+                self.second_guidance.cache_source_images(
+                    torch.cat([self.origin_frames[id] for id in ids], dim=0), ids
+                )
+            self.second_guidance.save_source_latents(latents_path)
+
+    def due_edit_views(self, batch_index):
+        # views of the batch to (re-)edit at this step, grouped with other views up to edit_batch_size
+        due = [
+            int(id) for id in batch_index
+            if id not in self.edit_frames
+            or (
+                self.cfg.per_editing_step > 0
+                and self.cfg.edit_begin_step < self.global_step < self.cfg.edit_until_step
+                and self.global_step % self.cfg.per_editing_step == 0
+            )
+        ]
+        if len(due) == 0 or len(due) >= self.cfg.edit_batch_size:
+            return due
+        others = sorted(
+            (int(id) for id in self.view_list if int(id) not in due),
+            key=lambda id: self.edit_steps.get(id, -1),
+        )
+        return due + others[: self.cfg.edit_batch_size - len(due)]
+
+    @torch.no_grad()
+    def render_views(self, ids, local=False):
+        cameras = self.trainer.datamodule.train_dataset.scene.cameras
+        images = {}
+        for start in range(0, len(ids), self.cfg.edit_batch_size):
+            chunk = ids[start: start + self.cfg.edit_batch_size]
+            out = self(
+                {
+                    "index": chunk,
+                    "camera": [cameras[id] for id in chunk],
+                    "height": self.trainer.datamodule.train_dataset.height,
+                    "width": self.trainer.datamodule.train_dataset.width,
+                },
+                local=local,
+            )
+            for id, image in zip(chunk, out["comp_rgb"]):
+                images[id] = image[None]
+        return images
+
+    def edit_views(self, ids, images, prompt_utils):
+        start_time = time.perf_counter()
+        for start in range(0, len(ids), self.cfg.edit_batch_size):
+            chunk = ids[start: start + self.cfg.edit_batch_size]
+            result = self.guidance(
+                torch.cat([images[id] for id in chunk], dim=0),
+                torch.cat([self.origin_frames[id] for id in chunk], dim=0),
+                prompt_utils,
+            )
+            for id, edit_image in zip(chunk, result["edit_images"]):
+                self.edit_frames[id] = edit_image[None]
+                self.edit_steps[id] = self.global_step
+        if torch.cuda.is_available():
+            torch.cuda.synchronize()
+        self.log("train/edit_views_per_sec", len(ids) / (time.perf_counter() - start_time))
 
     def training_step(self, batch, batch_idx):
         self.gaussian.update_learning_rate(self.true_global_step)
@@ -67,6 +150,27 @@ class GaussianEditor_Edit(GaussianEditor):
         batch_index = batch["index"]
         if isinstance(batch_index, int):
             batch_index = [batch_index]
+        edit_ids = []
+        edit_images = {}
+        if self.cfg.loss.lambda_l1 > 0 or self.cfg.loss.lambda_p > 0:
+            edit_ids = self.due_edit_views(batch_index)
+            # the other views of the edit group are rendered before the batch, whose render keeps the
+            # viewspace points and radii used for densification
+            edit_images = self.render_views(
+                [id for id in edit_ids if id not in batch_index], local=self.cfg.local_edit
+            )
+        if (
+                self.cfg.render_at_guidance_size
+                and self.cfg.loss.lambda_dds > 0
+                and self.cfg.loss.lambda_l1 <= 0
+                and self.cfg.loss.lambda_p <= 0
+        ):
+            batch["camera"] = [
+                rescale_camera(
+                    cam, *self.second_guidance.get_guidance_size(cam.image_height, cam.image_width)
+                )
+                for cam in batch["camera"]
+            ]
         out = self(batch, local=self.cfg.local_edit)
 
         images = out["comp_rgb"]
@@ -75,25 +179,11 @@ class GaussianEditor_Edit(GaussianEditor):
         # nerf2nerf loss
         if self.cfg.loss.lambda_l1 > 0 or self.cfg.loss.lambda_p > 0:
             prompt_utils = self.prompt_processor()
-            gt_images = []
-            for img_index, cur_index in enumerate(batch_index):
-                if cur_index not in self.edit_frames or (
-                        self.cfg.per_editing_step > 0
-                        and self.cfg.edit_begin_step
-                        < self.global_step
-                        < self.cfg.edit_until_step
-                        and self.global_step % self.cfg.per_editing_step == 0
-                ):
-                    result = self.guidance(
-                        images[img_index][None],
-                        self.origin_frames[cur_index],
-                        prompt_utils,
-                    )
-
-                    self.edit_frames[cur_index] = result["edit_images"].detach().clone()
-                    # print("edited image index", cur_index)
-
-                gt_images.append(self.edit_frames[cur_index])
+            if len(edit_ids) > 0:
+                for img_index, cur_index in enumerate(batch_index):
+                    edit_images[int(cur_index)] = images[img_index][None].detach()
+                self.edit_views(edit_ids, edit_images, prompt_utils)
+            gt_images = [self.edit_frames[cur_index] for cur_index in batch_index]
             gt_images = torch.concatenate(gt_images, dim=0)
 
             guidance_out = {
@@ -122,6 +212,7 @@ class GaussianEditor_Edit(GaussianEditor):
                 ),
                 dds_target_prompt_utils,
                 dds_source_prompt_utils,
+                cond_index=batch_index,
             )
             for name, value in second_guidance_out.items():
                 self.log(f"train/{name}", value)
@@ -0,0 +1,79 @@
+import torch
+
+from threestudio.utils.typing import *
+
+
+class CFGPlanner:
+    """
+    Collects the (latents, text embeddings, image conditioning) rows that classifier-free guidance formulas
+    need, keeps a single copy of rows requested more than once, runs all of them through the UNet as one
+    batch and returns the prediction of each requested row.
+
+    Rows are matched by tensor identity: callers pass the same tensor objects for inputs that coincide, e.g.
+    the shared unconditional embedding or noisy latents that are equal for two guidance branches.
+    """
+
+    def __init__(self):
+        self.rows = []
+        self.index = {}
+
+    def add(self, latents: Tensor, text_embeddings: Tensor, image_cond: Tensor) -> int:
+        """Requests a row and returns its position in the predictions of `run`."""
+        key = (id(latents), id(text_embeddings), id(image_cond))
+        if key not in self.index:
+            self.index[key] = len(self.rows)
+            self.rows.append((latents, text_embeddings, image_cond))
+        return self.index[key]
+
+    def __len__(self):
+        return len(self.rows)
+
+    def run(self, forward: Callable, t: Tensor) -> List[Tensor]:
+        """Calls forward(model_input, timesteps, encoder_hidden_states) once on all unique rows."""
+        latents, text_embeddings, image_cond = zip(*self.rows)
+        model_input = torch.cat([torch.cat(latents), torch.cat(image_cond)], dim=1)
+        noise_pred = forward(model_input, torch.cat([t] * len(self.rows)), torch.cat(text_embeddings))
+        return list(noise_pred.chunk(len(self.rows)))
+
+
+if __name__ == "__main__":
+    # python -m threestudio.utils.cfg_planner: the predictions of the deduplicated batch against one UNet call on
+    # every requested row, duplicates included, for the DDS rows of a target and a source branch
+    torch.manual_seed(0)
+    conv = torch.nn.Conv2d(8, 4, 3, padding=1)
+    proj = torch.nn.Linear(16, 4)
+
+    def forward(model_input, timesteps, encoder_hidden_states):
+        sample = conv(model_input) * (1 + timesteps.view(-1, 1, 1, 1) / 1000)
+        return sample + proj(encoder_hidden_states.mean(1))[..., None, None]
+
+    with torch.no_grad():
+        for batch_size in [1, 2]:
+            t = torch.randint(20, 980, (batch_size,))
+            image_cond = torch.randn(batch_size, 4, 8, 8)
+            uncond_image = torch.zeros_like(image_cond)
+            text, uncond = torch.randn(batch_size, 5, 16), torch.randn(batch_size, 5, 16)
+            tgt_latents, src_latents = torch.randn(batch_size, 4, 8, 8), torch.randn(batch_size, 4, 8, 8)
+            # target [text, image, uncond], then source [image, uncond] with distinct and with shared latents
+            for source_latents, unique_rows in [(src_latents, 5), (tgt_latents, 3)]:
+                requested = [
+                    (tgt_latents, text, image_cond),
+                    (tgt_latents, uncond, image_cond),
+                    (tgt_latents, uncond, uncond_image),
+                    (source_latents, uncond, image_cond),
+                    (source_latents, uncond, uncond_image),
+                ]
+                planner = CFGPlanner()
+                positions = [planner.add(*row) for row in requested]
+                assert len(planner) == unique_rows
+                noise_pred = planner.run(forward, t)
+
+                latents, text_embeddings, image_conds = zip(*requested)
+                reference = forward(
+                    torch.cat([torch.cat(latents), torch.cat(image_conds)], dim=1),
+                    torch.cat([t] * len(requested)),
+                    torch.cat(text_embeddings),
+                ).chunk(len(requested))
+                for position, expected in zip(positions, reference):
+                    assert torch.allclose(noise_pred[position], expected, atol=1e-6), (batch_size, unique_rows)
+    print("CFGPlanner matches the un-deduplicated batch")
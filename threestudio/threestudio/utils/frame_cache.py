@@ -0,0 +1,151 @@
+import hashlib
+import json
+import os
+from collections import OrderedDict
+
+import numpy as np
+import torch
+
+from threestudio.utils.typing import *
+
+MANIFEST_VERSION = 1
+
+
+def frames_to_uint8(frames: Float[Tensor, "..."]) -> Tensor:
+    # the truncating quantization of (x.clip(0, 1) * 255).astype(np.uint8), done on the device of `frames`
+    return (frames.clip(0.0, 1.0) * 255.0).to(torch.uint8)
+
+
+class FrameCache:
+    """
+    Per-view uint8 images of one view set, stored as a single (V, H, W, C) memory-mapped array
+    (`frames.u8`) next to a json manifest with the view ids, the shape and a sha1 of every view.
+    A cache whose manifest does not match the requested views and resolution is a miss.
+    """
+
+    def __init__(self, cache_dir: str):
+        self.cache_dir = cache_dir
+        self.data_path = os.path.join(cache_dir, "frames.u8")
+        self.manifest_path = os.path.join(cache_dir, "manifest.json")
+
+    def load(
+        self,
+        views: List[int],
+        height: int,
+        width: int,
+        channels: int,
+        verify: bool = True,
+    ) -> Optional[Tensor]:
+        # the whole view set as one uint8 tensor, pinned when CUDA is available, or None on a miss
+        if not os.path.exists(self.manifest_path) or not os.path.exists(self.data_path):
+            return None
+        with open(self.manifest_path) as f:
+            manifest = json.load(f)
+        shape = [len(views), height, width, channels]
+        if (
+            manifest.get("version") != MANIFEST_VERSION
+            or manifest["views"] != [int(view) for view in views]
+            or manifest["shape"] != shape
+            or os.path.getsize(self.data_path) != int(np.prod(shape))
+        ):
+            return None
+
+        data = np.memmap(self.data_path, dtype=np.uint8, mode="r", shape=tuple(shape))
+        frames = torch.empty(shape, dtype=torch.uint8, pin_memory=torch.cuda.is_available())
+        frames.numpy()[:] = data
+        del data
+        if verify and manifest["hashes"] != self._hashes(frames.numpy()):
+            return None
+        return frames
+
+    def save(self, views: List[int], frames: UInt[Tensor, "V H W C"]) -> None:
+        frames = frames.detach().cpu().contiguous().numpy()
+        assert frames.dtype == np.uint8 and frames.ndim == 4 and frames.shape[0] == len(views)
+        os.makedirs(self.cache_dir, exist_ok=True)
+        # the manifest is written last, so an interrupted save is a miss rather than a corrupted hit
+        if os.path.exists(self.manifest_path):
+            os.remove(self.manifest_path)
+        frames.tofile(self.data_path)
+        manifest = {
+            "version": MANIFEST_VERSION,
+            "views": [int(view) for view in views],
+            "shape": list(frames.shape),
+            "hashes": self._hashes(frames),
+        }
+        with open(self.manifest_path + ".tmp", "w") as f:
+            json.dump(manifest, f)
+        os.replace(self.manifest_path + ".tmp", self.manifest_path)
+
+    @staticmethod
+    def _hashes(frames: np.ndarray) -> List[str]:
+        return [hashlib.sha1(frame.data).hexdigest() for frame in frames]
+
+
+class FrameStore:
+    """
+    Dict-like store of per-view (1, H, W, C) frames in [0, 1]. Frames are kept as `dtype` ("uint8", "float16"
+    or "float32"), on pinned host memory when `on_host` is set, and converted to float32 on `device` when read.
+    The last `device_cache` frames read stay cached on the device in float32.
+    """
+
+    def __init__(
+        self,
+        dtype: str = "uint8",
+        device: Optional[torch.device] = None,
+        on_host: bool = False,
+        device_cache: int = 0,
+    ):
+        assert dtype in ["uint8", "float16", "float32"]
+        self.dtype = getattr(torch, dtype)
+        self.device = device if device is not None else torch.device("cuda")
+        self.on_host = on_host
+        self.device_cache = device_cache
+        self.frames = {}
+        self.cache = OrderedDict()
+
+    def __setitem__(self, key: int, frame: Tensor) -> None:
+        frame = frame.detach()
+        if self.dtype == torch.uint8 and frame.dtype != torch.uint8:
+            frame = frames_to_uint8(frame)
+        elif self.dtype != torch.uint8 and frame.dtype == torch.uint8:
+            frame = frame.to(torch.float32) / 255
+        if self.on_host:
+            stored = torch.empty(frame.shape, dtype=self.dtype, pin_memory=torch.cuda.is_available())
+            stored.copy_(frame)
+        else:
+            stored = frame.to(self.device, self.dtype, copy=True)
+        self.frames[key] = stored
+        self.cache.pop(key, None)
+
+    def __getitem__(self, key: int) -> Float[Tensor, "1 H W C"]:
+        if key in self.cache:
+            self.cache.move_to_end(key)
+            return self.cache[key]
+        frame = self.frames[key].to(self.device, non_blocking=True).to(torch.float32)
+        if self.dtype == torch.uint8:
+            frame = frame / 255
+        if self.device_cache > 0:
+            self.cache[key] = frame
+            if len(self.cache) > self.device_cache:
+                self.cache.popitem(last=False)
+        return frame
+
+    def __delitem__(self, key: int) -> None:
+        del self.frames[key]
+        self.cache.pop(key, None)
+
+    def __contains__(self, key: int) -> bool:
+        return key in self.frames
+
+    def __len__(self) -> int:
+        return len(self.frames)
+
+    def __iter__(self):
+        return iter(self.frames)
+
+    def keys(self):
+        return self.frames.keys()
+
+    def items(self):
+        for key in self.frames:
+            yield key, self[key]
@@ -4,7 +4,8 @@ from pathlib import Path
 from PIL import Image
 import torch
 from einops import rearrange
-from torchvision.transforms import ToPILImage, ToTensor
+from torchvision.transforms import functional as TF
+from groundingdino.util.inference import preprocess_caption
 
 from lang_sam import LangSAM
 
@@ -12,28 +13,71 @@ from lang_sam import LangSAM
 
 
 class LangSAMTextSegmentor(torch.nn.Module):
-    def __init__(self, sam_type="vit_h"):
+    def __init__(self, sam_type="vit_h", batch_size=8):
         super().__init__()
         self.model = LangSAM(sam_type)
+        # images encoded together by GroundingDINO and SAM
+        self.batch_size = batch_size
 
-        self.to_pil_image = ToPILImage(mode="RGB")
-        self.to_tensor = ToTensor()
-
-    def forward(self, images, prompt: str):
+    @torch.no_grad()
+    def forward(self, images, prompt: str, box_threshold=0.3, text_threshold=0.25):
+        # Same masks as LangSAM.predict on each image (the first box found for the prompt), but the images stay
+        # tensors on the device and both encoders run on batches of them. text_threshold only selects phrases,
+        # which are not returned.
         images = rearrange(images, "b h w c -> b c h w")
-        masks = []
-        for image in images:
-            # breakpoint()
-            image = self.to_pil_image(image.clamp(0.0, 1.0))
-            mask, _, _, _ = self.model.predict(image, prompt)
-            # breakpoint()
-            if mask.ndim == 3:
-                masks.append(mask[0:1].to(torch.float32))
+        # the quantization of the PIL round-trip
+        images = (images.clamp(0.0, 1.0) * 255).to(torch.uint8).to(self.model.device)
+        masks = [self.segment(batch, prompt, box_threshold) for batch in images.split(self.batch_size)]
+        return torch.cat(masks, dim=0)
+
+    def detect(self, images, prompt: str, box_threshold=0.3):
+        # GroundingDINO boxes (xyxy, pixels) of each uint8 image, in query order like groundingdino's predict
+        height, width = images.shape[-2:]
+        size = 800
+        if max(height, width) / min(height, width) * size > 1333:
+            size = int(round(1333 * min(height, width) / max(height, width)))
+        inputs = TF.resize(images, size, antialias=True).float() / 255
+        inputs = TF.normalize(inputs, [0.485, 0.456, 0.406], [0.229, 0.224, 0.225])
+        caption = preprocess_caption(caption=prompt)
+        outputs = self.model.groundingdino(inputs, captions=[caption] * images.shape[0])
+        logits = outputs["pred_logits"].sigmoid().max(dim=2)[0]
+        boxes = rearrange(outputs["pred_boxes"], "b q (s c) -> b q s c", s=2)
+        boxes = torch.cat([boxes[..., 0, :] - boxes[..., 1, :] / 2, boxes[..., 0, :] + boxes[..., 1, :] / 2], -1)
+        boxes = boxes * torch.tensor([width, height, width, height], device=boxes.device)
+        return [image_boxes[image_logits > box_threshold] for image_boxes, image_logits in zip(boxes, logits)]
+
+    def segment(self, images, prompt: str, box_threshold=0.3):
+        masks = torch.zeros(images.shape[0], 1, *images.shape[-2:], device=images.device)
+        boxes = self.detect(images, prompt, box_threshold)
+        detected = []
+        for i, image_boxes in enumerate(boxes):
+            if len(image_boxes) > 0:
+                detected.append(i)
             else:
                 print(f"None {prompt} Detected")
-                masks.append(torch.zeros_like(images[0, 0:1]))
+        if len(detected) == 0:
+            return masks
 
-        return torch.stack(masks, dim=0)
+        sam = self.model.sam
+        original_size = tuple(images.shape[-2:])
+        inputs = sam.transform.apply_image_torch(images[detected].float())
+        features = sam.model.image_encoder(sam.model.preprocess(inputs))
+        for feature, i in zip(features, detected):
+            # what SamPredictor.set_image leaves behind, for one image of the batch
+            sam.features = feature[None]
+            sam.original_size = original_size
+            sam.input_size = tuple(inputs.shape[-2:])
+            sam.is_image_set = True
+            # only the mask of the first box is used, SAM decodes each box independently
+            image_masks, _, _ = sam.predict_torch(
+                point_coords=None,
+                point_labels=None,
+                boxes=sam.transform.apply_boxes_torch(boxes[i][:1], original_size),
+                multimask_output=False,
+            )
+            masks[i] = image_masks[0].to(torch.float32)
+        sam.reset_image()
+        return masks
 
 
 if __name__ == "__main__":
@@ -0,0 +1,44 @@
+from threestudio.utils.typing import *
+
+
+class TruncatedScheduler:
+    """
+    A copy of a diffusers scheduler whose inference timesteps cover [0, t_start] instead of the whole training
+    range, with the noise tables of the original. This is what setting scheduler.config.num_train_timesteps
+    to t_start before set_timesteps did in the edit loops, without mutating the scheduler shared with the
+    score distillation paths. Only stateless schedulers such as DDIM can be reused across calls.
+    """
+
+    def __init__(self, scheduler, num_inference_steps: int, t_start: int):
+        config = dict(scheduler.config)
+        config["num_train_timesteps"] = t_start
+        self._scheduler = type(scheduler).from_config(config)
+        for name in ["betas", "alphas", "alphas_cumprod", "final_alpha_cumprod"]:
+            if hasattr(scheduler, name):
+                setattr(self._scheduler, name, getattr(scheduler, name))
+        self._scheduler.set_timesteps(num_inference_steps)
+        self.t_start = t_start
+
+    @property
+    def timesteps(self) -> Tensor:
+        return self._scheduler.timesteps
+
+    def step(self, *args, **kwargs):
+        return self._scheduler.step(*args, **kwargs)
+
+
+class TruncatedSchedulerCache:
+    """TruncatedScheduler of each start timestep, built on first use."""
+
+    def __init__(self, scheduler, num_inference_steps: int):
+        self.scheduler = scheduler
+        self.num_inference_steps = num_inference_steps
+        self.schedulers: Dict[int, TruncatedScheduler] = {}
+
+    def __getitem__(self, t_start: int) -> TruncatedScheduler:
+        t_start = int(t_start)
+        if t_start not in self.schedulers:
+            self.schedulers[t_start] = TruncatedScheduler(
+                self.scheduler, self.num_inference_steps, t_start
+            )
+        return self.schedulers[t_start]